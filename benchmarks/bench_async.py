@@ -0,0 +1,69 @@
+"""
+Throughput of concurrent Student.fetchone(id=...) calls:
+- threaded: the blocking API, run in a ThreadPoolExecutor as an asyncio service
+  would do with run_in_executor
+- asyncio: the coroutines of postgrespy/aio.py
+Both pools get the same POSTGRES_POOL_MAX_CONN connections.
+Needs the database of pg/ and the POSTGRES_* environment variables.
+Usage: PYTHONPATH=. python benchmarks/bench_async.py [requests] [concurrency] [threads]
+"""
+
+import asyncio
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from postgrespy.aio import get_async_pool
+from postgrespy.db import get_pool
+from tests.models import Student
+
+
+async def threaded(ids, concurrency, executor):
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(id):
+        async with semaphore:
+            await loop.run_in_executor(executor, lambda: Student.fetchone(id=id))
+
+    await asyncio.gather(*[one(id) for id in ids])
+
+
+async def native(ids, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(id):
+        async with semaphore:
+            await Student.afetchone(id=id)
+
+    await asyncio.gather(*[one(id) for id in ids])
+
+
+def run(requests, concurrency, threads):
+    students = Student.insert_many({'name': 'Student %d' % i, 'age': i} for i in range(100))
+    ids = [students[i % 100].id for i in range(requests)]
+    loop = asyncio.new_event_loop()
+    try:
+        with ThreadPoolExecutor(threads) as executor:
+            start = time.perf_counter()
+            loop.run_until_complete(threaded(ids, concurrency, executor))
+            print('threaded (%d threads): %8.0f req/sec' %
+                  (threads, requests / (time.perf_counter() - start)))
+
+        start = time.perf_counter()
+        loop.run_until_complete(native(ids, concurrency))
+        print('asyncio:               %8.0f req/sec' %
+              (requests / (time.perf_counter() - start)))
+    finally:
+        loop.close()
+        for student in students:
+            student.delete()
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    get_pool()
+    pool = get_async_pool()
+    run(args[0] if len(args) > 0 else 5000,
+        args[1] if len(args) > 1 else 100,
+        args[2] if len(args) > 2 else pool.maxconn)
@@ -0,0 +1,75 @@
+"""
+Rows/sec and memory per row when building Student objects from result rows:
+- legacy: `Student()` then one `setattr` per column, as Query.fetchall used to do
+- hydrator: the generated constructor of postgrespy/hydration.py
+- compact: the __slots__ based CompactRow
+By default rows are generated in memory so that only the Python side is measured.
+With --db, the rows are inserted in the `students` table then read with `Student.fetchall()`
+(needs the database of pg/ and the POSTGRES_* environment variables).
+Usage: PYTHONPATH=. python benchmarks/bench_hydration.py [rows] [--db]
+"""
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from tests.models import Student
+
+
+def legacy(row):
+    r = Student()
+    for i, f in enumerate(Student._schema.select_columns):
+        setattr(r, f, row[i])
+    return r
+
+
+def measure(name, hydrate, rows):
+    gc.collect()
+    start = time.perf_counter()
+    objs = [hydrate(row) for row in rows]
+    elapsed = time.perf_counter() - start
+    del objs
+    gc.collect()
+
+    # Memory is measured on a sample, tracemalloc slows everything down
+    sample = rows[:100000]
+    tracemalloc.start()
+    objs = [hydrate(row) for row in sample]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    print('%-10s %10.0f rows/sec %8.0f bytes/row' %
+          (name, len(rows) / elapsed, size / len(sample)))
+
+
+def run_db(n):
+    from postgrespy.db import get_pool
+    from postgrespy.queries import Select
+    get_pool()
+    Student.insert_many(({'name': 'Student %d' % i, 'age': i % 100, 'is_male': i % 2 == 0}
+                         for i in range(n)), returning=False)
+    try:
+        for compact in (False, True):
+            start = time.perf_counter()
+            with Select(Student, compact=compact) as select:
+                select.execute()
+                rows = select.fetchall()
+            elapsed = time.perf_counter() - start
+            print('Student.fetchall(compact=%s) %10.0f rows/sec' % (compact, len(rows) / elapsed))
+            del rows
+    finally:
+        with Select(Student) as select:
+            select.cur.execute('DELETE FROM students')
+            select.conn.commit()
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 1000000
+    if '--db' in sys.argv:
+        run_db(n)
+    else:
+        rows = [('Student %d' % i, i % 100, i % 2 == 0, i) for i in range(n)]
+        measure('legacy', legacy, rows)
+        measure('hydrator', Student._schema.hydrator(), rows)
+        measure('compact', Student._schema.hydrator(compact=True), rows)
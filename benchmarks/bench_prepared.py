@@ -0,0 +1,47 @@
+"""
+Latency of repeated Model CRUD and Select calls, with and without
+server-side prepared statements.
+Needs the database of pg/ (see pg/README.md) and the POSTGRES_* environment variables.
+Usage: PYTHONPATH=. python benchmarks/bench_prepared.py [iterations]
+"""
+
+import sys
+import time
+
+from postgrespy.db import get_pool
+from postgrespy.prepared import use_prepared_statements
+from tests.models import Student
+
+
+def timeit(fn, iterations):
+    """Return the mean latency of `fn()` in microseconds"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run(iterations):
+    peter = Student.insert(name='Peter', age=15)
+    cases = [
+        ('fetchone(id=)', lambda: Student.fetchone(id=peter.id)),
+        ('update(age=)', lambda: peter.update(age=16)),
+        ('insert+delete', lambda: Student.insert(name='Tmp', age=1).delete()),
+    ]
+    try:
+        for name, fn in cases:
+            results = []
+            for prepared in (False, True):
+                use_prepared_statements(prepared)
+                fn()  # warm up: PREPARE happens here
+                results.append(timeit(fn, iterations))
+            print('%-15s plain: %8.1f us   prepared: %8.1f us   (%.0f%%)' %
+                  (name, results[0], results[1], 100 * results[1] / results[0]))
+    finally:
+        use_prepared_statements(False)
+        peter.delete()
+
+
+if __name__ == '__main__':
+    get_pool()
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,279 @@
+"""
+Benchmark suite of the main paths, on the tables of tests/models.py:
+- crud: Student.insert, fetchone(id=...), update and delete of a single row
+- fetchall: Student.fetchall() of 1k and 100k rows (--rows 1000,100000,1000000 for 1M)
+- join2, join3: Join of students and cars, then products, fetchall()
+- jsonb, array: fetchall() of products (JSONB column) and movies (array columns)
+- threads: Student.fetchone(id=...) from a thread pool sharing the connection pool
+
+Every case reports ops/sec and the p50/p99 latency of one operation (a call, or a whole
+fetchall), in milliseconds. Results are written as JSON, to compare two runs:
+
+    PYTHONPATH=. python benchmarks/suite.py run --output before.json
+    (change something)
+    PYTHONPATH=. python benchmarks/suite.py run --output after.json
+    PYTHONPATH=. python benchmarks/suite.py compare before.json after.json
+
+`compare` exits with 1 if a case got slower than --threshold (default 10%).
+Needs the database of pg/ and the POSTGRES_* environment variables. The tables
+must be empty: the suite fills them, and empties them when it's done.
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from postgrespy.db import get_pool, get_conn_cur, commit, close
+from postgrespy.queries import Join
+from tests.models import Student, Product, Car, Movie
+
+
+def percentile(latencies, q):
+    """The `q` (0 to 1) percentile of the sorted `latencies`"""
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def result(latencies, elapsed, rows=None):
+    """Result of a case from the latencies of its operations, in seconds"""
+    latencies = sorted(latencies)
+    ret = dict(ops=len(latencies),
+               ops_per_sec=len(latencies) / elapsed,
+               p50_ms=percentile(latencies, 0.5) * 1e3,
+               p99_ms=percentile(latencies, 0.99) * 1e3)
+    if rows is not None:
+        ret['rows_per_sec'] = rows * len(latencies) / elapsed
+    return ret
+
+
+def measure(fn, iterations, rows=None):
+    """Call `fn()` `iterations` times, after a warm-up call"""
+    fn()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t)
+    return result(latencies, time.perf_counter() - start, rows)
+
+
+def sql(stmt):
+    """Return the rows of `stmt`, if any"""
+    conn, cur = get_conn_cur()
+    try:
+        cur.execute(stmt)
+        return cur.fetchall() if cur.description else None
+    finally:
+        commit(conn)
+        close(conn, cur)
+
+
+def analyze(*models):
+    """Update the planner statistics of freshly loaded tables"""
+    sql('ANALYZE ' + ','.join(model.Meta.table for model in models))
+
+
+def repeats(n, iterations):
+    """Number of fetchall of `n` rows: a few full scans are enough for the large tables"""
+    return max(3, min(iterations, 1000000 // n))
+
+
+def clean():
+    # Products and cars are deleted by cascade
+    Student.delete_where('TRUE')
+    Movie.delete_where('TRUE')
+
+
+def students(n):
+    """Fill the students table with `n` rows, return their ids"""
+    Student.copy_from({'name': 'Student %d' % i, 'age': i % 100, 'is_male': i % 2 == 0}
+                      for i in range(n))
+    analyze(Student)
+    return [row[0] for row in sql('SELECT id FROM students ORDER BY id')]
+
+
+def bench_crud(iterations):
+    peter = Student.insert(name='Peter', age=15)
+    tmp = []
+    results = {
+        'crud.insert': measure(lambda: tmp.append(Student.insert(name='Tmp', age=1)),
+                               iterations),
+        'crud.fetchone': measure(lambda: Student.fetchone(id=peter.id), iterations),
+        'crud.update': measure(lambda: peter.update(age=16), iterations),
+    }
+    deletes = iter(tmp)
+    results['crud.delete'] = measure(lambda: next(deletes).delete(), iterations)
+    clean()
+    return results
+
+
+def bench_fetchall(sizes, iterations):
+    results = {}
+    for n in sizes:
+        students(n)
+        results['fetchall.%d' % n] = measure(Student.fetchall, repeats(n, iterations), n)
+        clean()
+    return results
+
+
+def bench_joins(n, iterations):
+    ids = students(n)
+    Car.copy_from({'name': 'Car %d' % i, 'owner_id': id} for i, id in enumerate(ids))
+    Product.copy_from({'name': 'Product %d' % i, 'owner_id': id, 'detail': {'color': 'red'}}
+                      for i, id in enumerate(ids))
+    analyze(Car, Product)
+
+    def join2():
+        with Join(Student, 'INNER JOIN', Car, Student.c.id == Car.c.owner_id) as query:
+            query.execute()
+            return query.fetchall()
+
+    def join3():
+        with Join(Student).join('INNER JOIN', Car, Student.c.id == Car.c.owner_id) \
+                .join('INNER JOIN', Product, Student.c.id == Product.c.owner_id) as query:
+            query.execute()
+            return query.fetchall()
+
+    repeat = repeats(n, iterations)
+    results = {'join2.%d' % n: measure(join2, repeat, n),
+               'join3.%d' % n: measure(join3, repeat, n)}
+    clean()
+    return results
+
+
+def bench_hydration(n, iterations):
+    ids = students(1)
+    Product.copy_from({'name': 'Product %d' % i, 'owner_id': ids[0],
+                       'detail': {'color': 'red', 'size': i, 'tags': ['a', 'b']}}
+                      for i in range(n))
+    Movie.copy_from({'name': 'Movie %d' % i, 'casts': ['Actor %d' % j for j in range(5)],
+                     'earning': [{'country': 'USA', 'amount': i}],
+                     'trivia': [{'fact': 'Fact %d' % i}]}
+                    for i in range(n))
+    analyze(Product, Movie)
+    repeat = repeats(n, iterations)
+    results = {'jsonb.%d' % n: measure(Product.fetchall, repeat, n),
+               'array.%d' % n: measure(Movie.fetchall, repeat, n)}
+    clean()
+    return results
+
+
+def bench_threads(iterations, threads):
+    ids = students(100)
+    latencies = []
+
+    def one(i):
+        t = time.perf_counter()
+        Student.fetchone(id=ids[i % 100])
+        latencies.append(time.perf_counter() - t)
+
+    pool = get_pool()
+    waits = pool.stats()['waits']
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(one, range(threads)))  # warm up the connections
+        del latencies[:]
+        start = time.perf_counter()
+        list(executor.map(one, range(iterations)))
+        elapsed = time.perf_counter() - start
+    ret = result(latencies, elapsed)
+    ret['threads'] = threads
+    ret['pool_waits'] = pool.stats()['waits'] - waits
+    clean()
+    return {'threads.fetchone': ret}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    get_pool()
+    if Student.exists() or Movie.exists():
+        sys.exit('The students and movies tables must be empty')
+    cases = args.cases.split(',')
+    sizes = [int(n) for n in args.rows.split(',')]
+    results = {}
+    try:
+        if 'crud' in cases:
+            results.update(bench_crud(args.iterations))
+        if 'fetchall' in cases:
+            results.update(bench_fetchall(sizes, args.iterations))
+        if 'join' in cases:
+            results.update(bench_joins(sizes[0], args.iterations))
+        if 'hydration' in cases:
+            results.update(bench_hydration(sizes[0], args.iterations))
+        if 'threads' in cases:
+            results.update(bench_threads(args.iterations, args.threads or get_pool().maxconn))
+    finally:
+        clean()
+
+    report = dict(meta=dict(commit=git_commit(), date=datetime.now().isoformat(),
+                            python=platform.python_version(),
+                            postgres=sql('SHOW server_version')[0][0],
+                            iterations=args.iterations),
+                  results=results)
+    for name, r in sorted(results.items()):
+        print('%-20s %10.0f ops/sec   p50 %8.3f ms   p99 %8.3f ms' %
+              (name, r['ops_per_sec'], r['p50_ms'], r['p99_ms']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print('%s -> %s' % (before['meta'].get('commit'), after['meta'].get('commit')))
+    regressions = 0
+    for name in sorted(set(before['results']) & set(after['results'])):
+        b, a = before['results'][name], after['results'][name]
+        ops = a['ops_per_sec'] / b['ops_per_sec'] - 1
+        p99 = a['p99_ms'] / b['p99_ms'] - 1
+        slower = ops < -args.threshold
+        regressions += slower
+        print('%-20s ops/sec %+7.1f%%   p99 %+7.1f%%%s' %
+              (name, ops * 100, p99 * 100, '   SLOWER' if slower else ''))
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--cases', default='crud,fetchall,join,hydration,threads',
+                            help='comma-separated cases to run')
+    run_parser.add_argument('--rows', default='1000,100000',
+                            help='comma-separated table sizes of fetchall, '
+                                 'the first one is used by join and hydration')
+    run_parser.add_argument('--iterations', type=int, default=2000,
+                            help='operations per case, fewer full scans of the large tables')
+    run_parser.add_argument('--threads', type=int, default=0,
+                            help='threads of the threads case, default: POSTGRES_POOL_MAX_CONN')
+    run_parser.add_argument('--output', help='JSON file of the results')
+    compare_parser = commands.add_parser('compare', help='compare two JSON results')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='slowdown of ops/sec reported as a regression')
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        compare(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -23,8 +23,12 @@ create table movies (
     trivia JSONB[]
 );
 
+create type mood as enum ('sad', 'ok', 'happy');
+
 create table entries (
     id serial primary key,
     body text,
-    updated timestamp
+    updated timestamp,
+    mood mood,
+    rating numeric
 );
@@ -1,7 +1,18 @@
 """Version 0.2.1, July 2017"""
 
+from psycopg2.pool import PoolError
+
 
 class UniqueViolatedError(Exception):
     """Exception rasied for unique constrain violated
     """
     pass
+
+
+class PoolTimeoutError(PoolError):
+    """Exception raised when no pooled connection is available in time
+    """
+    pass
+
+
+from postgrespy.db import transaction  # noqa: E402
@@ -0,0 +1,165 @@
+"""
+asyncio support, built on psycopg2's asynchronous connections.
+http://initd.org/psycopg/docs/advanced.html#asynchronous-support
+
+Step-by-step usage for this module:
+- (Optional) get a pool from `pool = get_async_pool()`, with the same settings as `db.get_pool`
+- use the `a`-prefixed coroutines of models and queries:
+    `student = await Student.ainsert(name='Tom')`
+    `await student.aupdate(age=20)`
+    `students = await Select(Student, 'age > %s').afetchall((18, ))`
+    `async for student in Student.aiter(batch_size=1000): ...`
+
+Asynchronous connections are always in autocommit mode: every statement is
+committed as soon as it's executed.
+"""
+
+import asyncio
+from collections import deque
+from time import perf_counter
+
+import psycopg2
+from psycopg2 import OperationalError
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+
+from postgrespy.db import settings
+from postgrespy import instrumentation
+
+_pool = None
+
+
+async def wait(conn):
+    """Wait until the pending operation of the asynchronous connection `conn` is done"""
+    loop = asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == POLL_OK:
+            return
+        fd = conn.fileno()
+        future = loop.create_future()
+
+        def ready():
+            if not future.done():
+                future.set_result(None)
+
+        if state == POLL_READ:
+            loop.add_reader(fd, ready)
+            try:
+                await future
+            finally:
+                loop.remove_reader(fd)
+        elif state == POLL_WRITE:
+            loop.add_writer(fd, ready)
+            try:
+                await future
+            finally:
+                loop.remove_writer(fd)
+        else:
+            raise OperationalError('Bad poll state: ' + str(state))
+
+
+async def execute(conn, stmt, values=None):
+    """Execute `stmt` on the asynchronous connection `conn`, return the cursor"""
+    cur = conn.cursor()
+    cur.execute(stmt, values)
+    await wait(conn)
+    return cur
+
+
+class AsyncPool:
+    """ Pool of asynchronous connections.
+    When `maxconn` connections are in use, `getconn()` waits for one to be returned,
+    waiters are served in FIFO order.
+    """
+
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.minconn = int(minconn)
+        self.maxconn = int(maxconn)
+        self._kwargs = kwargs
+        self._idle = deque()
+        self._waiters = deque()
+        self._size = 0
+
+    async def _connect(self):
+        self._size += 1
+        try:
+            conn = psycopg2.connect(async_=1, **self._kwargs)
+            await wait(conn)
+        except BaseException:
+            self._size -= 1
+            raise
+        return conn
+
+    async def getconn(self):
+        while self._idle:
+            conn = self._idle.popleft()
+            if not conn.closed:
+                return conn
+            self._size -= 1
+        if self._size < self.maxconn:
+            return await self._connect()
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append(future)
+        conn = await future
+        if conn is None:
+            # The connection given back was closed, open a new one instead
+            return await self._connect()
+        return conn
+
+    def putconn(self, conn, close=False):
+        if close and not conn.closed:
+            conn.close()
+        while self._waiters:
+            future = self._waiters.popleft()
+            if future.done():
+                # The waiter was cancelled
+                continue
+            if conn.closed:
+                self._size -= 1
+                future.set_result(None)
+                return
+            future.set_result(conn)
+            return
+        if conn.closed:
+            self._size -= 1
+        else:
+            self._idle.append(conn)
+
+    def acquire(self):
+        """`async with pool.acquire() as conn:` get a connection and put it back"""
+        return _Acquire(self)
+
+    def closeall(self):
+        for conn in self._idle:
+            conn.close()
+        self._size -= len(self._idle)
+        self._idle.clear()
+
+
+class _Acquire:
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    async def __aenter__(self):
+        if not instrumentation.listening():
+            self.conn = await self.pool.getconn()
+            return self.conn
+        start = perf_counter()
+        self.conn = await self.pool.getconn()
+        instrumentation.checked_out(self.conn, perf_counter() - start)
+        return self.conn
+
+    async def __aexit__(self, type, value, tb):
+        # A connection interrupted in the middle of a statement can't be reused
+        broken = type is not None and self.conn.isexecuting()
+        self.pool.putconn(self.conn, close=broken)
+
+
+def get_async_pool(minconn=None, maxconn=None, database=None, user=None, password=None, host=None, port=None):
+    """Same as `db.get_pool`, for the asynchronous pool"""
+    global _pool
+    if _pool is None:
+        _pool = AsyncPool(**settings(minconn, maxconn, database, user,
+                                     password, host, port))
+    return _pool
@@ -0,0 +1,169 @@
+"""
+In-process caches.
+`statement_cache` keeps the SQL text generated by models and queries, so that
+calls with the same shape (model class, operation, columns) don't rebuild it.
+`RowCache` keeps rows of models by id, see its docstring.
+"""
+
+import pickle
+import select
+import time
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+
+import psycopg2
+
+from postgrespy.db import settings
+
+
+class LRUCache:
+    """ Thread-safe, bounded, least-recently-used cache with hit/miss counters"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, build=None):
+        """ Return the value cached for `key`.
+        On a miss, if `build` is given, cache and return `build()`, otherwise return None."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return value
+        if build is None:
+            return None
+        value = build()
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'maxsize': self.maxsize, 'currsize': len(self._data)}
+
+
+statement_cache = LRUCache(maxsize=512)
+
+
+class RowCache(LRUCache):
+    """ Cache of rows by (table, id), set as `cache` in the `Meta` of models:
+        class Meta:
+            table = 'students'
+            cache = RowCache(maxsize=10000, ttl=60)
+    `Model.fetchone(id=...)` and `Select(model_cls, 'id=%s')` read through it,
+    `update()` and `delete()` evict the rows they write.
+    Entries expire `ttl` seconds after being stored.
+    With read replicas, the lookups by id which go through the cache read the primary:
+    a replica lagging behind a write would fill the cache with the old row.
+    Rows are kept pickled: the objects built from a cached row never share its dicts and
+    lists (JSONB, arrays) with the cache, nor with each other.
+    If `channel` is set, these writes also send `NOTIFY channel, 'table:id'`,
+    and `listen()` evicts the rows notified by any process.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, channel=None):
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.channel = channel
+        self.evictions = 0
+        self.expirations = 0
+        self._listening = None
+
+    def get_row(self, table, id):
+        key = (table, id)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            row = entry[1]
+        return pickle.loads(row)
+
+    def set_row(self, table, id, row):
+        self.set((table, id),
+                 (time.monotonic() + self.ttl, pickle.dumps(row, pickle.HIGHEST_PROTOCOL)))
+
+    def evict(self, table, id):
+        if self.pop((table, id)) is not None:
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        super().clear()
+        self.evictions = 0
+        self.expirations = 0
+
+    def info(self):
+        ret = super().info()
+        ret.update(ttl=self.ttl, evictions=self.evictions, expirations=self.expirations)
+        return ret
+
+    def listen(self, **kwargs):
+        """ Start a daemon thread, on its own connection, evicting the rows notified on
+        `channel`. Connection settings which are not given are the ones of `db.get_pool()`"""
+        params = settings(**kwargs)
+        params.pop('minconn')
+        params.pop('maxconn')
+        conn = psycopg2.connect(**params)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute('LISTEN ' + self.channel)
+        self._listening = Event()
+        self._listening.set()
+        thread = Thread(target=self._listen, args=(conn, self._listening),
+                        name='postgrespy-cache-listener', daemon=True)
+        thread.start()
+        return thread
+
+    def stop_listening(self):
+        if self._listening is not None:
+            self._listening.clear()
+            self._listening = None
+
+    def _listen(self, conn, listening):
+        try:
+            while listening.is_set():
+                if select.select([conn], [], [], 0.5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    table, _, id = conn.notifies.pop(0).payload.rpartition(':')
+                    self.evict(table, int(id))
+        finally:
+            conn.close()
@@ -0,0 +1,245 @@
+"""
+Helpers for PostgreSQL `COPY ... FROM STDIN` and `COPY ... TO STDOUT`.
+Rows are encoded lazily: `RowStream` is a file-like object that psycopg2's
+`copy_expert` reads from, so a large dataset never has to be materialized as
+one big string.
+Rows are encoded in the text format, or in the binary format with the encoders
+returned by `binary_encoder()` for the types of the columns.
+https://www.postgresql.org/docs/current/static/sql-copy.html
+"""
+
+import json
+import struct
+import uuid
+from datetime import date, datetime, time, timedelta, timezone
+
+# Options of each COPY format
+FORMATS = {'binary': ' WITH (FORMAT binary)',
+           'csv': ' WITH (FORMAT csv, HEADER true)',
+           'text': ''}
+
+
+def _escape(text):
+    """Escape a value for the COPY text format"""
+    return text.replace('\\', '\\\\') \
+        .replace('\n', '\\n') \
+        .replace('\r', '\\r') \
+        .replace('\t', '\\t')
+
+
+def _array_element(value):
+    """Render an element of an array literal: {"a","b"}"""
+    if value is None:
+        return 'NULL'
+    if type(value) is bool:
+        return 't' if value else 'f'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return _array_literal(value)
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    elif isinstance(value, (date, time)):
+        value = value.isoformat()
+    else:
+        value = str(value)
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _array_literal(values):
+    return '{' + ','.join(_array_element(v) for v in values) + '}'
+
+
+def encode_text(value):
+    """Encode one Python value as a field of the COPY text format"""
+    if value is None:
+        return '\\N'
+    if type(value) is bool:
+        return 't' if value else 'f'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, dict):
+        return _escape(json.dumps(value))
+    if isinstance(value, (list, tuple)):
+        return _escape(_array_literal(value))
+    if isinstance(value, (date, time)):
+        return _escape(value.isoformat())
+    return _escape(str(value))
+
+
+def encode_row(values):
+    return '\t'.join(encode_text(v) for v in values) + '\n'
+
+
+class RowStream:
+    """ File-like object feeding `rows` (an iterable of value tuples) to `copy_expert`
+    Only `read()` is implemented, which is all psycopg2 needs.
+    `encode` returns str (text format) or bytes (binary format, with its `header`
+    and `trailer`).
+    """
+
+    def __init__(self, rows, encode=encode_row, header='', trailer=''):
+        self._rows = iter(rows)
+        self._encode = encode
+        self._buffer = header
+        self._trailer = trailer
+
+    def read(self, size=-1):
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            row = next(self._rows, _END)
+            if row is _END:
+                parts.append(self._trailer)
+                length += len(self._trailer)
+                self._trailer = self._trailer[:0]
+                break
+            line = self._encode(row)
+            parts.append(line)
+            length += len(line)
+        data = self._buffer[:0].join(parts)
+        if size < 0:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def copy_from(cur, table, columns, rows, size=8192, encoders=None):
+    """ Stream `rows` into `table` with COPY FROM STDIN, using the cursor `cur`.
+    With `encoders` (one per column, see `binary_encoder()`), in the binary format"""
+    stmt = 'COPY ' + table + ' (' + ','.join(columns) + ') FROM STDIN'
+    if encoders is None:
+        cur.copy_expert(stmt, RowStream(rows), size)
+    else:
+        cur.copy_expert(stmt + FORMATS['binary'],
+                        RowStream(rows, binary_row_encoder(encoders), _HEADER, _TRAILER), size)
+
+
+def copy_file_from(cur, table, columns, fileobj, format, size=8192):
+    """Stream the file-like `fileobj`, in `format` (see FORMATS), into `table`"""
+    stmt = 'COPY ' + table + ' (' + ','.join(columns) + ') FROM STDIN' + _options(format)
+    cur.copy_expert(stmt, fileobj, size)
+
+
+def copy_to(cur, source, fileobj, format, size=8192):
+    """ Write `source`, 'table (columns)' or '(query)', to the file-like `fileobj`
+    in `format` (see FORMATS), by chunks of `size` bytes"""
+    cur.copy_expert('COPY ' + source + ' TO STDOUT' + _options(format), fileobj, size)
+
+
+def _options(format):
+    try:
+        return FORMATS[format]
+    except KeyError:
+        raise ValueError('Unknown COPY format: ' + str(format))
+
+
+"""
+Binary format: a header, then per row the number of fields and, per field,
+its length (-1 for NULL) followed by its value in the binary representation of
+its type (the one of the `send` function of the type).
+https://www.postgresql.org/docs/current/static/sql-copy.html#id-1.9.3.55.9.4
+"""
+
+_END = object()
+_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_TRAILER = struct.pack('!h', -1)
+_NULL = struct.pack('!i', -1)
+_length = struct.Struct('!i').pack
+_EPOCH = datetime(2000, 1, 1)
+_EPOCH_TZ = datetime(2000, 1, 1, tzinfo=timezone.utc)
+_DAY_EPOCH = date(2000, 1, 1).toordinal()
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _packer(fmt, convert):
+    pack = struct.Struct(fmt).pack
+    return lambda value: pack(convert(value))
+
+
+def _encode_json(value):
+    # Strings are JSON texts already, like when they are given to psycopg2
+    return (value if isinstance(value, str) else json.dumps(value)).encode()
+
+
+def _encode_timestamptz(value):
+    if value.tzinfo is None:
+        # Naive datetimes are taken as UTC
+        return struct.pack('!q', (value - _EPOCH) // _MICROSECOND)
+    return struct.pack('!q', (value - _EPOCH_TZ) // _MICROSECOND)
+
+
+def _encode_uuid(value):
+    return (value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))).bytes
+
+
+_ENCODERS = {
+    'bool': lambda value: b'\x01' if value else b'\x00',
+    'int2': _packer('!h', int),
+    'int4': _packer('!i', int),
+    'int8': _packer('!q', int),
+    'oid': _packer('!I', int),
+    'float4': _packer('!f', float),
+    'float8': _packer('!d', float),
+    'text': lambda value: str(value).encode(),
+    'varchar': lambda value: str(value).encode(),
+    'bpchar': lambda value: str(value).encode(),
+    'name': lambda value: str(value).encode(),
+    'json': _encode_json,
+    # jsonb: a version number, then the JSON text
+    'jsonb': lambda value: b'\x01' + _encode_json(value),
+    'timestamp': lambda value: struct.pack('!q', (value - _EPOCH) // _MICROSECOND),
+    'timestamptz': _encode_timestamptz,
+    'date': lambda value: struct.pack('!i', value.toordinal() - _DAY_EPOCH),
+    'uuid': _encode_uuid,
+    'bytea': bytes,
+}
+
+
+def _array_encoder(element_encoder, element_oid):
+    """Encoder of the one-dimensional arrays of elements encoded by `element_encoder`"""
+    def encode(values):
+        if not values:
+            return struct.pack('!iii', 0, 0, element_oid)
+        parts = [struct.pack('!iiiii', 1, any(v is None for v in values), element_oid,
+                             len(values), 1)]
+        for value in values:
+            if value is None:
+                parts.append(_NULL)
+            else:
+                data = element_encoder(value)
+                parts.append(_length(len(data)))
+                parts.append(data)
+        return b''.join(parts)
+    return encode
+
+
+def binary_encoder(type_name, element_type_name=None, element_oid=None):
+    """ Return the function encoding a Python value of a column of type `type_name`
+    (`pg_type.typname`), as bytes of the binary COPY format.
+    For arrays, `element_type_name` and `element_oid` are the ones of their elements."""
+    if element_type_name is not None:
+        return _array_encoder(binary_encoder(element_type_name), element_oid)
+    try:
+        return _ENCODERS[type_name]
+    except KeyError:
+        raise ValueError('No binary COPY encoding for the type ' + type_name +
+                         ', use the csv or text format')
+
+
+def binary_row_encoder(encoders):
+    """Return the function encoding a tuple of values, one per encoder, as a binary row"""
+    count = struct.pack('!h', len(encoders))
+
+    def encode(row):
+        parts = [count]
+        for encode_value, value in zip(encoders, row):
+            if value is None:
+                parts.append(_NULL)
+            else:
+                data = encode_value(value)
+                parts.append(_length(len(data)))
+                parts.append(data)
+        return b''.join(parts)
+    return encode
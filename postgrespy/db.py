@@ -4,64 +4,334 @@ Step-by-step usage for this module:
 - (Optional) Define POSTGRES_POOL_MIN_CONN, POSTGRES_POOL_MAX_CONN, 
 POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT
 in environment file then source it. Otherwise, you need to supply then in `get_pool`
+- (Optional) Define POSTGRES_POOL_TIMEOUT, POSTGRES_POOL_MAX_LIFETIME, POSTGRES_POOL_IDLE_TIMEOUT
+(in seconds), see postgrespy/pool.py
 - get a pool from `pool = get_pool()`)
 - from the pool, get the a connection `conn = pool.getconn()`
 - from te connection, get the cursor `cur = conn.cursor()`
 - working with the database through the cursor
 - Don't forget to commit the connection (`conn.commit()`) and release it `pool.putconn(conn)`
+
+Models and queries use `get_conn_cur()`, `commit()`, `rollback()` and `close()`,
+which take care of the transaction opened by `transaction()`, if any.
+
+Read replicas:
+- register them with `add_replica(name, host=..., port=...)`, the missing settings
+are the ones of the primary
+- reads (`Select`, `Join`, `Model.fetch*`) then go to a replica, chosen by `set_routing()`
+- writes, and every statement inside a `transaction()`, go to the primary (`get_pool()`)
+- to read your own writes, use `Select(..., primary=True)` or `with on_primary(): ...`
 """
 
 import os
-from psycopg2.pool import ThreadedConnectionPool
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+from time import perf_counter
+from psycopg2 import DatabaseError
+from psycopg2.extras import execute_batch
+from postgrespy.pool import ConnectionPool
+from postgrespy import instrumentation, UniqueViolatedError
 
 _pool = None
 
+# {name: pool} of the read replicas
+_replicas = OrderedDict()  # type: OrderedDict
+_routing = 'round_robin'
+_round_robin = count()
+# {id(conn): pool} of the connections taken from a replica
+_owners = {}  # type: dict
+
+# The innermost `transaction()` of the current thread, and whether reads
+# must go to the primary
+_local = threading.local()
+
 
-def get_pool(minconn=None, maxconn=None, database=None, user=None, password=None, host=None, port=None):
-    """ `db.py` assumes that you use only one Postgresql database server for your application.
-    If you need more than one, modifying this module is necessary.
+def settings(minconn=None, maxconn=None, database=None, user=None, password=None, host=None, port=None):
+    """Return the pool settings, taking the missing ones from the environment variables"""
+    if minconn is None:
+        minconn = os.environ['POSTGRES_POOL_MIN_CONN']
+    if maxconn is None:
+        maxconn = os.environ['POSTGRES_POOL_MAX_CONN']
+    if database is None:
+        database = os.environ['POSTGRES_USER']
+    if user is None:
+        user = os.environ['POSTGRES_USER']
+    if password is None:
+        password = os.environ['POSTGRES_PASSWORD']
+    if host is None:
+        host = os.environ['POSTGRES_HOST']
+    if port is None:
+        port = os.environ['POSTGRES_PORT']
+    return dict(minconn=minconn, maxconn=maxconn, database=database,
+                user=user, password=password, host=host, port=port)
+
+
+def get_pool(minconn=None, maxconn=None, database=None, user=None, password=None, host=None, port=None,
+             timeout=None, max_lifetime=None, idle_timeout=None):
+    """ Return the pool of the primary Postgresql database server.
+    Read replicas can be added with `add_replica()`.
 
     !IMPORTANT: if this function is never called, _pool is None, so others may not work.
     My intent is to force users call this function explicitly.
+
+    The pool is created once per process: after a fork (e.g. gunicorn workers),
+    each child process gets its own connections, see postgrespy/pool.py
     """
     global _pool
     if _pool is None:
-        """
-        TODO: need to check in production: if the app run inside something like
-        gunicorn, how many instance of _pool is created?
-        With these numbers, and by researching the pool size effect on Postgresql
-        performance, optimal pool size can be found out.
-        """
-        print("New pool is created. Should it be created often?")
-        if minconn is None:
-            minconn = os.environ['POSTGRES_POOL_MIN_CONN']
-        if maxconn is None:
-            maxconn = os.environ['POSTGRES_POOL_MAX_CONN']
-        if database is None:
-            database = os.environ['POSTGRES_USER']
-        if user is None:
-            user = os.environ['POSTGRES_USER']
-        if password is None:
-            password = os.environ['POSTGRES_PASSWORD']
-        if host is None:
-            host = os.environ['POSTGRES_HOST']
-        if port is None:
-            port = os.environ['POSTGRES_PORT']
-        _pool = ThreadedConnectionPool(minconn=minconn, maxconn=maxconn, database=database,
-                                       user=user, password=password,
-                                       host=host, port=port
-                                       )
+        instrumentation.logger.info('New pool is created. Should it be created often?')
+        if timeout is None:
+            timeout = os.environ.get('POSTGRES_POOL_TIMEOUT', 30)
+        if max_lifetime is None:
+            max_lifetime = os.environ.get('POSTGRES_POOL_MAX_LIFETIME', 3600)
+        if idle_timeout is None:
+            idle_timeout = os.environ.get('POSTGRES_POOL_IDLE_TIMEOUT', 600)
+        _pool = ConnectionPool(timeout=timeout, max_lifetime=max_lifetime,
+                               idle_timeout=idle_timeout,
+                               **settings(minconn, maxconn, database, user,
+                                          password, host, port))
     return _pool
 
 
-def get_conn_cur():
-    pool = get_pool()
-    conn = pool.getconn()
+def add_replica(name, minconn=None, maxconn=None, database=None, user=None, password=None,
+                host=None, port=None, **kwargs):
+    """ Register a read replica. Settings which are not given are taken from the
+    environment variables, like the primary ones.
+    :param: kwargs: other arguments of postgrespy.pool.ConnectionPool, e.g. `timeout`"""
+    _replicas[name] = ConnectionPool(**kwargs, **settings(minconn, maxconn, database, user,
+                                                          password, host, port))
+    return _replicas[name]
+
+
+def remove_replica(name):
+    pool = _replicas.pop(name)
+    pool.closeall()
+
+
+def set_routing(routing):
+    """ Choose how reads are spread over the replicas:
+    - 'round_robin': each one in turn
+    - 'least_busy': the one with the fewest connections in use"""
+    global _routing
+    if routing not in ('round_robin', 'least_busy'):
+        raise ValueError('Unknown routing: ' + str(routing))
+    _routing = routing
+
+
+def get_replica_pool():
+    """Return the pool the next read goes to, the primary one if there is no replica"""
+    pools = list(_replicas.values())
+    if not pools:
+        return get_pool()
+    if _routing == 'least_busy':
+        return min(pools, key=lambda pool: pool.stats()['in_use'])
+    return pools[next(_round_robin) % len(pools)]
+
+
+@contextmanager
+def on_primary():
+    """Send the reads of the `with` block to the primary, e.g. to read your own writes"""
+    previous = getattr(_local, 'primary', False)
+    _local.primary = True
+    try:
+        yield
+    finally:
+        _local.primary = previous
+
+
+def get_conn_cur(read_only=False):
+    """ Return a connection and a cursor.
+    If `read_only`, the connection may come from a read replica."""
+    tx = current_transaction()
+    if tx is not None:
+        tx.root().flush()
+        return tx.conn, tx.conn.cursor()
+    if read_only and _replicas and not getattr(_local, 'primary', False):
+        pool = get_replica_pool()
+        conn = _checkout(pool)
+        _owners[id(conn)] = pool
+        return conn, conn.cursor()
+    conn = _checkout(get_pool())
     cur = conn.cursor()
     return conn, cur
 
 
+def translate(e):
+    """ Return the exception to raise for the psycopg2 DatabaseError `e`:
+    UniqueViolatedError for a unique violation, `e` itself otherwise"""
+    if e.pgcode == '23505':
+        """
+        23505: PostgreSQL error code: unique violation
+        https://www.postgresql.org/docs/9.6/static/errcodes-appendix.html
+        """
+        return UniqueViolatedError()
+    return e
+
+
+def _checkout(pool):
+    """Take a connection from `pool`, recording the wait if statements are instrumented"""
+    if not instrumentation.listening():
+        return pool.getconn()
+    start = perf_counter()
+    conn = pool.getconn()
+    instrumentation.checked_out(conn, perf_counter() - start)
+    return conn
+
+
+def _in_transaction(conn):
+    tx = current_transaction()
+    return tx is not None and tx.conn is conn
+
+
+def commit(conn):
+    """Commit, unless `conn` belongs to a transaction, which is committed at its end"""
+    if not _in_transaction(conn):
+        conn.commit()
+
+
+def rollback(conn):
+    """Rollback, unless `conn` belongs to a transaction, which is rolled back by the
+    exception leaving its block"""
+    if not _in_transaction(conn):
+        conn.rollback()
+
+
 def close(conn, cur):
     cur.close()
-    pool = get_pool()
-    pool.putconn(conn)
+    if not _in_transaction(conn):
+        pool = _owners.pop(id(conn), None) or get_pool()
+        pool.putconn(conn)
+
+
+class Transaction:
+    """ Context manager returned by `transaction()`"""
+
+    def __init__(self, batch_writes=False):
+        self.batch_writes = batch_writes
+        self.conn = None
+        self.parent = None
+        self.savepoint = None
+        # Deferred writes: list of [stmt, [values, ...]], in execution order
+        self._pending = []
+        # Functions called after the commit
+        self._on_commit = []
+
+    def __enter__(self):
+        self.parent = getattr(_local, 'transaction', None)
+        if self.parent is None:
+            self.conn = _checkout(get_pool())
+        else:
+            root = self.parent.root()
+            root.flush()
+            self.conn = root.conn
+            self.savepoint = 'postgrespy_savepoint_' + str(self.depth())
+            with self.conn.cursor() as cur:
+                cur.execute('SAVEPOINT ' + self.savepoint)
+        _local.transaction = self
+        return self
+
+    def __exit__(self, type, value, tb):
+        _local.transaction = self.parent
+        if self.parent is not None:
+            with self.conn.cursor() as cur:
+                if type is None:
+                    try:
+                        # The queued writes can fail too: the block is rolled back then
+                        self.root().flush()
+                        cur.execute('RELEASE SAVEPOINT ' + self.savepoint)
+                    except BaseException as e:
+                        self._rollback_savepoint(cur)
+                        if isinstance(e, DatabaseError):
+                            raise translate(e)
+                        raise
+                else:
+                    self._rollback_savepoint(cur)
+            return
+
+        try:
+            if type is None:
+                self.flush()
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        except DatabaseError as e:
+            self.conn.rollback()
+            raise translate(e)
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            get_pool().putconn(self.conn)
+            self.conn = None
+            on_commit, self._on_commit = self._on_commit, []
+        if type is None:
+            for fn in on_commit:
+                fn()
+
+    def _rollback_savepoint(self, cur):
+        # Drop the writes queued in this block
+        self.root()._pending = []
+        cur.execute('ROLLBACK TO SAVEPOINT ' + self.savepoint)
+
+    def root(self):
+        return self if self.parent is None else self.parent.root()
+
+    def depth(self):
+        return 0 if self.parent is None else self.parent.depth() + 1
+
+    def on_commit(self, fn):
+        """Call `fn()` once the transaction is committed"""
+        self.root()._on_commit.append(fn)
+
+    def defer(self, stmt, values):
+        """Queue a write, if the transaction batches them. Return True if queued"""
+        root = self.root()
+        if not root.batch_writes:
+            return False
+        if root._pending and root._pending[-1][0] == stmt:
+            root._pending[-1][1].append(values)
+        else:
+            root._pending.append([stmt, [values]])
+        return True
+
+    def flush(self):
+        """Execute the queued writes. Consecutive writes with the same statement
+        are sent together, in as few round trips as possible"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        with self.conn.cursor() as cur:
+            for stmt, argslist in pending:
+                execute_batch(cur, stmt, argslist)
+
+
+def transaction(batch_writes=False):
+    """ Run every Model and Query call of a `with` block on one pooled connection,
+    committed once at the end of the block, or rolled back if it raises.
+    Nested blocks create savepoints: the exception of a nested block only rolls back
+    the statements of that block.
+    Inside a transaction, a failed statement aborts the transaction: to recover from,
+    e.g. a UniqueViolatedError, wrap the statement in a nested block.
+
+    :param: batch_writes: if True, `Model.update()` and `Model.delete()` are queued
+            and executed in batches when the transaction commits, or before the next
+            statement which is not queued.
+
+    Usage:
+        with transaction():
+            tom = Student.insert(name='Tom')
+            Car.insert(name='Toyota', owner_id=tom.id)
+    """
+    return Transaction(batch_writes)
+
+
+def current_transaction():
+    return getattr(_local, 'transaction', None)
+
+
+def defer(stmt, values):
+    """Queue a write in the current transaction, if it batches them. Return True if queued"""
+    tx = current_transaction()
+    return tx is not None and tx.defer(stmt, values)
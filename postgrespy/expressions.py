@@ -0,0 +1,210 @@
+"""
+Build WHERE clauses from Python expressions instead of SQL strings.
+Every model has a `c` attribute holding its columns:
+
+    Select(Student, (Student.c.age >= 18) & Student.c.name.in_(['Tom', 'Jerry']))
+    Student.fetchall(Student.c.is_male.is_null() | (Student.c.age < 10))
+    Product.fetchall(Product.c.detail.contains({'color': 'red'}))  # can use a GIN index
+
+Values are never written in the SQL text, they are sent as parameters.
+The SQL text is built once per expression shape (the same operators on the same columns,
+whatever the values) and kept in `statement_cache`.
+"""
+
+from postgrespy.cache import statement_cache
+
+# Value of the conditions which have none, e.g. IS NULL
+_NONE = object()
+
+
+class Expression:
+    """Base class of the boolean expressions"""
+
+    def __and__(self, other):
+        return BoolOp('AND', (self, other))
+
+    def __or__(self, other):
+        return BoolOp('OR', (self, other))
+
+    def __invert__(self):
+        return Not(self)
+
+    def compile(self):
+        """Return (sql, values), where sql has a %s placeholder for each value"""
+        values = []
+        self._values(values)
+        return statement_cache.get(('expression', self.shape()), self.sql), values
+
+    def shape(self):
+        """Hashable description of the expression, without its values"""
+        raise NotImplementedError
+
+    def sql(self):
+        raise NotImplementedError
+
+    def _values(self, values):
+        raise NotImplementedError
+
+
+class Condition(Expression):
+    """`template` with the column in place of {}, e.g. '{} = %s'"""
+    __slots__ = ('template', 'column', 'value')
+
+    def __init__(self, template, column, value=_NONE):
+        self.template = template
+        self.column = column
+        self.value = value
+
+    def shape(self):
+        return self.template, self.column.sql
+
+    def sql(self):
+        return self.template.format(self.column.sql)
+
+    def _values(self, values):
+        if self.value is not _NONE:
+            values.append(self.value)
+
+
+class BoolOp(Expression):
+    __slots__ = ('op', 'operands')
+
+    def __init__(self, op, operands):
+        self.op = op
+        # Flatten a & b & c
+        self.operands = tuple(o for operand in operands for o in (
+            operand.operands if isinstance(operand, BoolOp) and operand.op == op else (operand, )))
+
+    def shape(self):
+        return (self.op, ) + tuple(o.shape() for o in self.operands)
+
+    def sql(self):
+        return '(' + (' ' + self.op + ' ').join(o.sql() for o in self.operands) + ')'
+
+    def _values(self, values):
+        for operand in self.operands:
+            operand._values(values)
+
+
+class Not(Expression):
+    __slots__ = ('operand', )
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def shape(self):
+        return 'NOT', self.operand.shape()
+
+    def sql(self):
+        return 'NOT ' + self.operand.sql()
+
+    def _values(self, values):
+        self.operand._values(values)
+
+
+def and_(*expressions):
+    """`expressions` joined by AND, None if there is none"""
+    if not expressions:
+        return None
+    if len(expressions) == 1:
+        return expressions[0]
+    return BoolOp('AND', expressions)
+
+
+def or_(*expressions):
+    """`expressions` joined by OR, None if there is none"""
+    if not expressions:
+        return None
+    if len(expressions) == 1:
+        return expressions[0]
+    return BoolOp('OR', expressions)
+
+
+class Column:
+    """ A column of a model: `Model.c.name`.
+    Comparing it to a value, or to another column, gives a Condition"""
+    __slots__ = ('model_cls', 'name', 'sql')
+
+    def __init__(self, model_cls, name):
+        self.model_cls = model_cls
+        self.name = name
+        self.sql = model_cls.Meta.table + '.' + name
+
+    def _compare(self, op, value):
+        if isinstance(value, Column):
+            return Condition('{} ' + op + ' ' + value.sql, self)
+        return Condition('{} ' + op + ' %s', self, value)
+
+    def __eq__(self, value):  # type: ignore
+        if value is None:
+            return self.is_null()
+        return self._compare('=', value)
+
+    def __ne__(self, value):  # type: ignore
+        if value is None:
+            return self.is_not_null()
+        return self._compare('<>', value)
+
+    def __lt__(self, value):
+        return self._compare('<', value)
+
+    def __le__(self, value):
+        return self._compare('<=', value)
+
+    def __gt__(self, value):
+        return self._compare('>', value)
+
+    def __ge__(self, value):
+        return self._compare('>=', value)
+
+    # Columns are compared with ==, which builds a Condition, but they remain usable as keys
+    __hash__ = object.__hash__
+
+    def in_(self, values):
+        """`column = ANY(%s)`: one parameter, whatever the number of values"""
+        return Condition('{} = ANY(%s)', self, list(values))
+
+    def not_in(self, values):
+        return Condition('NOT ({} = ANY(%s))', self, list(values))
+
+    def is_null(self):
+        return Condition('{} IS NULL', self)
+
+    def is_not_null(self):
+        return Condition('{} IS NOT NULL', self)
+
+    def like(self, pattern):
+        return Condition('{} LIKE %s', self, pattern)
+
+    def ilike(self, pattern):
+        return Condition('{} ILIKE %s', self, pattern)
+
+    def contains(self, value):
+        """ `column @> %s`: the JSONB value (a dict, or a list) or the array contains `value`.
+        It can use a GIN index on the column.
+        https://www.postgresql.org/docs/current/static/datatype-json.html#JSON-CONTAINMENT"""
+        return Condition('{} @> %s', self, value)
+
+    def __repr__(self):
+        return 'Column(' + self.sql + ')'
+
+
+class Columns:
+    """The columns of a model, as attributes: `Model.c`"""
+
+    def __init__(self, model_cls):
+        self._model_cls = model_cls
+        self._columns = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        column = self._columns.get(name)
+        if column is None:
+            if name not in self._model_cls._schema.field_types:
+                raise AttributeError(self._model_cls.__name__ + ' has no column ' + name)
+            column = self._columns[name] = Column(self._model_cls, name)
+        return column
@@ -1,85 +1,122 @@
+import pickle
 from datetime import datetime
+from typing import Optional
 
 import psycopg2
 import psycopg2.extras
 
+
 class BaseField:
+    """ A column of a Model, declared as a class attribute: `name = TextField()`.
+    Fields only hold metadata, the objects keep the raw values of their columns
+    (str, int, dict, list, datetime...) in their __dict__, without wrapper.
+    - python_type: type of the values read from the database
+    - sql_type: type of the column in Postgres, None if it depends on the column
+    """
+    __slots__ = ('name', )
+    python_type = object  # type: type
+    sql_type = None  # type: Optional[str]
+
     def __init__(self):
-        pass
+        self.name = None
 
+    def __set_name__(self, owner, name):
+        self.name = name
 
-class TextField(BaseField, str):
-    def __init__(self, value: str = None) -> None:
-        super().__init__()
-        self.value = value
+    def __get__(self, obj, cls=None):
+        # Only reached when the object holds no value for the field: not given to the
+        # constructor, or left out of the query, see hydration.DeferredColumns
+        if obj is None:
+            return self
+        deferred = obj.__dict__.get('_deferred')
+        if deferred is not None and self.name in deferred.columns:
+            deferred.load()
+            return obj.__dict__.get(self.name)
+        return None
 
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, self.name)
 
-class EnumField(BaseField, str):
-    def __init__(self, value: str = None) -> None:
-        super().__init__()
-        self.value = value
 
+def snapshot(value):
+    """ Copy of a mutable value (dict, list) as read or written, to detect its changes
+    in place, see `Model.changes()`. `unsnapshot()` gives the value back"""
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
 
-class IntegerField(BaseField, int):
-    def __init__(self, value: int = None) -> None:
-        super().__init__()
-        self.value = value
 
+unsnapshot = pickle.loads
 
-class BooleanField(BaseField):
-    def __init__(self, value: bool= None) -> None:
-        super().__init__()
-        self.value = value
 
-    def __eq__(self, val: object):
-        return self.value is val
+class MutableField(BaseField):
+    """ Field whose values can be changed in place (JSONB, arrays).
+    It's a data descriptor: every read goes through it, and the first read of a value
+    takes its snapshot, in the `_snapshots` of the object. Objects which are only
+    hydrated, and values which are never read, have no snapshot."""
+    __slots__ = ()
 
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        d = obj.__dict__
+        if self.name not in d:
+            # Loads the column if it was deferred
+            super().__get__(obj, cls)
+        value = d.get(self.name)
+        # NULL values have no snapshot: they can only be changed by assignment
+        if value is not None:
+            snapshots = d.get('_snapshots')
+            if snapshots is None:
+                snapshots = d['_snapshots'] = {}
+            if self.name not in snapshots:
+                snapshots[self.name] = snapshot(value)
+        return value
 
-class JsonBField(BaseField, dict):
-    def __init__(self, value: object = None) -> None:
-        super().__init__()
-        self.value = value
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
 
-    def __getitem__(self, key):
-        return self.value[key]
 
-    def __setitem__(self, key, val):
-        self.value[key] = val
+class TextField(BaseField):
+    __slots__ = ()
+    python_type = str
+    sql_type = 'text'
 
 
-class ArrayField(BaseField, list):
-    def __init__(self, value: list = None) -> None:
-        super().__init__()
-        self.value = value
-        self._index = 0
+class EnumField(BaseField):
+    __slots__ = ()
+    python_type = str
 
-    def __len__(self):
-        return len(self.value)
 
-    def __getitem__(self, index):
-        return self.value[index]
+class IntegerField(BaseField):
+    __slots__ = ()
+    python_type = int
+    sql_type = 'integer'
 
-    def __iter__(self):
-        return self
 
-    def __next__(self):
-        if self._index >= len(self.value):
-            raise StopIteration
-        else:
-            self._index += 1
-            return self.value[self._index - 1]
+class BooleanField(BaseField):
+    __slots__ = ()
+    python_type = bool
+    sql_type = 'boolean'
 
 
-class DateTimeField(BaseField):
-    """ Translate the datetime.datetime class into timestamp field without timezone in postgresql."""
+class JsonBField(MutableField):
+    """ Values are dicts (or lists), written as Json by the adapter registered below"""
+    __slots__ = ()
+    python_type = dict
+    sql_type = 'jsonb'
 
-    def __init__(self, value: datetime = None) -> None:
-        super().__init__()
-        self.value = value
 
+class ArrayField(MutableField):
+    """ Values are lists. A list of dicts is written as jsonb[]"""
+    __slots__ = ()
+    python_type = list
 
-"""Adapt Python dict as Postgres Json"""
-psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
 
+class DateTimeField(BaseField):
+    """ Translate the datetime.datetime class into timestamp field without timezone in postgresql."""
+    __slots__ = ()
+    python_type = datetime
+    sql_type = 'timestamp'
 
 
+"""Adapt Python dict as Postgres Json"""
+psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
@@ -0,0 +1,117 @@
+"""
+Build model objects from the rows returned by psycopg2.
+For every Model class (and set of selected columns), a constructor is
+generated once, which fills the object's __dict__ straight from the row tuple
+instead of going through `Model.__init__` per column.
+"""
+
+import weakref
+from typing import Any
+
+
+def make_hydrator(model_cls, columns, offset=0):
+    """ Return a function `hydrate(row)` building a `model_cls` object
+    from row[offset:offset + len(columns)], which holds the values of `columns`"""
+    schema = model_cls._schema
+    namespace = {'new': object.__new__, 'cls': model_cls, 'fields': schema.fields}
+    lines = ['def hydrate(row):',
+             '    obj = new(cls)',
+             '    d = obj.__dict__',
+             "    d['id'] = None",
+             "    d['fields'] = fields"]
+    for i, name in enumerate(columns):
+        # Raw values, NULL as None: fields are descriptors, not wrappers
+        lines.append('    d[%r] = row[%d]' % (name, offset + i))
+    lines.append('    return obj')
+    exec('\n'.join(lines), namespace)
+    return namespace['hydrate']
+
+
+class CompactRow:
+    """ Base class of the compact representation of a model row.
+    Values are kept as plain Python objects in __slots__: there is no __dict__
+    and no `fields` set.
+    Use `to_model()` to get the full model object back.
+    """
+    __slots__ = ()
+    model_cls = None  # type: Any
+
+    def astuple(self):
+        return tuple(getattr(self, name, None) for name in self.__slots__)
+
+    def to_model(self):
+        return self.model_cls._schema.hydrator()(self.astuple())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.astuple() == other.astuple()
+
+    def __hash__(self):
+        return hash(self.astuple())
+
+    def __repr__(self):
+        return type(self).__name__ + '(' + ', '.join(
+            name + '=' + repr(getattr(self, name, None)) for name in self.__slots__) + ')'
+
+
+def make_compact_cls(model_cls, columns):
+    """Generate the CompactRow class of `model_cls`, with one slot per column"""
+    return type(model_cls.__name__ + 'Row', (CompactRow,),
+                {'__slots__': columns,
+                 'model_cls': model_cls,
+                 '__module__': model_cls.__module__})
+
+
+def make_compact_hydrator(model_cls, columns, offset=0):
+    """ Same as `make_hydrator`, but build the CompactRow of `model_cls`"""
+    namespace = {'new': object.__new__, 'cls': model_cls._schema.compact_cls}
+    lines = ['def hydrate(row):',
+             '    obj = new(cls)']
+    for i, name in enumerate(columns):
+        lines.append('    obj.%s = row[%d]' % (name, offset + i))
+    # Columns which are not selected
+    for name in namespace['cls'].__slots__:
+        if name not in columns:
+            lines.append('    obj.%s = None' % name)
+    lines.append('    return obj')
+    exec('\n'.join(lines), namespace)
+    return namespace['hydrate']
+
+
+class DeferredColumns:
+    """ Columns left out of a query by `Select(..., only=..., defer=...)`, shared by the
+    objects of its result set. The first access to one of these columns, on any of the
+    objects, loads them for all the objects still alive, in one query."""
+
+    def __init__(self, model_cls, columns):
+        self.model_cls = model_cls
+        self.columns = tuple(columns)
+        self._refs = []
+
+    def add(self, obj):
+        obj.__dict__['_deferred'] = self
+        self._refs.append(weakref.ref(obj))
+        return obj
+
+    def load(self):
+        # Imported here: queries imports this module
+        from postgrespy.queries import Select
+
+        objs = {}
+        for ref in self._refs:
+            obj = ref()
+            if obj is not None and obj.__dict__.get('_deferred') is self:
+                objs[obj.id] = obj
+        self._refs = []
+        for obj in objs.values():
+            del obj.__dict__['_deferred']
+        if not objs:
+            return
+
+        with Select(self.model_cls, 'id = ANY(%s)', only=self.columns) as select:
+            select.execute((list(objs), ))
+            for row in select.cur.fetchall():
+                d = objs[row[-1]].__dict__
+                for name, value in zip(self.columns, row):
+                    # Values set since the query are kept
+                    if name not in d:
+                        d[name] = value
@@ -0,0 +1,326 @@
+"""
+Instrumentation of the statements executed by models and queries.
+
+Every statement of `Model` and `Query` operations produces a `QueryEvent`, reported to
+the registered listeners: `before(event)` when the statement is sent, and `after(event)`
+once its result is consumed (for a query: when it's fetched entirely, executed again,
+or closed). The event holds the statement, its fingerprint, the number of parameters,
+the time spent waiting for a pooled connection, executing, fetching and hydrating, the
+number of rows and the error, if any.
+
+    from postgrespy.instrumentation import add_listener, SlowQueryLogger, Histogram
+    add_listener(SlowQueryLogger(threshold=0.5))
+    histogram = add_listener(Histogram())
+    ...
+    histogram.stats()  # {fingerprint: {'count': ..., 'sum': ..., 'max': ..., 'buckets': ...}}
+
+Without listener, statements are executed as they are, nothing is timed.
+"""
+
+import logging
+import random
+import re
+from bisect import bisect_left
+from collections import deque
+from functools import lru_cache
+from threading import Lock
+from time import perf_counter
+from weakref import WeakKeyDictionary
+
+from psycopg2.pool import PoolError
+
+from postgrespy.prepared import execute as _execute
+
+logger = logging.getLogger('postgrespy')
+
+_listeners = []  # type: list
+
+# {connection: seconds waited to check it out}, until its first statement
+_pool_waits = WeakKeyDictionary()  # type: WeakKeyDictionary
+
+_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_space_re = re.compile(r'\s+')
+
+
+class Listener:
+    """Base class of the listeners, override `before()` and/or `after()`"""
+
+    def before(self, event):
+        pass
+
+    def after(self, event):
+        pass
+
+
+def add_listener(listener):
+    """Report the events of every statement to `listener`. Return the listener"""
+    _listeners.append(listener)
+    return listener
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def listening():
+    """Whether a listener is registered, i.e. whether statements are timed"""
+    return bool(_listeners)
+
+
+def checked_out(conn, wait):
+    """Record that `conn` was taken from a pool after waiting `wait` seconds"""
+    _pool_waits[conn] = wait
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(stmt):
+    """ The statement without its literals and extra spaces, e.g.
+    'SELECT name FROM students WHERE age > %s LIMIT ?', to group the statements which only
+    differ by their values"""
+    return _space_re.sub(' ', _literal_re.sub('?', stmt)).strip()
+
+
+class QueryEvent:
+    """ A statement and its timings, in seconds"""
+    __slots__ = ('operation', 'model_cls', 'stmt', 'values', 'pool_wait', 'execute_time',
+                 'fetch_time', 'hydrate_time', 'rows', 'error', '_done')
+
+    def __init__(self, operation, model_cls, stmt, values, conn):
+        self.operation = operation
+        self.model_cls = model_cls
+        self.stmt = stmt
+        self.values = values
+        self.pool_wait = _pool_waits.pop(conn, 0.0)
+        self.execute_time = 0.0
+        self.fetch_time = 0.0
+        self.hydrate_time = 0.0
+        # Number of rows fetched, or written for the statements without result
+        self.rows = 0
+        self.error = None
+        self._done = False
+
+    @property
+    def fingerprint(self):
+        return fingerprint(self.stmt)
+
+    @property
+    def params(self):
+        return 0 if self.values is None else len(self.values)
+
+    @property
+    def total_time(self):
+        return self.pool_wait + self.execute_time + self.fetch_time + self.hydrate_time
+
+    def begin(self):
+        for listener in _listeners:
+            listener.before(self)
+
+    def end(self, error=None):
+        """Report the event to the `after()` of the listeners, once"""
+        if self._done:
+            return
+        self._done = True
+        if error is not None:
+            self.error = error
+        for listener in _listeners:
+            listener.after(self)
+
+    def __repr__(self):
+        return 'QueryEvent(%s, %.6fs, %d rows)' % (self.fingerprint, self.total_time, self.rows)
+
+
+def execute(cur, stmt, values=None, prepared=False, operation='execute', model_cls=None,
+            keep_open=False):
+    """ `prepared.execute()`, reported to the listeners.
+    Return the event, or None if there is no listener. Unless `keep_open`, the event ends
+    here, with the number of written rows, otherwise the caller records the fetched rows
+    and ends it."""
+    if not _listeners:
+        _execute(cur, stmt, values, prepared)
+        return None
+    event = QueryEvent(operation, model_cls, stmt, values, cur.connection)
+    event.begin()
+    start = perf_counter()
+    try:
+        _execute(cur, stmt, values, prepared)
+    except BaseException as e:
+        event.execute_time = perf_counter() - start
+        event.end(e)
+        raise
+    event.execute_time = perf_counter() - start
+    if not keep_open:
+        event.rows = max(cur.rowcount, 0)
+        event.end()
+    return event
+
+
+async def aexecute(conn, stmt, values=None, operation='execute', model_cls=None,
+                   keep_open=False):
+    """ `aio.execute()`, reported to the listeners, see `execute()`. Return (cursor, event)"""
+    from postgrespy import aio
+    if not _listeners:
+        return await aio.execute(conn, stmt, values), None
+    event = QueryEvent(operation, model_cls, stmt, values, conn)
+    event.begin()
+    start = perf_counter()
+    try:
+        cur = await aio.execute(conn, stmt, values)
+    except BaseException as e:
+        event.execute_time = perf_counter() - start
+        event.end(e)
+        raise
+    event.execute_time = perf_counter() - start
+    if not keep_open:
+        event.rows = max(cur.rowcount, 0)
+        event.end()
+    return cur, event
+
+
+def fetch(event, fetch_rows, hydrate=None):
+    """ Return the results of `fetch_rows()` (a list of rows) built by `hydrate(row)`,
+    recording the fetch and hydration times in `event`"""
+    start = perf_counter()
+    rows = fetch_rows()
+    fetched = perf_counter()
+    if hydrate is not None:
+        rows = [hydrate(row) for row in rows]
+    event.fetch_time += fetched - start
+    event.hydrate_time += perf_counter() - fetched
+    event.rows += len(rows)
+    return rows
+
+
+class SlowQueryLogger(Listener):
+    """ Log the statements which take more than `threshold` seconds, from the pool checkout
+    to the hydration of their results. Values are not logged, only their number."""
+
+    def __init__(self, threshold=0.5, logger=logger, level=logging.WARNING):
+        self.threshold = threshold
+        self.logger = logger
+        self.level = level
+
+    def after(self, event):
+        if event.total_time < self.threshold:
+            return
+        self.logger.log(
+            self.level,
+            'Slow %s of %s: %.3fs (pool wait %.3fs, execute %.3fs, fetch %.3fs, '
+            'hydrate %.3fs), %d rows, %d params: %s',
+            event.operation, getattr(event.model_cls, '__name__', None), event.total_time,
+            event.pool_wait, event.execute_time, event.fetch_time, event.hydrate_time,
+            event.rows, event.params, event.fingerprint)
+
+
+class Histogram(Listener):
+    """ In-memory histogram of the total time of the statements, per fingerprint
+    (or per `key(event)`), with counts of statements up to each bound of `buckets`"""
+
+    def __init__(self, buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0), key=None):
+        self.buckets = tuple(sorted(buckets))
+        self.key = key or (lambda event: event.fingerprint)
+        # {key: [count, sum, max, rows, errors, [count per bucket, then above the last]]}
+        self._data = {}
+        self._lock = Lock()
+
+    def after(self, event):
+        total = event.total_time
+        index = bisect_left(self.buckets, total)
+        key = self.key(event)
+        with self._lock:
+            data = self._data.get(key)
+            if data is None:
+                data = self._data[key] = [0, 0.0, 0.0, 0, 0, [0] * (len(self.buckets) + 1)]
+            data[0] += 1
+            data[1] += total
+            data[2] = max(data[2], total)
+            data[3] += event.rows
+            data[4] += event.error is not None
+            data[5][index] += 1
+
+    def stats(self):
+        """ {key: {'count', 'sum', 'max', 'rows', 'errors', 'buckets': {bound: count}}},
+        the count of a bound is the number of statements which took at most `bound`
+        seconds (cumulative), 'inf' counts them all"""
+        with self._lock:
+            items = [(key, list(data), list(data[5])) for key, data in self._data.items()]
+        stats = {}
+        for key, data, counts in items:
+            buckets = {}
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('inf', ), counts):
+                cumulative += count
+                buckets[bound] = cumulative
+            stats[key] = dict(count=data[0], sum=data[1], max=data[2], rows=data[3],
+                              errors=data[4], buckets=buckets)
+        return stats
+
+    def percentile(self, key, q):
+        """ Upper bound of the bucket holding the `q` (0 to 1) percentile of `key`,
+        None if there is no statement, 'inf' if it's above the last bound"""
+        with self._lock:
+            data = self._data.get(key)
+            counts = None if data is None else list(data[5])
+        if not counts:
+            return None
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('inf', ), counts):
+            cumulative += count
+            if cumulative >= rank and cumulative:
+                return bound
+        return 'inf'
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ExplainSampler(Listener):
+    """ Run `EXPLAIN (ANALYZE, BUFFERS)` on a sample (`rate`, from 0 to 1) of the SELECT
+    statements which took more than `threshold` seconds, on a connection of the primary
+    pool, and log their plan. The last `keep` plans are in `plans`, as (event, plan).
+    The statement runs again: other statements are never explained, and the sampler
+    is meant for a small rate. Statements are not explained when no connection is free,
+    and the failures are logged, the sampled query never waits for nor fails because of
+    the sampler."""
+
+    def __init__(self, threshold=1.0, rate=0.01, keep=100, logger=logger, level=logging.INFO):
+        self.threshold = threshold
+        self.rate = rate
+        self.logger = logger
+        self.level = level
+        self.plans = deque(maxlen=keep)
+
+    def after(self, event):
+        if event.error is not None or event.total_time < self.threshold or \
+                not event.stmt.lstrip()[:6].upper() == 'SELECT' or random.random() >= self.rate:
+            return
+        from postgrespy.db import get_pool
+        # The query being sampled may still hold its connection: never wait for another one
+        try:
+            pool = get_pool()
+            conn = pool.getconn(timeout=0)
+        except PoolError:
+            self.logger.log(self.level, 'EXPLAIN skipped, no free connection: %s',
+                            event.fingerprint)
+            return
+        except Exception:
+            self.logger.exception('EXPLAIN failed: %s', event.fingerprint)
+            return
+        try:
+            with conn.cursor() as cur:
+                cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + event.stmt, event.values)
+                plan = '\n'.join(row[0] for row in cur.fetchall())
+            conn.rollback()
+        except Exception:
+            self.logger.exception('EXPLAIN failed: %s', event.fingerprint)
+            try:
+                conn.rollback()
+            except Exception:
+                pass  # A broken connection is replaced by the pool on checkout
+            return
+        finally:
+            pool.putconn(conn)
+        self.plans.append((event, plan))
+        self.logger.log(self.level, 'Plan of %s (%.3fs):\n%s',
+                        event.fingerprint, event.total_time, plan)
@@ -0,0 +1,143 @@
+"""
+Batch loading by id, to avoid one query per object (the N+1 queries problem).
+
+- `Model.fetch_by_ids(ids)` fetches many objects in one query.
+- a `Loader` collects the ids requested with `load(id)`, and fetches them all in one
+  query the first time one of them is needed:
+      loader = Loader(Student)
+      owners = [loader.load(car.owner_id) for car in cars]
+      owners = [owner.get() for owner in owners]  # a single query
+  `await loader.aload(id)` batches the ids requested in the same event loop iteration,
+  e.g. from the coroutines of one `asyncio.gather()`.
+- `prefetch()` and `prefetch_one()` load the related objects of many objects in one query.
+"""
+
+import asyncio
+from collections import OrderedDict
+
+from postgrespy.queries import Select
+
+
+class Deferred:
+    """An object requested from a Loader, `get()` returns it"""
+    __slots__ = ('loader', 'id')
+
+    def __init__(self, loader, id):
+        self.loader = loader
+        self.id = id
+
+    def get(self):
+        """Return the object, or None if it doesn't exist"""
+        return self.loader._get(self.id)
+
+
+class Loader:
+    """ Batch the lookups by id of `model_cls`, see the module docstring.
+    Loaded objects are kept for the lifetime of the loader, so use one loader per scope
+    (e.g. per web request), and don't share it between threads."""
+
+    def __init__(self, model_cls):
+        self.model_cls = model_cls
+        # {id: object}, None for the ids which don't exist
+        self._loaded = {}
+        # Ids to fetch on the next dispatch, as an ordered set
+        self._pending = OrderedDict()
+        # Future of the next asynchronous dispatch
+        self._future = None
+
+    def load(self, id):
+        """Request the object of `id`, return a Deferred"""
+        id = int(id)
+        if id not in self._loaded:
+            self._pending[id] = None
+        return Deferred(self, id)
+
+    def load_many(self, ids):
+        """Return the objects of `ids` (None for the ids which don't exist), in one query"""
+        deferreds = [self.load(id) for id in ids]
+        return [deferred.get() for deferred in deferreds]
+
+    def prime(self, obj):
+        """Add an object fetched by other means"""
+        self._loaded[int(obj.id)] = obj
+
+    def clear(self):
+        self._loaded.clear()
+
+    def dispatch(self):
+        """Fetch the pending ids in one query"""
+        if not self._pending:
+            return
+        ids = list(self._pending)
+        self._pending.clear()
+        self._store(ids, self.model_cls.fetch_by_ids(ids))
+
+    def _store(self, ids, objs):
+        by_id = {obj.id: obj for obj in objs}
+        for id in ids:
+            self._loaded[id] = by_id.get(id)
+
+    def _get(self, id):
+        if id not in self._loaded:
+            self._pending[id] = None
+            self.dispatch()
+        return self._loaded[id]
+
+    async def aload(self, id):
+        """ Asynchronous version of `load(id).get()`: the ids requested before the event
+        loop runs the dispatch are fetched in one query"""
+        id = int(id)
+        if id in self._loaded:
+            return self._loaded[id]
+        self._pending[id] = None
+        if self._future is None:
+            loop = asyncio.get_event_loop()
+            self._future = loop.create_future()
+            loop.call_soon(lambda: asyncio.ensure_future(self._adispatch()))
+        # Shielded: a cancelled caller must not cancel the dispatch of the others
+        await asyncio.shield(self._future)
+        return self._loaded.get(id)
+
+    async def _adispatch(self):
+        future, self._future = self._future, None
+        ids = list(self._pending)
+        self._pending.clear()
+        try:
+            self._store(ids, await self.model_cls.afetch_by_ids(ids))
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
+
+def prefetch(objs, related_cls, fk, attr):
+    """ Load, in one query, the `related_cls` objects whose `fk` column references one of
+    `objs`, and set the list of the related objects of every object as its `attr`:
+        prefetch(students, Car, 'owner_id', 'cars')
+        students[0].cars  # [Car, ...]
+    Return {id: [related objects]}"""
+    groups = {int(obj.id): [] for obj in objs}
+    if groups:
+        with Select(related_cls, fk + ' = ANY(%s)') as select:
+            select.order_by('id')
+            select.execute((list(groups), ))
+            for related in select.fetchall():
+                groups[int(getattr(related, fk))].append(related)
+    for obj in objs:
+        setattr(obj, attr, groups[int(obj.id)])
+    return groups
+
+
+def prefetch_one(objs, related_cls, fk, attr):
+    """ The reverse of `prefetch()`: load, in one query, the `related_cls` objects which
+    the `fk` column of `objs` references, and set each one as `attr` of its objects:
+        prefetch_one(cars, Student, 'owner_id', 'owner')
+        cars[0].owner  # Student or None
+    Return {id: related object}"""
+    # Deferred foreign keys are loaded for all the objects, in one query
+    keys = [getattr(obj, fk) for obj in objs]
+    related = {obj.id: obj for obj in related_cls.fetch_by_ids(
+        OrderedDict.fromkeys(key for key in keys if key is not None))}
+    for obj, key in zip(objs, keys):
+        setattr(obj, attr, related.get(key))
+    return related
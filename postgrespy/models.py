@@ -1,13 +1,178 @@
-from postgrespy.db import get_conn_cur, close
-from postgrespy import UniqueViolatedError
-from postgrespy.fields import BaseField, JsonBField, IntegerField
-from postgrespy.queries import Select
-from jinja2 import Template
+from postgrespy.db import get_conn_cur, close, commit, rollback, defer, current_transaction, \
+    transaction, translate as _translate
+from postgrespy.fields import BaseField, IntegerField, MutableField, snapshot, unsnapshot
+from postgrespy.queries import Select, Aggregate
+from postgrespy.expressions import Columns, Expression, and_
+from postgrespy.copy import copy_from, copy_file_from, copy_to, binary_encoder
+from postgrespy.cache import statement_cache
+from postgrespy.prepared import is_prepared
+from postgrespy.instrumentation import execute, aexecute
+from postgrespy.hydration import make_hydrator, make_compact_hydrator, make_compact_cls
+from postgrespy import aio
 from psycopg2 import DatabaseError
-import json
+from collections import OrderedDict
+from operator import itemgetter
+from types import MappingProxyType
+from typing import Any, Optional
+import itertools
 import warnings
 
 
+def _placeholder(value):
+    """Placeholder for one value of an INSERT/UPDATE statement"""
+    # check if value is list of dict
+    # if so, treat it as an array of json
+    if type(value) is list and len(value) > 0 and type(value[0]) is dict:
+        # https://github.com/psycopg/psycopg2/issues/585
+        #https://stackoverflow.com/questions/31641894/convert-python-list-of-dicts-into-postgresql-array-of-json
+        return '%s::jsonb[]'
+    return '%s'
+
+
+def _translate_insert(e):
+    """`_translate()` of `insert()`, which raises NotImplementedError for the other errors"""
+    ret = _translate(e)
+    if ret is e:
+        return NotImplementedError('Unhandled error. Need to check.')
+    return ret
+
+
+def _insert_stmt(table, columns, placeholders, on_conflict=''):
+    return 'INSERT INTO ' + table + \
+        ' ( ' + ','.join(columns) + ' )' + \
+        ' VALUES ( ' + ','.join(placeholders) + ' )' + \
+        on_conflict + \
+        ' RETURNING id'
+
+
+def _on_conflict(conflict_columns, update_columns):
+    """ON CONFLICT clause of an upsert"""
+    target = ' (' + ','.join(conflict_columns) + ')' if conflict_columns else ''
+    if not update_columns:
+        return ' ON CONFLICT' + target + ' DO NOTHING'
+    if not conflict_columns:
+        raise ValueError('conflict_columns are required to update the conflicting rows')
+    return ' ON CONFLICT' + target + ' DO UPDATE SET ' + \
+        ','.join(c + ' = EXCLUDED.' + c for c in update_columns)
+
+
+def _update_stmt(table, columns, placeholders):
+    return 'UPDATE ' + table + \
+        ' SET ' + ','.join(c + ' = ' + p for c, p in zip(columns, placeholders)) + \
+        ' WHERE id = %s'
+
+
+# Value of the columns which were not set, see Model.changes()
+_MISSING = object()
+
+# Tell the other processes to evict a row from their cache, see cache.RowCache
+_NOTIFY = 'SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload'
+
+
+def _where(model_cls, where, kwargs):
+    """ The expression matching `where` (an expression or None) and every key=value
+    of `kwargs`, None if there is no condition"""
+    conditions = [model_cls.c[k] == v for k, v in kwargs.items()]
+    if where is not None:
+        conditions.insert(0, where)
+    return and_(*conditions)
+
+
+def _update_columns(kwargs, conflict_columns, update_columns):
+    """Columns an upsert of `kwargs` updates on conflict, as a tuple"""
+    if update_columns is None:
+        return tuple(c for c in kwargs.keys() if c not in conflict_columns)
+    return tuple(update_columns)
+
+
+def _upsert_many_stmt(table, columns, types, count, conflict_columns, update_columns,
+                      nulls=False):
+    """ Statement of a batch of `upsert_many()`: its rows, with their positions, are
+    merged by the database, which gives the upserted ids back by position, matched on
+    the conflict values as they are stored.
+    :param: types: {column: SQL type}, the values are cast before being compared
+    :param: nulls: if True, NULL conflict values are matched too, without a hash join"""
+    row_placeholder = '(%s,' + ','.join('%s::' + types[c] for c in columns) + ')'
+    match = ' IS NOT DISTINCT FROM ' if nulls else ' = '
+    return 'WITH v (i_,' + ','.join(columns) + ') AS (VALUES ' + \
+        ','.join([row_placeholder] * count) + '),' + \
+        ' upserted AS (INSERT INTO ' + table + ' (' + ','.join(columns) + ')' + \
+        ' SELECT DISTINCT ON (' + ','.join(conflict_columns) + ') ' + ','.join(columns) + \
+        ' FROM v ORDER BY ' + ','.join(conflict_columns) + ', i_ DESC' + \
+        _on_conflict(conflict_columns, update_columns) + \
+        ' RETURNING id AS id_,' + ','.join(conflict_columns) + ')' + \
+        ' SELECT v.i_, upserted.id_ FROM v JOIN upserted ON ' + \
+        ' AND '.join('v.' + c + match + 'upserted.' + c for c in conflict_columns)
+
+
+def _upserted(cls, id, kwargs):
+    """The object of an upserted row, `kwargs` may hold its id too"""
+    obj = cls(**kwargs)
+    obj.id = id
+    return obj._synced()
+
+
+def _batches(rows, batch_size):
+    """Split `rows` (list of dicts) into batches of at most `batch_size` rows
+    sharing the same columns. Yield (columns, batch)"""
+    columns = None
+    batch = []
+    for row in rows:
+        row_columns = tuple(row.keys())
+        if batch and (row_columns != columns or len(batch) >= batch_size):
+            yield columns, batch
+            batch = []
+        columns = row_columns
+        batch.append(row)
+    if batch:
+        yield columns, batch
+
+
+class Schema:
+    """ Field metadata of a Model class, computed once when the class is defined.
+    - columns: the field names, in declaration order, `id` excluded
+    - select_columns: `columns` + ('id',), the order of the columns selected by queries
+    - field_types: {name: field class}, `id` included
+    - index: {name: position in `select_columns`}
+    - fields: frozenset of `columns`
+    - mutable: frozenset of the columns whose values can change in place (JSONB, arrays)
+    - compact_cls: the __slots__ based representation of a row, see postgrespy/hydration.py
+    - sql_types: {column: SQL type} of the table, read from the catalog on first use
+    - copy_types: the types of the table for the binary COPY, likewise, see `Model.copy_from()`
+    """
+
+    def __init__(self, model_cls):
+        self.model_cls = model_cls
+        field_types = OrderedDict()
+        for klass in reversed(model_cls.__mro__):
+            for name, value in vars(klass).items():
+                if not name.startswith('__') and isinstance(value, BaseField):
+                    field_types[name] = type(value)
+        self.columns = tuple(field_types.keys())
+        self.select_columns = self.columns + ('id',)
+        field_types['id'] = IntegerField
+        self.field_types = MappingProxyType(field_types)
+        self.index = MappingProxyType(
+            {name: i for i, name in enumerate(self.select_columns)})
+        self.fields = frozenset(self.columns)
+        self.mutable = frozenset(name for name in self.columns
+                                 if issubclass(field_types[name], MutableField))
+        self.compact_cls = make_compact_cls(model_cls, self.select_columns)
+        self._hydrators = {}
+        self.sql_types = None
+        self.copy_types = None
+
+    def hydrator(self, columns=None, offset=0, compact=False):
+        """ Return the function building a model object (a CompactRow if `compact`)
+        from a row holding the values of `columns` (default: `select_columns`),
+        starting at `offset`"""
+        key = (self.select_columns if columns is None else tuple(columns), offset, compact)
+        hydrate = self._hydrators.get(key)
+        if hydrate is None:
+            make = make_compact_hydrator if compact else make_hydrator
+            hydrate = self._hydrators[key] = make(self.model_cls, key[0], offset)
+        return hydrate
+
 
 class Model(object):
     """
@@ -16,38 +181,121 @@ class Model(object):
     IMPORTANT!: Every child has a implicit `id` row.
     """
 
+    _schema = None  # type: Optional[Schema]
+    # The columns, for expressions: `Student.c.age > 18`, see postgrespy/expressions.py
+    c = None  # type: Any
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._schema = Schema(cls)
+        cls.c = Columns(cls)
+
     def __init__(self, id=None, **kwargs):
         self.id = id
         for k in kwargs.keys():
             setattr(self, k, kwargs[k])
 
-        self.fields = set()
-        for k in dir(self):
-            if issubclass(type(getattr(self, k)), BaseField):
-                self.fields.add(k)
+        self.fields = self._schema.fields
 
     def __setattr__(self, name, value):
-        if name in dir(self):
-            if value is not None:
-                field_cls = type(getattr(self, name))
-                if name == 'id':
-                    field_cls = IntegerField
-                super().__setattr__(name, field_cls(value))
-        else:
-            super().__setattr__(name, value)
+        if name in self._schema.fields:
+            # Keep the value as loaded or written, to find the changed columns
+            d = self.__dict__
+            original = d.get('_original')
+            if original is None:
+                original = d['_original'] = {}
+            if name not in original:
+                original[name] = d.get(name, _MISSING)
+        super().__setattr__(name, value)
+
+    def changes(self):
+        """ {column: value} of the columns changed since the object was loaded or written:
+        set to another value, or, for JSONB and array columns, modified in place after
+        being read (see fields.MutableField)"""
+        d = self.__dict__
+        original = d.get('_original') or {}
+        snapshots = d.get('_snapshots') or {}
+        ret = OrderedDict()
+        for name in self._schema.columns:
+            if name in original:
+                value = d.get(name, _MISSING)
+                if value is not original[name] and value != original[name]:
+                    ret[name] = value
+                    continue
+            # JSONB and array values, compared to their value when they were first read
+            if name in snapshots and d.get(name) != unsnapshot(snapshots[name]):
+                ret[name] = d.get(name)
+        return ret
+
+    def _synced(self, columns=None):
+        """ Record that the values of `columns` (default: every column set) are the ones
+        of the database. Return the object"""
+        d = self.__dict__
+        if columns is None:
+            columns = [name for name in self._schema.columns if name in d]
+        original = d.get('_original')
+        if original:
+            for name in columns:
+                original.pop(name, None)
+        for name in columns:
+            if name in self._schema.mutable and name in d:
+                d.setdefault('_snapshots', {})[name] = snapshot(d[name])
+        return self
 
     def save(self):
-        """Insert if id is None.
-        Update if otherwise
-        IMPORTANT: this is a 'dumb' method. You need to check for
-        any constraint or handle exception before/after calling me.
-        and DON't add new attributes after an object is created.
-        """
-        warnings.warn("DEPRECATED from September 2017. Use update(self, **kwargs) instead", DeprecationWarning)
+        """ Insert the object if its id is None, with the columns which are set.
+        Otherwise, update only its changed columns (see `changes()`), nothing if there is none.
+        IMPORTANT: You need to check for any constraint or handle exception
+        before/after calling me.
+        :return: the names of the written columns"""
+        d = self.__dict__
         if self.id is None:
-            self._insert()
-        else:
-            self._update()
+            values = OrderedDict(
+                (name, d[name]) for name in self._schema.columns if name in d)
+            self.id = type(self).insert(**values).id
+            self._synced(values)
+            return tuple(values)
+        changes = self.changes()
+        if changes:
+            self.update(**changes)
+        return tuple(changes)
+
+    @classmethod
+    def save_all(cls, objs, batch_size=1000):
+        """ `save()` many objects in a single transaction.
+        The objects without id are inserted by `insert_many()`, the changes of the others
+        are sent by `update_many()`: one `UPDATE ... FROM (VALUES ...)` statement per set
+        of changed columns (and per `batch_size` objects), objects without change are skipped.
+        :param: objs: iterable of objects of the model
+        :return: the number of written objects"""
+        # {columns: [(obj, {column: value})]}
+        new_groups = OrderedDict()
+        changed_groups = OrderedDict()
+        for obj in objs:
+            if obj.id is None:
+                d = obj.__dict__
+                values = OrderedDict(
+                    (name, d[name]) for name in cls._schema.columns if name in d)
+                new_groups.setdefault(tuple(values), []).append((obj, values))
+                continue
+            changes = obj.changes()
+            if changes:
+                changed_groups.setdefault(tuple(changes), []).append((obj, changes))
+        inserts = [item for group in new_groups.values() for item in group]
+        updates = [item for group in changed_groups.values() for item in group]
+        if not (inserts or updates):
+            return 0
+
+        with transaction():
+            if inserts:
+                inserted = cls.insert_many([values for _, values in inserts], batch_size)
+                for (obj, values), new in zip(inserts, inserted):
+                    obj.id = new.id
+            if updates:
+                cls.update_many([(obj.id, changes) for obj, changes in updates], batch_size)
+        for obj, values in inserts + updates:
+            obj._synced(values)
+        return len(inserts) + len(updates)
 
     @classmethod
     def insert(cls, **kwargs):
@@ -56,86 +304,447 @@ class Model(object):
                 key is one field of the table,
                 value must be a Python builtin type, not my custom types defined in fields.py: int, string, datetime, dict, etc."""
         conn, cur = get_conn_cur()
-
-        template = Template('INSERT INTO {{table}}\n'
-                            '( {{columns}} )\n'
-                            'VALUES ( {{placeholders}} )\n'
-                            'RETURNING id')
-
-        """Prepare placeholders"""
-        temp_arr = []
-        for k,v in kwargs.items():
-            # check if value is list of dict
-            # if so, treat it as an array of json
-            if type(v) is list and len(v) > 0 and type(v[0]) is dict:
-                # https://github.com/psycopg/psycopg2/issues/585
-                #https://stackoverflow.com/questions/31641894/convert-python-list-of-dicts-into-postgresql-array-of-json
-                temp_arr.append('%s::jsonb[]')
-            else: 
-                temp_arr.append('%s')
-        placeholders = ','.join(temp_arr)
-        
-        """Render and execute the statement"""
-        stmt = template.render(table=cls.Meta.table,
-                               columns=','.join(kwargs.keys()),
-                               placeholders=placeholders
-                               )
+        stmt = cls._insert_sql(kwargs)
         ret = None
 
         try:
             values = tuple(val for val in kwargs.values())
-            cur.execute(stmt, values)
+            execute(cur, stmt, values, is_prepared(cls), 'insert', cls)
             id = cur.fetchone()[0]
-            conn.commit()
-            ret = cls(id, **kwargs)
+            commit(conn)
+            ret = cls(id, **kwargs)._synced()
+        except DatabaseError as e:
+            rollback(conn)
+            close(conn, cur)
+            raise _translate_insert(e)
+
+        close(conn, cur)
+        return ret
+
+    @classmethod
+    def _insert_sql(cls, kwargs):
+        """Get the statement from the cache, build it on the first call with this signature"""
+        columns = tuple(kwargs.keys())
+        placeholders = tuple(_placeholder(v) for v in kwargs.values())
+        return statement_cache.get(
+            (cls, 'insert', columns, placeholders),
+            lambda: _insert_stmt(cls.Meta.table, columns, placeholders))
+
+    @classmethod
+    def insert_many(cls, rows, batch_size=1000, returning=True):
+        """ Insert many rows in a single transaction
+        :param: rows: iterable of dicts, each one is the kwargs you would pass to `insert`
+        :param: batch_size: maximum number of rows sent in one statement
+        :param: returning: if True, send multi-row `INSERT ... VALUES ... RETURNING id` batches
+                so that the returned objects have their ids.
+                Otherwise, stream the rows with `COPY FROM STDIN`, which is faster
+                but the returned objects have no id.
+        :return: list of model objects, in the same order as `rows`"""
+        rows = list(rows)
+        ret = []
+        conn, cur = get_conn_cur()
+        try:
+            for columns, batch in _batches(rows, batch_size):
+                if returning:
+                    row_placeholders = []
+                    values = []
+                    for row in batch:
+                        row_placeholders.append(
+                            '(' + ','.join(_placeholder(v) for v in row.values()) + ')')
+                        values.extend(row.values())
+                    row_placeholders = tuple(row_placeholders)
+                    stmt = statement_cache.get(
+                        (cls, 'insert_many', columns, row_placeholders),
+                        lambda: 'INSERT INTO ' + cls.Meta.table +
+                        ' ( ' + ','.join(columns) + ' )' +
+                        ' VALUES ' + ','.join(row_placeholders) +
+                        ' RETURNING id')
+                    execute(cur, stmt, values, False, 'insert_many', cls)
+                    # Rows of a multi-row VALUES are returned in their input order
+                    ids = [r[0] for r in cur.fetchall()]
+                else:
+                    copy_from(cur, cls.Meta.table, columns,
+                              (tuple(row.values()) for row in batch))
+                    ids = [None] * len(batch)
+                ret.extend(cls(id, **row)._synced() for id, row in zip(ids, batch))
+            commit(conn)
         except DatabaseError as e:
-            conn.rollback()
-            if e.pgcode == '23505':
-                """
-                23505: PostgreSQL error code: unique violation
-                https://www.postgresql.org/docs/9.6/static/errcodes-appendix.html
-                """
-                raise UniqueViolatedError()
+            rollback(conn)
+            close(conn, cur)
+            raise _translate(e)
+
+        close(conn, cur)
+        return ret
+
+    @classmethod
+    def copy_to(cls, fileobj, where=None, values=None, format='binary', columns=None, size=8192):
+        """ Export rows with `COPY ... TO STDOUT`, streamed to `fileobj` by chunks of `size`
+        :param: fileobj: file-like object with a `write()` method, binary for the binary format
+        :param: where: WHERE clause, SQL or expression (see postgrespy.expressions),
+                default: every row
+        :param: values: parameters of a SQL `where`
+        :param: format: 'binary', 'csv' (with a header line) or 'text'
+        :param: columns: exported columns, default: every column and the id
+        :return: number of exported rows"""
+        columns = tuple(columns or cls._schema.select_columns)
+        if isinstance(where, Expression):
+            where, values = where.compile()
+        conn, cur = get_conn_cur(read_only=True)
+        try:
+            if where is None:
+                source = cls.Meta.table + ' (' + ','.join(columns) + ')'
             else:
-                raise NotImplementedError(
-                    'Unhandled error. Need to check.')
+                source = '(' + cur.mogrify(
+                    'SELECT ' + ','.join(columns) + ' FROM ' + cls.Meta.table +
+                    ' WHERE ' + where, values).decode() + ')'
+            copy_to(cur, source, fileobj, format, size)
+            count = cur.rowcount
+            commit(conn)
+        except DatabaseError as e:
+            rollback(conn)
+            close(conn, cur)
+            raise _translate(e)
+        except BaseException:
+            # e.g. an unknown format, or an error of `fileobj`
+            rollback(conn)
+            close(conn, cur)
+            raise
 
         close(conn, cur)
+        return count
+
+    @classmethod
+    def copy_from(cls, source, columns=None, format='binary', size=8192):
+        """ Import rows with `COPY ... FROM STDIN` in a single transaction, streamed by
+        chunks of `size`.
+        :param: source: file-like object with a `read()` method, in `format`
+                (e.g. the output of `copy_to()`), or iterable of rows, dicts or tuples
+                in the order of `columns`, encoded on the fly in the binary format, or
+                in the text format if a column has no binary encoding (e.g. numeric)
+        :param: columns: imported columns, default: the keys of the first dict row,
+                otherwise every column and the id
+        :param: format: 'binary', 'csv' (with a header line) or 'text', for a file
+        :return: number of imported rows
+        Usage:
+            with open('students.copy', 'wb') as f:
+                Student.copy_to(f)
+            with open('students.copy', 'rb') as f:
+                Student.copy_from(f)"""
+        rows = None
+        if hasattr(source, 'read'):
+            columns = tuple(columns or cls._schema.select_columns)
+        else:
+            rows = iter(source)
+            first = next(rows, None)
+            if first is None:
+                return 0
+            if isinstance(first, dict):
+                columns = tuple(columns or first)
+                rows = (tuple(row.get(c) for c in columns)
+                        for row in itertools.chain((first, ), rows))
+            else:
+                columns = tuple(columns or cls._schema.select_columns)
+                rows = itertools.chain((first, ), rows)
+
+        conn, cur = get_conn_cur()
+        try:
+            if rows is None:
+                copy_file_from(cur, cls.Meta.table, columns, source, format, size)
+            else:
+                copy_from(cur, cls.Meta.table, columns, rows, size,
+                          cls._copy_encoders(cur, columns))
+            count = cur.rowcount
+            if 'id' in columns:
+                # Explicit ids don't advance the sequence
+                cur.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'),"
+                            ' (SELECT max(id) FROM ' + cls.Meta.table + '))',
+                            (cls.Meta.table, ))
+            commit(conn)
+        except DatabaseError as e:
+            rollback(conn)
+            close(conn, cur)
+            raise _translate(e)
+        except BaseException:
+            # e.g. a value which can't be encoded, or an error of `source`
+            rollback(conn)
+            close(conn, cur)
+            raise
+
+        close(conn, cur)
+        return count
+
+    @classmethod
+    def _copy_types(cls, cur):
+        """ {column: (type name, element type name, element type oid)} of the table,
+        the element ones are None but for arrays. Read from the catalog once per model"""
+        schema = cls._schema
+        if schema.copy_types is None:
+            # Enums are sent like text, their labels
+            cur.execute("SELECT a.attname, CASE t.typtype WHEN 'e' THEN 'text' ELSE t.typname END,"
+                        " CASE e.typtype WHEN 'e' THEN 'text' ELSE e.typname END, e.oid"
+                        ' FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid'
+                        " LEFT JOIN pg_type e ON e.oid = t.typelem AND t.typcategory = 'A'"
+                        ' WHERE a.attrelid = %s::regclass AND a.attnum > 0'
+                        ' AND NOT a.attisdropped', (cls.Meta.table, ))
+            schema.copy_types = {row[0]: row[1:] for row in cur.fetchall()}
+        return schema.copy_types
+
+    @classmethod
+    def _copy_encoders(cls, cur, columns):
+        """ Binary encoders of `columns`, None if one of them has no binary encoding:
+        the rows are then sent in the text format"""
+        types = cls._copy_types(cur)
+        unknown = [c for c in columns if c not in types]
+        if unknown:
+            raise ValueError('Unknown columns of ' + cls.Meta.table + ': ' + ', '.join(unknown))
+        try:
+            return [binary_encoder(*types[c]) for c in columns]
+        except ValueError:
+            return None
+
+    @classmethod
+    def upsert(cls, conflict_columns=(), update_columns=None, **kwargs):
+        """ Insert a row, or update the existing row it conflicts with, in one statement
+        (`INSERT ... ON CONFLICT ... RETURNING id`)
+        :param: conflict_columns: columns of the unique index which detects the conflict
+        :param: update_columns: columns updated on conflict, default: every column of `kwargs`
+                which is not in `conflict_columns`. If empty, the existing row is left
+                as it is (`DO NOTHING`)
+        :param: kwargs: like `insert()`
+        :return: the object, or None if the row existed and was left as it is
+        Usage: Student.upsert(('name', ), name='Tom', age=20)"""
+        conflict_columns = tuple(conflict_columns)
+        update_columns = _update_columns(kwargs, conflict_columns, update_columns)
+        columns = tuple(kwargs.keys())
+        placeholders = tuple(_placeholder(v) for v in kwargs.values())
+        stmt = statement_cache.get(
+            (cls, 'upsert', columns, placeholders, conflict_columns, update_columns),
+            lambda: _insert_stmt(cls.Meta.table, columns, placeholders,
+                                 _on_conflict(conflict_columns, update_columns)))
+
+        conn, cur = get_conn_cur()
+        try:
+            execute(cur, stmt, tuple(kwargs.values()), is_prepared(cls), 'upsert', cls)
+            row = cur.fetchone()
+            if row is not None and update_columns:
+                notify = cls._evict(row)
+                if notify is not None:
+                    cur.execute(_NOTIFY, notify)
+            commit(conn)
+        except DatabaseError as e:
+            rollback(conn)
+            close(conn, cur)
+            raise _translate(e)
+
+        close(conn, cur)
+        if row is not None and update_columns:
+            cls._evict_committed(row)
+        return None if row is None else _upserted(cls, row[0], kwargs)
+
+    @classmethod
+    def upsert_many(cls, rows, conflict_columns, update_columns=None, batch_size=1000):
+        """ Bulk version of `upsert()`, in a single transaction: consecutive rows with the
+        same columns are sent as one multi-row `INSERT ... ON CONFLICT` statement of
+        at most `batch_size` rows.
+        Inside a statement, rows with the same values of `conflict_columns` are merged,
+        the last one wins.
+        :param: rows: iterable of dicts, each one is the kwargs you would pass to `upsert`
+        :return: list of model objects, in the same order as `rows`. The id of
+                 the objects whose row existed and was left as it is is None"""
+        conflict_columns = tuple(conflict_columns)
+        if not conflict_columns:
+            raise ValueError('conflict_columns are required to match the returned rows')
+        rows = list(rows)
+        ret = []
+        evicted = []
+        conn, cur = get_conn_cur()
+        try:
+            types = cls._sql_types(cur)
+            for columns, batch in _batches(rows, batch_size):
+                updates = _update_columns(batch[0], conflict_columns, update_columns)
+                nulls = any(row[c] is None for row in batch for c in conflict_columns)
+                stmt = statement_cache.get(
+                    (cls, 'upsert_many', columns, len(batch), conflict_columns, updates, nulls),
+                    lambda: _upsert_many_stmt(cls.Meta.table, columns, types, len(batch),
+                                              conflict_columns, updates, nulls))
+                values = []
+                for i, row in enumerate(batch):
+                    values.append(i)
+                    values.extend(row.values())
+                execute(cur, stmt, values, False, 'upsert_many', cls)
+                # {position in the batch: id}
+                ids = dict(cur.fetchall())
+                if updates:
+                    evicted.extend(set(ids.values()))
+                ret.extend(_upserted(cls, ids.get(i), row) for i, row in enumerate(batch))
+            notify = cls._evict(evicted)
+            if notify is not None:
+                cur.execute(_NOTIFY, notify)
+            commit(conn)
+        except DatabaseError as e:
+            rollback(conn)
+            close(conn, cur)
+            raise _translate(e)
+
+        close(conn, cur)
+        cls._evict_committed(evicted)
         return ret
 
+    @classmethod
+    def update_where(cls, where, values=None, returning=False, **kwargs):
+        """ Update every row matching `where`, in one statement
+        :param: where: the WHERE clause, with %s placeholders for `values`,
+                or an expression, see postgrespy/expressions.py
+        :param: values: tuple of values of the WHERE clause
+        :param: returning: if True, return the updated objects instead of their number
+        :param: kwargs: key=value of the columns to set, like `update()`
+        Usage: Student.update_where('age < %s', (18, ), is_male=True)
+               Student.update_where(Student.c.age < 18, is_male=True)"""
+        if isinstance(where, Expression):
+            where, values = where.compile()
+        columns = tuple(kwargs.keys())
+        placeholders = tuple(_placeholder(v) for v in kwargs.values())
+        stmt = statement_cache.get(
+            (cls, 'update_where', columns, placeholders, where, returning),
+            lambda: 'UPDATE ' + cls.Meta.table +
+            ' SET ' + ','.join(c + ' = ' + p for c, p in zip(columns, placeholders)) +
+            ' WHERE ' + where + cls._returning(returning))
+        return cls._bulk_write(
+            lambda cur: [(stmt, list(kwargs.values()) + list(values or ()))], returning,
+            'update_where')
+
+    @classmethod
+    def delete_where(cls, where, values=None, returning=False):
+        """ Delete every row matching `where`, in one statement
+        :param: where: the WHERE clause, with %s placeholders for `values`,
+                or an expression, see postgrespy/expressions.py
+        :param: values: tuple of values of the WHERE clause
+        :param: returning: if True, return the deleted objects instead of their number
+        Usage: Student.delete_where('age < %s', (18, ))"""
+        if isinstance(where, Expression):
+            where, values = where.compile()
+        stmt = statement_cache.get(
+            (cls, 'delete_where', where, returning),
+            lambda: 'DELETE FROM ' + cls.Meta.table + ' WHERE ' + where +
+            cls._returning(returning))
+        return cls._bulk_write(lambda cur: [(stmt, values)], returning, 'delete_where')
+
+    @classmethod
+    def update_many(cls, updates, batch_size=1000, returning=False):
+        """ Update many rows, each one with its own values, in a single transaction.
+        Consecutive updates of the same columns are sent as one
+        `UPDATE ... FROM (VALUES ...)` statement of at most `batch_size` rows.
+        :param: updates: iterable of (id, {column: value})
+        :param: returning: if True, return the updated objects instead of their number
+        Usage: Student.update_many([(tom.id, {'age': 21}), (jerry.id, {'age': 19})])"""
+        rows = [OrderedDict([('id', id)] + list(changes.items())) for id, changes in updates]
+
+        def statements(cur):
+            types = cls._sql_types(cur)
+            for columns, batch in _batches(rows, batch_size):
+                row_placeholder = '(' + ','.join('%s::' + types[c] for c in columns) + ')'
+                stmt = statement_cache.get(
+                    (cls, 'update_many', columns, len(batch), returning),
+                    lambda: 'UPDATE ' + cls.Meta.table +
+                    ' SET ' + ','.join(c + ' = v.' + c for c in columns[1:]) +
+                    ' FROM (VALUES ' + ','.join([row_placeholder] * len(batch)) + ')' +
+                    ' AS v (' + ','.join(columns) + ')' +
+                    ' WHERE ' + cls.Meta.table + '.id = v.id' + cls._returning(returning))
+                yield stmt, [v for row in batch for v in row.values()]
+
+        return cls._bulk_write(statements, returning, 'update_many')
+
+    @classmethod
+    def _sql_types(cls, cur):
+        """{column: SQL type} of the table, read from the catalog once per model"""
+        schema = cls._schema
+        if schema.sql_types is None:
+            cur.execute('SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute'
+                        ' WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped',
+                        (cls.Meta.table, ))
+            schema.sql_types = dict(cur.fetchall())
+        return schema.sql_types
+
+    @classmethod
+    def _returning(cls, returning):
+        """ RETURNING clause of the bulk writes: every column if `returning`, otherwise
+        the id if the written rows must be evicted from the row cache"""
+        if returning:
+            return ' RETURNING ' + ','.join(
+                cls.Meta.table + '.' + c for c in cls._schema.select_columns)
+        if getattr(cls.Meta, 'cache', None) is not None:
+            return ' RETURNING ' + cls.Meta.table + '.id'
+        return ''
+
+    @classmethod
+    def _bulk_write(cls, statements, returning, operation):
+        """ Execute the (stmt, values) of `statements(cur)` in a single transaction.
+        Return the written objects if `returning`, otherwise the number of written rows"""
+        evict = getattr(cls.Meta, 'cache', None) is not None
+        hydrate = cls._schema.hydrator()
+        count = 0
+        objs = []
+        evicted = []
+        conn, cur = get_conn_cur()
+        try:
+            for stmt, values in statements(cur):
+                execute(cur, stmt, values, False, operation, cls)
+                if not (returning or evict):
+                    count += cur.rowcount
+                    continue
+                rows = cur.fetchall()
+                count += len(rows)
+                if returning:
+                    objs.extend(hydrate(row) for row in rows)
+                # id is the last returned column
+                ids = [row[-1] for row in rows]
+                evicted.extend(ids)
+                notify = cls._evict(ids)
+                if notify is not None:
+                    cur.execute(_NOTIFY, notify)
+            commit(conn)
+        except DatabaseError as e:
+            rollback(conn)
+            close(conn, cur)
+            raise _translate(e)
+
+        close(conn, cur)
+        cls._evict_committed(evicted)
+        return objs if returning else count
+
     def update(self, **kwargs):
         """Execute the update query
         :param: kwargs: list of key=value, where
                 key is one field of the table,
                 value must be a Python builtin type, not my custom types defined in fields.py: int, string, datetime, dict, etc."""
-        conn, cur = get_conn_cur()
-
-        template = Template('UPDATE {{table}} '
-                            'SET {{ field_value_pairs }} '
-                            'WHERE id = %s')
-
-        """Prepare the field value pairs"""
-        temp_arr = []
-        for k,v in kwargs.items():
-            # check if value is list of dict
-            # if so, treat it as an array of json
-            if type(v) is list and len(v) > 0 and type(v[0]) is dict:
-                # https://github.com/psycopg/psycopg2/issues/585
-                #https://stackoverflow.com/questions/31641894/convert-python-list-of-dicts-into-postgresql-array-of-json
-                temp_arr.append(k + ' = %s::jsonb[]')
-            else: 
-                temp_arr.append(k + ' = %s')
-        field_value_pairs = ','.join(temp_arr)
-
-        """Render and execute the statement"""
-        stmt = template.render(table=self.Meta.table, field_value_pairs=field_value_pairs)
-        cur.execute(stmt, list(kwargs.values()) + [self.id])
-
-        conn.commit()
-        close(conn, cur)
+        stmt = self._update_sql(kwargs)
+        values = list(kwargs.values()) + [self.id]
+        if not defer(stmt, values):
+            conn, cur = get_conn_cur()
+            execute(cur, stmt, values, is_prepared(type(self)), 'update', type(self))
+            notify = self._evict((self.id, ))
+            if notify is not None:
+                cur.execute(_NOTIFY, notify)
+            commit(conn)
+            close(conn, cur)
+            self._evict_committed((self.id, ))
+        else:
+            notify = self._evict((self.id, ))
+            if notify is not None:
+                defer(_NOTIFY, notify)
 
         for k,v in kwargs.items():
             setattr(self, k, v)
+        self._synced(kwargs)
+
+    @classmethod
+    def _update_sql(cls, kwargs):
+        """Get the statement from the cache, build it on the first call with this signature"""
+        columns = tuple(kwargs.keys())
+        placeholders = tuple(_placeholder(v) for v in kwargs.values())
+        return statement_cache.get(
+            (cls, 'update', columns, placeholders),
+            lambda: _update_stmt(cls.Meta.table, columns, placeholders))
 
     # DEPRECATED, use update(cls, **kwargs) instead
     def _update(self):
@@ -143,79 +752,302 @@ class Model(object):
         warnings.warn("_update(self) deprecated from 09/2017, use update(self, **kwargs) instead", DeprecationWarning)
         conn, cur = get_conn_cur()
 
-        template = Template('UPDATE {{table}}\n'
-                            'SET {{ field_value_pairs }} \n'
-                            'WHERE id = %s')
-        stmt = template.render(table=self.Meta.table,
-                               field_value_pairs=','.join(
-                                   f + '=%s' for f in self.fields))
-        values = []
-        for f in self.fields:
-            if getattr(self, f) is None:
-                values.append(None)
-            else:
-                values.append(getattr(self, f).value)
+        stmt = _update_stmt(self.Meta.table, self.fields, ['%s'] * len(self.fields))
+        values = [getattr(self, f) for f in self.fields]
         cur.execute(stmt, values + [self.id])
+        notify = self._evict((self.id, ))
+        if notify is not None:
+            cur.execute(_NOTIFY, notify)
 
-        conn.commit()
+        commit(conn)
         close(conn, cur)
+        self._evict_committed((self.id, ))
 
     @classmethod
-    def fetchone(cls, **kwargs):
-        """Syntactic sugar for Select().fetchone()"""
-        wheres = [k + '=%s' for k in kwargs.keys()]
-        if len(kwargs) > 0:
-            where = ' and '.join(wheres)
-            values = tuple(kwargs.values())
-        else:
-            where = None
-            values = None
-        with Select(cls, where) as select:
-            select.execute(values)
+    def _select(cls, where, kwargs, only=None, defer=None):
+        """Select of the model, see `fetchone()`"""
+        return Select(cls, _where(cls, where, kwargs), only=only, defer=defer)
+
+    @classmethod
+    def fetchone(cls, where=None, only=None, defer=None, **kwargs):
+        """Syntactic sugar for Select().fetchone()
+        :param: where: expression on the columns, e.g. `Student.c.age > 18`,
+                see postgrespy/expressions.py
+        :param: only, defer: columns to select, or not to select, see Select
+        :param: kwargs: key=value, the columns must be equal to these values"""
+        with cls._select(where, kwargs, only, defer) as select:
+            select.execute()
             one = select.fetchone()
             if one is None:
                 return None
         return one
 
     @classmethod
-    def fetchall(cls, **kwargs):
-        """Syntactic sugar for Select().fetchall()"""
-        wheres = [k + '=%s' for k in kwargs.keys()]
-        if len(kwargs) > 0:
-            where = ' and '.join(wheres)
-            values = tuple(kwargs.values())
-        else:
-            where = None
-            values = None
-        with Select(cls, where) as select:
-            select.execute(values)
+    def fetchall(cls, where=None, only=None, defer=None, **kwargs):
+        """Syntactic sugar for Select().fetchall(), see `fetchone()`"""
+        with cls._select(where, kwargs, only, defer) as select:
+            select.execute()
             return select.fetchall()
 
     @classmethod
-    def fetchmany(cls, size, **kwargs):
-        """Syntactic sugar for Select().fetchmany()"""
-        wheres = [k + '=%s' for k in kwargs.keys()]
-        if len(kwargs) > 0:
-            where = ' and '.join(wheres)
-            values = tuple(kwargs.values())
-        else:
-            where = None
-            values = None
-        with Select(cls, where) as select:
-            select.execute(values)
+    def fetchmany(cls, size, where=None, only=None, defer=None, **kwargs):
+        """Syntactic sugar for Select().fetchmany(), see `fetchone()`"""
+        with cls._select(where, kwargs, only, defer) as select:
+            select.limit(size)
+            select.execute()
             return select.fetchmany(size)
 
+    @classmethod
+    def iter(cls, batch_size=2000, where=None, only=None, defer=None, **kwargs):
+        """ Generator version of fetchall(): yield the objects one by one,
+        reading them from a server-side cursor, `batch_size` rows at a time.
+        The connection goes back to the pool when the generator is exhausted,
+        closed or garbage-collected."""
+        with cls._select(where, kwargs, only, defer) as select:
+            yield from select.iter(batch_size=batch_size)
+
+    stream = iter
+
+    @classmethod
+    def values(cls, *fields, where=None, **kwargs):
+        """ Like `fetchall()`, but return dicts of `fields` (default: every column and id)
+        instead of model objects: only `fields` are selected, nothing is hydrated.
+        Usage: Student.values('name', 'age', age=20)  # [{'name': 'Tom', 'age': 20}]"""
+        fields = fields or cls._schema.select_columns
+        return [dict(zip(fields, row)) for row in cls._values(fields, where, kwargs)]
+
+    @classmethod
+    def values_list(cls, *fields, flat=False, where=None, **kwargs):
+        """ Like `values()`, with tuples of `fields` instead of dicts.
+        :param: flat: with a single field, return the list of its values
+        Usage: Student.values_list('name', flat=True)  # ['Tom', 'Jerry']"""
+        if flat and len(fields) != 1:
+            raise ValueError('flat=True needs a single field')
+        rows = cls._values(fields or cls._schema.select_columns, where, kwargs)
+        if flat:
+            return [row[0] for row in rows]
+        return rows
+
+    @classmethod
+    def _values(cls, fields, where, kwargs):
+        """Tuples of the values of `fields` of the rows matching the conditions"""
+        with cls._select(where, kwargs, only=[f for f in fields if f != 'id']) as select:
+            select.execute()
+            rows = select.fetchall('tuple')
+        positions = tuple(select.fields.index(f) for f in fields)
+        if positions == tuple(range(len(select.fields))):
+            return rows
+        if len(positions) == 1:
+            i = positions[0]
+            return [(row[i], ) for row in rows]
+        get = itemgetter(*positions)
+        return [get(row) for row in rows]
+
+    @classmethod
+    def count(cls, where=None, **kwargs):
+        """ Number of rows matching the conditions, counted by the server.
+        See `fetchone()` for the conditions"""
+        with Aggregate(cls, ['count(*)'], _where(cls, where, kwargs)) as query:
+            query.execute()
+            return query.fetchone()[0]
+
+    @classmethod
+    def exists(cls, where=None, **kwargs):
+        """ True if a row matches the conditions, see `fetchone()`.
+        The server stops at the first one."""
+        with Aggregate(cls, ['1'], _where(cls, where, kwargs)) as query:
+            query.limit(1)
+            query.execute()
+            return query.fetchone() is not None
+
+    @classmethod
+    def fetch_by_ids(cls, ids):
+        """ Fetch the objects of `ids` in one query (`WHERE id = ANY(...)`) instead of
+        one `fetchone(id=...)` per id. See also postgrespy/loader.py
+        Return them in the order of `ids`, skipping the ids which don't exist.
+        Rows found in the row cache of the model (`Meta.cache`) are not fetched again."""
+        ids = [int(id) for id in ids]
+        rows, missing = cls._cached_rows(ids)
+        if missing:
+            # Rows are cached from the primary only, see Select
+            primary = getattr(cls.Meta, 'cache', None) is not None
+            with Select(cls, 'id = ANY(%s)', primary=primary) as select:
+                select.execute((missing, ))
+                cls._cache_rows(rows, select.cur.fetchall())
+        return cls._by_ids(ids, rows)
+
+    @classmethod
+    def _cached_rows(cls, ids):
+        """Return ({id: row} of the rows of `ids` in the row cache, [the other ids])"""
+        cache = getattr(cls.Meta, 'cache', None)
+        rows = {}
+        if cache is not None and current_transaction() is None:
+            for id in set(ids):
+                row = cache.get_row(cls.Meta.table, id)
+                if row is not None:
+                    rows[id] = row
+        return rows, list(OrderedDict.fromkeys(id for id in ids if id not in rows))
+
+    @classmethod
+    def _cache_rows(cls, rows, fetched):
+        """Add the `fetched` rows to `rows` ({id: row}) and to the row cache"""
+        cache = getattr(cls.Meta, 'cache', None)
+        if current_transaction() is not None:
+            cache = None
+        for row in fetched:
+            # id is the last selected column
+            rows[row[-1]] = row
+            if cache is not None:
+                cache.set_row(cls.Meta.table, row[-1], row)
+
+    @classmethod
+    def _by_ids(cls, ids, rows):
+        hydrate = cls._schema.hydrator()
+        objs = {id: hydrate(row) for id, row in rows.items()}
+        return [objs[id] for id in ids if id in objs]
+
     def delete(self):
         """
         Delete the row from database.
         """
+        if defer(self._delete_sql(), (self.id,)):
+            notify = self._evict((self.id, ))
+            if notify is not None:
+                defer(_NOTIFY, notify)
+            return
         conn, cur = get_conn_cur()
-        template = Template('DELETE FROM {{table}}\n'
-                            'WHERE id = %s')
-        stmt = template.render(table=self.Meta.table)
-        cur.execute(stmt, (self.id,))
-        conn.commit()
+        execute(cur, self._delete_sql(), (self.id,), is_prepared(type(self)),
+                'delete', type(self))
+        notify = self._evict((self.id, ))
+        if notify is not None:
+            cur.execute(_NOTIFY, notify)
+        commit(conn)
         close(conn, cur)
+        self._evict_committed((self.id, ))
+
+    @classmethod
+    def _evict(cls, ids):
+        """ Drop the rows of `ids` from the row cache of the model (`Meta.cache`), now and,
+        inside a transaction, once it's committed. Return the values of the NOTIFY statement
+        telling the other processes to do the same, or None, see cache.RowCache"""
+        cache = getattr(cls.Meta, 'cache', None)
+        if cache is None:
+            return None
+        table, ids = cls.Meta.table, [int(id) for id in ids]
+
+        def evict():
+            for id in ids:
+                cache.evict(table, id)
+
+        evict()
+        tx = current_transaction()
+        if tx is not None:
+            tx.on_commit(evict)
+        if cache.channel is None or not ids:
+            return None
+        return cache.channel, [table + ':' + str(id) for id in ids]
+
+    @classmethod
+    def _evict_committed(cls, ids):
+        """ Drop the rows of `ids` from the row cache again, once written outside of a
+        transaction: a reader may have cached the old rows between `_evict()` and the commit.
+        Inside a transaction, `_evict()` already does it on commit"""
+        cache = getattr(cls.Meta, 'cache', None)
+        if cache is None or current_transaction() is not None:
+            return
+        for id in ids:
+            cache.evict(cls.Meta.table, int(id))
+
+    @classmethod
+    def _delete_sql(cls):
+        return statement_cache.get(
+            (cls, 'delete'),
+            lambda: 'DELETE FROM ' + cls.Meta.table + ' WHERE id = %s')
+
+    """
+    Asynchronous versions of the methods above, see postgrespy/aio.py
+    """
+
+    @classmethod
+    async def ainsert(cls, **kwargs):
+        """Asynchronous version of `insert()`"""
+        async with aio.get_async_pool().acquire() as conn:
+            try:
+                cur, _ = await aexecute(conn, cls._insert_sql(kwargs), tuple(kwargs.values()),
+                                        'insert', cls)
+            except DatabaseError as e:
+                raise _translate_insert(e)
+        return cls(cur.fetchone()[0], **kwargs)._synced()
+
+    async def aupdate(self, **kwargs):
+        """Asynchronous version of `update()`"""
+        async with aio.get_async_pool().acquire() as conn:
+            await aexecute(conn, self._update_sql(kwargs), list(kwargs.values()) + [self.id],
+                           'update', type(self))
+            notify = self._evict((self.id, ))
+            if notify is not None:
+                await aio.execute(conn, _NOTIFY, notify)
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+        self._synced(kwargs)
+
+    async def adelete(self):
+        """Asynchronous version of `delete()`"""
+        async with aio.get_async_pool().acquire() as conn:
+            await aexecute(conn, self._delete_sql(), (self.id,), 'delete', type(self))
+            notify = self._evict((self.id, ))
+            if notify is not None:
+                await aio.execute(conn, _NOTIFY, notify)
+
+    @classmethod
+    async def afetchone(cls, where=None, **kwargs):
+        """Asynchronous version of `fetchone()`"""
+        return await cls._select(where, kwargs).afetchone()
+
+    @classmethod
+    async def afetchall(cls, where=None, **kwargs):
+        """Asynchronous version of `fetchall()`"""
+        return await cls._select(where, kwargs).afetchall()
+
+    @classmethod
+    async def afetchmany(cls, size, where=None, **kwargs):
+        """Asynchronous version of `fetchmany()`"""
+        return await cls._select(where, kwargs).afetchmany(size)
+
+    @classmethod
+    async def acount(cls, where=None, **kwargs):
+        """Asynchronous version of `count()`"""
+        return (await Aggregate(cls, ['count(*)'], _where(cls, where, kwargs)).afetchone())[0]
+
+    @classmethod
+    async def aexists(cls, where=None, **kwargs):
+        """Asynchronous version of `exists()`"""
+        query = Aggregate(cls, ['1'], _where(cls, where, kwargs))
+        query.limit(1)
+        return await query.afetchone() is not None
+
+    @classmethod
+    async def afetch_by_ids(cls, ids):
+        """Asynchronous version of `fetch_by_ids()`"""
+        ids = [int(id) for id in ids]
+        rows, missing = cls._cached_rows(ids)
+        if missing:
+            async with aio.get_async_pool().acquire() as conn:
+                cur, _ = await aexecute(conn, Select(cls, 'id = ANY(%s)').stmt, (missing, ),
+                                        'select', cls)
+            cls._cache_rows(rows, cur.fetchall())
+        return cls._by_ids(ids, rows)
+
+    @classmethod
+    async def aiter(cls, batch_size=2000, where=None, **kwargs):
+        """Asynchronous version of `iter()`: `async for obj in Model.aiter(): ...`"""
+        stream = cls._select(where, kwargs).aiter(batch_size=batch_size)
+        try:
+            async for obj in stream:
+                yield obj
+        finally:
+            # `async for` doesn't close the inner generator when this one is closed early
+            await stream.aclose()
     
     # DEPRECATED, use ::insert() instead
     def _insert(self):
@@ -223,37 +1055,17 @@ class Model(object):
         warnings.warn("DEPRECATED, use ::insert() instead", DeprecationWarning)
         conn, cur = get_conn_cur()
 
-        template = Template('INSERT INTO {{table}}\n'
-                            '( {{columns}} )\n'
-                            'VALUES ( {{placeholders}} )\n'
-                            'RETURNING id')
-
-        stmt = template.render(table=self.Meta.table,
-                               columns=','.join(self.fields),
-                               placeholders=','.join('%s'
-                                                     for f in self.fields)
-                               )
+        stmt = _insert_stmt(self.Meta.table, self.fields, ['%s'] * len(self.fields))
         try:
-            values = []
-            for f in self.fields:
-                if type(getattr(self, f)) == JsonBField:
-                    values.append(json.dumps(getattr(self, f).value))
-                else:
-                    values.append(getattr(self, f).value)
+            values = [getattr(self, f) for f in self.fields]
             cur.execute(stmt, values)
             self.id = cur.fetchone()[0]
-            conn.commit()
+            commit(conn)
         except DatabaseError as e:
-            conn.rollback()
-            if e.pgcode == '23505':
-                """
-                23505: PostgreSQL error code: unique violation
-                https://www.postgresql.org/docs/9.6/static/errcodes-appendix.html
-                """
-                raise UniqueViolatedError()
-            else:
-                raise NotImplementedError(
-                    'Unhandled error. Need to check.')
+            rollback(conn)
+            close(conn, cur)
+            raise _translate_insert(e)
         close(conn, cur)
 
 
+Model._schema = Schema(Model)
@@ -0,0 +1,244 @@
+"""
+Thread-safe pool of psycopg2 connections, used by `db.get_pool()`.
+Compared to psycopg2's ThreadedConnectionPool:
+- `getconn()` waits up to `timeout` seconds for a connection when `maxconn` are in use,
+  instead of raising PoolError right away. Waiters are served in FIFO order.
+- connections are recycled after `max_lifetime` seconds, or after `idle_timeout` seconds
+  spent idle in the pool (while more than `minconn` are open)
+- a connection is checked before being handed out: broken ones are replaced, and the
+  ones idle for more than `ping_after` seconds are pinged with `SELECT 1`
+- after a fork (e.g. gunicorn workers), the child process starts with a new set of
+  connections instead of sharing the sockets of its parent
+- `stats()` returns counters of the pool activity
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import DatabaseError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from psycopg2.pool import PoolError
+
+from postgrespy import PoolTimeoutError
+
+# Connections inherited from the parent process. They must not be closed in the
+# child, that would end the parent's sessions, so they are only kept referenced.
+_inherited = []  # type: list
+
+
+class _Waiter:
+    __slots__ = ('event', 'conn')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.conn = None
+
+
+class ConnectionPool:
+    def __init__(self, minconn, maxconn, timeout=30.0, max_lifetime=3600.0,
+                 idle_timeout=600.0, ping_after=5.0, **kwargs):
+        """
+        :param: minconn: number of connections opened at start, and kept open when idle
+        :param: maxconn: maximum number of connections
+        :param: timeout: seconds `getconn()` waits for a connection before raising PoolTimeoutError
+        :param: max_lifetime: seconds after which a connection is closed and replaced
+        :param: idle_timeout: seconds after which an idle connection is closed
+        :param: ping_after: seconds of idleness after which a connection is pinged on checkout
+        :param: kwargs: passed to psycopg2.connect()
+        """
+        self.minconn = int(minconn)
+        self.maxconn = int(maxconn)
+        self.timeout = float(timeout)
+        self.max_lifetime = float(max_lifetime)
+        self.idle_timeout = float(idle_timeout)
+        self.ping_after = float(ping_after)
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._lock_pid = os.getpid()
+        self.closed = False
+        self._reset()
+        for _ in range(self.minconn):
+            self._size += 1
+            self.putconn(self._connect())
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # Idle connections, the most recently used at the right
+        self._idle = deque()
+        self._waiters = deque()
+        # {id(conn): [conn, created at, last used at]}
+        self._info = {}
+        # Number of open connections, including the ones being opened
+        self._size = 0
+        self._stats = dict(checkouts=0, waits=0, wait_time=0.0, max_wait_time=0.0,
+                           timeouts=0, connects=0, recycled=0, broken=0)
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            if self._lock_pid != os.getpid():
+                # Another thread of the parent may have held the lock at fork time: it
+                # would stay locked forever, the child takes a new one
+                self._lock_pid = os.getpid()
+                self._lock = threading.Lock()
+            with self._lock:
+                if os.getpid() != self._pid:
+                    _inherited.extend(info[0] for info in self._info.values())
+                    self._reset()
+
+    def _connect(self):
+        try:
+            conn = psycopg2.connect(**self._kwargs)
+        except BaseException:
+            with self._lock:
+                self._size -= 1
+            raise
+        now = time.monotonic()
+        with self._lock:
+            self._info[id(conn)] = [conn, now, now]
+            self._stats['connects'] += 1
+        return conn
+
+    def _discard(self, conn, reason):
+        """Close `conn` and forget it. The caller must hold the lock"""
+        self._info.pop(id(conn), None)
+        self._size -= 1
+        self._stats[reason] += 1
+        if not conn.closed:
+            conn.close()
+
+    def _usable(self, conn, now):
+        """Return False if `conn` must not be handed out. The caller must hold the lock"""
+        created, last_used = self._info[id(conn)][1:]
+        if conn.closed or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            self._discard(conn, 'broken')
+            return False
+        if now - created > self.max_lifetime or \
+                (now - last_used > self.idle_timeout and self._size > self.minconn):
+            self._discard(conn, 'recycled')
+            return False
+        return True
+
+    def _ping(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except DatabaseError:
+            with self._lock:
+                self._discard(conn, 'broken')
+            return False
+
+    def getconn(self, timeout=None):
+        """ Take a connection, wait up to `timeout` seconds (default: `self.timeout`)
+        if they are all in use."""
+        self._check_fork()
+        if self.closed:
+            raise PoolError('connection pool is closed')
+        start = time.monotonic()
+        while True:
+            waiter = None
+            with self._lock:
+                self._stats['checkouts'] += 1
+                conn = None
+                while self._idle:
+                    candidate = self._idle.pop()
+                    if self._usable(candidate, start):
+                        conn = candidate
+                        break
+                if conn is None:
+                    if self._size < self.maxconn:
+                        self._size += 1
+                    else:
+                        waiter = _Waiter()
+                        self._waiters.append(waiter)
+                        self._stats['waits'] += 1
+
+            if conn is None and waiter is None:
+                return self._connect()
+
+            if waiter is not None:
+                conn = self._wait(waiter, start, self.timeout if timeout is None else timeout)
+                if conn is None:
+                    # The connection handed over was closed, a slot is free for a new one
+                    return self._connect()
+                return conn
+
+            if time.monotonic() - self._info[id(conn)][2] <= self.ping_after or self._ping(conn):
+                return conn
+            with self._lock:
+                self._stats['checkouts'] -= 1
+
+    def _wait(self, waiter, start, timeout):
+        waiter.event.wait(timeout)
+        with self._lock:
+            waited = time.monotonic() - start
+            self._stats['wait_time'] += waited
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'], waited)
+            if not waiter.event.is_set():
+                self._waiters.remove(waiter)
+                self._stats['timeouts'] += 1
+                raise PoolTimeoutError(
+                    'no connection available after %.1f seconds' % timeout)
+        return waiter.conn
+
+    def putconn(self, conn, close=False):
+        """Give a connection back to the pool. Close it if `close` is True"""
+        if os.getpid() != self._pid or id(conn) not in self._info:
+            # Taken before a fork, or not from this pool
+            return
+        # The rollback is a round trip: done without the lock, like the pings of getconn()
+        if not conn.closed and not close:
+            status = conn.get_transaction_status()
+            if status == TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except DatabaseError:
+                    close = True
+        with self._lock:
+            now = time.monotonic()
+            info = self._info[id(conn)]
+            info[2] = now
+            if close or conn.closed or self.closed:
+                self._discard(conn, 'broken')
+                conn = None
+            elif now - info[1] > self.max_lifetime:
+                self._discard(conn, 'recycled')
+                conn = None
+
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                if conn is None:
+                    # Hand over a free slot instead
+                    self._size += 1
+                waiter.conn = conn
+                waiter.event.set()
+            elif conn is not None:
+                self._idle.append(conn)
+
+    def closeall(self):
+        with self._lock:
+            self.closed = True
+            while self._idle:
+                self._discard(self._idle.pop(), 'recycled')
+
+    def stats(self):
+        """ Return the pool counters:
+        - checkouts, waits, timeouts: number of `getconn()` calls, of calls which had to
+          wait and of calls which timed out
+        - wait_time, max_wait_time: total and maximum seconds spent waiting
+        - connects, recycled, broken: number of connections opened, closed because of their
+          age, and closed because they were unusable
+        - size, in_use, idle, waiting: current number of connections, of connections in
+          use, idle, and of waiting threads"""
+        self._check_fork()
+        with self._lock:
+            ret = dict(self._stats)
+            ret.update(size=self._size, idle=len(self._idle),
+                       in_use=self._size - len(self._idle), waiting=len(self._waiters))
+        return ret
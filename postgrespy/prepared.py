@@ -0,0 +1,87 @@
+"""
+Server-side prepared statements.
+When enabled, a statement is sent once per connection with `PREPARE`,
+then every following call with the same SQL text only sends `EXECUTE`,
+so PostgreSQL parses and plans it once.
+https://www.postgresql.org/docs/current/static/sql-prepare.html
+
+Usage:
+- for every model: `use_prepared_statements()`
+- for one model: set `prepared = True` in its `Meta`
+- for one query: `Select(Student, 'name=%s', prepared=True)`
+"""
+
+import re
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+# Maximum number of statements prepared on one connection.
+# Statements beyond it are executed without being prepared.
+MAX_PREPARED_PER_CONN = 256
+
+_enabled = False
+
+# Prepared statements only live as long as their session, so the registry
+# is kept per connection: {conn: {sql: 'EXECUTE name(...)'}}
+_registry = WeakKeyDictionary()  # type: WeakKeyDictionary
+_lock = Lock()
+
+_placeholder_re = re.compile(r'%%|%s(::[\w\[\]]+)?')
+
+
+def use_prepared_statements(enabled=True):
+    """Turn prepared statements on (or off) for models which don't set `Meta.prepared`"""
+    global _enabled
+    _enabled = enabled
+
+
+def is_prepared(model_cls):
+    return getattr(model_cls.Meta, 'prepared', _enabled)
+
+
+def _parse(stmt):
+    """ Translate psycopg2 placeholders into PostgreSQL positional parameters.
+    Return the statement to PREPARE and the argument list of EXECUTE, e.g.
+    'UPDATE t SET a = %s::jsonb[] WHERE id = %s' gives
+    'UPDATE t SET a = $1::jsonb[] WHERE id = $2' and '(%s::jsonb[],%s)'
+    """
+    args = []
+
+    def repl(match):
+        if match.group(0) == '%%':
+            return '%'
+        args.append(match.group(0))
+        return '$' + str(len(args)) + (match.group(1) or '')
+
+    return _placeholder_re.sub(repl, stmt), '(' + ','.join(args) + ')'
+
+
+def prepared_statements(conn):
+    """Return {sql: 'EXECUTE name(...)'} of the statements prepared on `conn`"""
+    with _lock:
+        return dict(_registry.get(conn, {}))
+
+
+def execute(cur, stmt, values=None, prepared=False):
+    """ Execute `stmt` on `cur`, through a prepared statement if `prepared` is True"""
+    if not prepared:
+        cur.execute(stmt, values)
+        return
+
+    with _lock:
+        names = _registry.setdefault(cur.connection, {})
+        entry = names.get(stmt)
+    if entry is None:
+        if len(names) >= MAX_PREPARED_PER_CONN:
+            cur.execute(stmt, values)
+            return
+        name = 'postgrespy_' + str(len(names) + 1)
+        if values:
+            body, args = _parse(stmt)
+        else:
+            body, args = stmt, ''
+        cur.execute('PREPARE ' + name + ' AS ' + body)
+        entry = ('EXECUTE ' + name + args)
+        with _lock:
+            names[stmt] = entry
+    cur.execute(entry, values or None)
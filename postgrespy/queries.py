@@ -1,22 +1,128 @@
-from postgrespy.fields import BaseField
-from postgrespy.db import get_conn_cur, close
-from typing import Tuple
+from postgrespy.db import get_conn_cur, close, current_transaction
+from postgrespy.prepared import is_prepared
+from postgrespy.instrumentation import execute
+from postgrespy.hydration import DeferredColumns
+from postgrespy.expressions import Column, Expression
+from postgrespy import aio, instrumentation
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from itertools import count
+import base64
+import json
+from time import perf_counter
+from typing import Any, Sequence, Tuple, Union
+
+# Names of server-side cursors, they must be unique inside a session
+_cursor_ids = count(1)
+
+# Rows read at once to build columnar results, see Query.fetchall()
+COLUMNAR_BATCH_SIZE = 10000
+
+
+def _sql(expression):
+    """SQL text of a column or of a SQL string"""
+    return expression.sql if isinstance(expression, Column) else expression
+
+
+def _condition(condition):
+    """(SQL text, values) of a condition: a SQL string or an expression"""
+    if isinstance(condition, Expression):
+        return condition.compile()
+    return condition, []
+
+
+@lru_cache(maxsize=256)
+def _namedtuple(fields):
+    """namedtuple class of the rows of `fields`, invalid names (e.g. 'cars.id') are renamed"""
+    return namedtuple('Row', fields, rename=True)
+
+
+def _array(np, values, field_type=None):
+    """ NumPy array of a column of numbers, NULLs as NaN, or of booleans without NULL.
+    The other columns stay lists. The `python_type` of `field_type` (a field class) gives
+    the type of an empty column"""
+    types = set(map(type, values))
+    nulls = type(None) in types
+    types.discard(type(None))
+    if not types and field_type is not None:
+        types = {field_type.python_type}
+    if types == {bool} and not nulls:
+        return np.array(values, dtype=bool)
+    if types and types <= {int, float}:
+        if nulls or float in types:
+            return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        return np.array(values, dtype=np.int64)
+    return values
+
+
+def _encode_token(values):
+    """Opaque pagination token holding `values`, see Select.paginate_after()"""
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def _decode_token(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except ValueError:
+        values = None
+    if not isinstance(values, list):
+        raise ValueError('Invalid pagination token')
+    return values
 
 
 class Query:
+    # Execute through a server-side prepared statement, see postgrespy/prepared.py
+    prepared = False
+    # Read from the primary even if there are read replicas, see postgrespy/db.py
+    primary = False
+    # Operation of the statements, see postgrespy/instrumentation.py
+    operation = 'select'
+
+    # The pooled connection and its cursor, taken on first use
+    _conn = None  # type: Any
+    _cur = None  # type: Any
+    # Cursor of the last `aexecute()`
+    _acur = None  # type: Any
+    # Values of the WHERE expression, used when no values are given, see postgrespy/expressions.py
+    values = None  # type: Any
+    # Instrumentation event of the current result set, None without listener
+    _event = None  # type: Any
+
     def __init__(self, model_cls):
-        self.conn, self.cur = get_conn_cur()
         self.model_cls = model_cls
-        self.fields = [f for f in dir(model_cls) if not f.startswith(
-            '__') and issubclass(type(getattr(model_cls, f)), BaseField)]
-        self.fields = self.fields + ['id']  # Add id to the list of fields
+        # The field names, followed by id
+        self.fields = model_cls._schema.select_columns
+        # Build one result object from one row
+        self._hydrate = model_cls._schema.hydrator()
         self.stmt = ''
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, tb):
-        close(self.conn, self.cur)
+        self._end_event()
+        if self._conn is not None:
+            close(self._conn, self._cur)
+            self._conn = self._cur = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        self._end_event()
+        self._acur = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn, self._cur = get_conn_cur(read_only=not self.primary)
+        return self._conn
+
+    @property
+    def cur(self):
+        if self._conn is None:
+            self._conn, self._cur = get_conn_cur(read_only=not self.primary)
+        return self._cur
 
     def order_by(self, *expressions):
         """ add ORDER BY expression to the query
@@ -27,163 +133,625 @@ class Query:
         https://www.postgresql.org/docs/current/static/queries-order.html"""
         self.stmt += ' ORDER BY ' + ','.join(expressions)
 
+    def limit(self, count: int):
+        """ add LIMIT clause to the query, after `order_by()`
+        https://www.postgresql.org/docs/current/static/queries-limit.html"""
+        self.stmt += ' LIMIT ' + str(int(count))
+
+    def offset(self, start: int):
+        """ add OFFSET clause to the query, after `limit()`.
+        The skipped rows are still computed by the server: for deep pages,
+        use `Select.paginate_after()` instead"""
+        self.stmt += ' OFFSET ' + str(int(start))
+
     def execute(self, values: Tuple = None):
-        self.cur.execute(self.stmt, values)
+        if values is None:
+            values = self.values
+        self._end_event()
+        self._event = execute(self.cur, self.stmt, values, self.prepared, self.operation,
+                              self.model_cls, keep_open=True)
+
+    def _end_event(self):
+        if self._event is not None:
+            self._event.end()
+            self._event = None
+
+    def _builder(self, as_):
+        """ The function building a result from a row:
+        - None: a model object (or what the query builds, e.g. a tuple of objects for a Join)
+        - 'tuple': the row itself, a tuple of the values of `fields`
+        - 'dict': {field: value}
+        - 'namedtuple': a namedtuple of `fields`"""
+        if as_ is None:
+            return self._hydrate
+        if as_ == 'tuple':
+            return tuple
+        if as_ == 'dict':
+            fields = self.fields
+            return lambda row: dict(zip(fields, row))
+        if as_ == 'namedtuple':
+            return _namedtuple(tuple(self.fields))._make
+        raise ValueError('Unknown result type: ' + str(as_))
+
+    def _results(self, fetch_rows, hydrate=None):
+        """ The objects built by `hydrate` from the rows returned by `fetch_rows()`,
+        timed if the statement is instrumented"""
+        if hydrate is None:
+            hydrate = self._hydrate
+        if self._event is None:
+            if hydrate is tuple:
+                # Rows are tuples already
+                return fetch_rows()
+            return [hydrate(row) for row in fetch_rows()]
+        return instrumentation.fetch(self._event, fetch_rows, hydrate)
 
-    def fetchone(self):
+    def _columnar(self, fetch_rows, as_):
+        """ {field: list of its values} of the rows returned by the successive calls of
+        `fetch_rows()`, with NumPy arrays for the numeric columns if `as_` is 'numpy'"""
+        columns = [[] for _ in self.fields]
+        while True:
+            rows = self._results(fetch_rows, tuple)
+            if not rows:
+                break
+            for column, values in zip(columns, zip(*rows)):
+                column.extend(values)
+        if as_ == 'numpy':
+            try:
+                import numpy as np
+            except ImportError:
+                raise ImportError("as_='numpy' needs NumPy: pip install numpy")
+            field_types = self.model_cls._schema.field_types
+            columns = [_array(np, column, field_types.get(field))
+                       for field, column in zip(self.fields, columns)]
+        return OrderedDict(zip(self.fields, columns))
+
+    def fetchone(self, as_: str = None):
+        """ Return the next result, None if there is no more.
+        Args:
+            as_: build the result as a model object (default), a 'tuple', a 'dict' or a
+                'namedtuple' of the values of `fields`, see `fetchall()`"""
+        build = self._builder(as_)
+        if self._event is not None:
+            objs = self._results(lambda: self.cur.fetchmany(1), build)
+            return objs[0] if objs else None
         row = self.cur.fetchone()
         if row is None:
             return None
-        ret = self.model_cls()
-        for i, f in enumerate(self.fields):
-            setattr(ret, f, row[i])
-        return ret
+        return build(row)
 
-    def fetchall(self):
-        rows = self.cur.fetchall()
-        ret = []
-        for row in rows:
-            r = self.model_cls()
-            for i, f in enumerate(self.fields):
-                setattr(r, f, row[i])
-            ret.append(r)
-        return ret
-
-    def fetchmany(self, size):
+    def fetchall(self, as_: str = None):
+        """ Return the remaining results.
+        Args:
+            as_: build the results as model objects (default), or skip the hydration:
+                'tuple', 'dict', 'namedtuple': one per row, of the values of `fields`
+                'columns': {field: list of the values of the column}
+                'numpy': same as 'columns', with NumPy arrays for the columns of numbers
+                (NULLs as NaN) and of booleans. The rows are read by batches of
+                COLUMNAR_BATCH_SIZE, so that they don't all live at once"""
+        if as_ in ('columns', 'numpy'):
+            objs = self._columnar(lambda: self.cur.fetchmany(COLUMNAR_BATCH_SIZE), as_)
+        else:
+            objs = self._results(self.cur.fetchall, self._builder(as_))
+        self._end_event()
+        return objs
+
+    def fetchmany(self, size, as_: str = None):
+        """ Return the next `size` results, as_: see `fetchone()`"""
         # Set cursor's array size for better performance
         # See more here: http://initd.org/psycopg/docs/cursor.html#cursor.fetchmany
         self.cur.arraysize = size
-        rows = self.cur.fetchmany()
-        ret = []
-        for row in rows:
-            r = self.model_cls()
-            for i, f in enumerate(self.fields):
-                setattr(r, f, row[i])
-            ret.append(r)
-        return ret
+        return self._results(self.cur.fetchmany, self._builder(as_))
+
+    def iter(self, values: Tuple = None, batch_size: int = 2000, as_: str = None):
+        """ Execute the query on a server-side (named) cursor and yield the results
+        one by one, so that only `batch_size` rows are held in memory at a time.
+        Use it instead of `execute()` + `fetchall()` for large result sets.
+        as_: see `fetchone()`
+        http://initd.org/psycopg/docs/usage.html#server-side-cursors"""
+        batches = self._iter_batches(values, batch_size, self._builder(as_))
+        try:
+            for objs in batches:
+                yield from objs
+        finally:
+            batches.close()
+
+    def _iter_batches(self, values, batch_size, hydrate=None):
+        """ Yield the results of the query by lists of `batch_size`, read from a server-side
+        cursor. Results are the rows, or their objects built by `hydrate(row)`"""
+        cur = self.conn.cursor(name='postgrespy_cursor_' + str(next(_cursor_ids)))
+        if values is None:
+            values = self.values
+        event = None
+        try:
+            event = execute(cur, self.stmt, values, False, self.operation, self.model_cls,
+                            keep_open=True)
+            while True:
+                if event is not None:
+                    results = instrumentation.fetch(event, lambda: cur.fetchmany(batch_size),
+                                                    hydrate)
+                elif hydrate is None:
+                    results = cur.fetchmany(batch_size)
+                else:
+                    results = [hydrate(row) for row in cur.fetchmany(batch_size)]
+                if not results:
+                    break
+                yield results
+        finally:
+            if event is not None:
+                event.end()
+            # After the query's exit, its connection went back to the pool with the cursor
+            if self._conn is not None and not self._conn.closed:
+                cur.close()
+
+    stream = iter
+
+    async def aexecute(self, values: Tuple = None):
+        """ Asynchronous version of `execute()`, on a connection of `aio.get_async_pool()`.
+        The whole result is transferred when the statement completes, so the connection
+        goes back to the pool right away."""
+        if values is None:
+            values = self.values
+        async with aio.get_async_pool().acquire() as conn:
+            self._end_event()
+            self._acur, self._event = await instrumentation.aexecute(
+                conn, self.stmt, values, self.operation, self.model_cls, keep_open=True)
+
+    async def afetchone(self, values: Tuple = None, as_: str = None):
+        """ Asynchronous version of `fetchone()`.
+        If the query has not been executed yet, execute it with `values`"""
+        if self._acur is None:
+            await self.aexecute(values)
+        build = self._builder(as_)
+        if self._event is not None:
+            objs = self._results(lambda: self._acur.fetchmany(1), build)
+            return objs[0] if objs else None
+        row = self._acur.fetchone()
+        if row is None:
+            return None
+        return build(row)
+
+    async def afetchall(self, values: Tuple = None, as_: str = None):
+        """ Asynchronous version of `fetchall()`.
+        If the query has not been executed yet, execute it with `values`"""
+        if self._acur is None:
+            await self.aexecute(values)
+        if as_ in ('columns', 'numpy'):
+            objs = self._columnar(lambda: self._acur.fetchmany(COLUMNAR_BATCH_SIZE), as_)
+        else:
+            objs = self._results(self._acur.fetchall, self._builder(as_))
+        self._end_event()
+        return objs
+
+    async def afetchmany(self, size, values: Tuple = None, as_: str = None):
+        """ Asynchronous version of `fetchmany()`.
+        If the query has not been executed yet, execute it with `values`"""
+        if self._acur is None:
+            await self.aexecute(values)
+        return self._results(lambda: self._acur.fetchmany(size), self._builder(as_))
+
+    async def aiter(self, values: Tuple = None, batch_size: int = 2000, as_: str = None):
+        """ Asynchronous version of `iter()`: `async for obj in query.aiter(): ...`
+        as_: see `fetchone()`
+        Asynchronous connections have no named cursors, so the cursor is declared in SQL.
+        https://www.postgresql.org/docs/current/static/sql-declare.html"""
+        name = 'postgrespy_cursor_' + str(next(_cursor_ids))
+        if values is None:
+            values = self.values
+        pool = aio.get_async_pool()
+        conn = await pool.getconn()
+        event = None
+        try:
+            await aio.execute(conn, 'BEGIN')
+            _, event = await instrumentation.aexecute(
+                conn, 'DECLARE ' + name + ' NO SCROLL CURSOR FOR ' + self.stmt, values,
+                self.operation, self.model_cls, keep_open=True)
+            fetch = 'FETCH ' + str(int(batch_size)) + ' FROM ' + name
+            hydrate = self._builder(as_)
+            while True:
+                start = perf_counter()
+                rows = (await aio.execute(conn, fetch)).fetchall()
+                if not rows:
+                    break
+                if event is None:
+                    for row in rows:
+                        yield hydrate(row)
+                else:
+                    event.fetch_time += perf_counter() - start
+                    for obj in instrumentation.fetch(event, lambda: rows, hydrate):
+                        yield obj
+        finally:
+            if event is not None:
+                event.end()
+            # Also reached when the generator is closed or garbage-collected early.
+            # Nothing was written, ROLLBACK ends the transaction and drops the cursor
+            if conn.closed or conn.isexecuting():
+                pool.putconn(conn, close=True)
+            else:
+                try:
+                    await aio.execute(conn, 'ROLLBACK')
+                except BaseException:
+                    pool.putconn(conn, close=True)
+                    raise
+                pool.putconn(conn)
 
 
 class Select(Query):
-    def __init__(self, model_cls, where: str=None) -> None:
+    # Columns left out of the current result set, see `only` and `defer`
+    _group = None  # type: Any
+
+    def __init__(self, model_cls, where: Union[str, Expression]=None, prepared: bool=None,
+                 compact: bool=False, primary: bool=False, only: Sequence[str]=None,
+                 defer: Sequence[str]=None) -> None:
+        """ SELECT query
+        Args:
+            where: the WHERE clause, with %s placeholders for the values given to `execute`,
+                or an expression holding its values, see postgrespy/expressions.py
+            prepared: use a server-side prepared statement. Default to the model setting,
+                see postgrespy/prepared.py
+            compact: fetch `model_cls._schema.compact_cls` objects (plain values in __slots__)
+                instead of model objects
+            primary: read from the primary even if there are read replicas
+            only: select only these columns (and id)
+            defer: select every column but these.
+                The columns which are not selected are loaded on first access, for every
+                object of the result set at once, see hydration.DeferredColumns.
+                Compact rows hold None instead."""
         super().__init__(model_cls)
+        self.primary = primary
+        schema = model_cls._schema
+        deferred = ()  # type: Tuple
+        if only is not None or defer is not None:
+            unknown = set(only or ()).union(defer or ()) - schema.fields - {'id'}
+            if unknown:
+                raise ValueError('Unknown columns: ' + ', '.join(sorted(unknown)))
+            kept = set(schema.columns if only is None else only) - set(defer or ())
+            self.fields = tuple(c for c in schema.columns if c in kept) + ('id', )
+            deferred = tuple(c for c in schema.columns if c not in kept)
+        if compact:
+            self._hydrate = schema.hydrator(self.fields, compact=True)
+        elif deferred:
+            self._hydrate_columns = schema.hydrator(self.fields)
+            self._deferred = deferred
+            self._hydrate = self._hydrate_partial
+        self.prepared = is_prepared(model_cls) if prepared is None else prepared
+        if isinstance(where, Expression):
+            self.where, self.values = where.compile()
+        else:
+            self.where = where
         self.stmt = 'SELECT ' + ','.join(self.fields) + \
             ' FROM ' + model_cls.Meta.table
-        if where is not None:
-            self.stmt = self.stmt + ' WHERE ' + where
+        if self.where is not None:
+            self.stmt = self.stmt + ' WHERE ' + self.where
+        # Lookups by id go through the row cache of the model, see cache.RowCache
+        self._row_cache = None
+        self._rows = None  # type: Any
+        if self.where is not None and not deferred and \
+                self.where.replace(' ', '') in ('id=%s', model_cls.Meta.table + '.id=%s'):
+            self._row_cache = getattr(model_cls.Meta, 'cache', None)
+            # Rows are cached from the primary only: a replica which has not caught up
+            # with a write would fill the cache with the old row for the whole TTL
+            if self._row_cache is not None:
+                self.primary = True
 
+    def paginate_after(self, order_columns: Sequence[str], last=None, page_size: int=100,
+                       values: Tuple=None, desc: bool=False):
+        """ Fetch one page of a keyset pagination: the `page_size` rows following `last`
+        in the order of `order_columns`, with
+        `WHERE (a, b) > (%s, %s) ORDER BY a, b LIMIT page_size`
+        With an index on `order_columns`, every page takes the same time, however deep.
+        Args:
+            order_columns: selected NOT NULL columns, the last ones unique (e.g. id)
+            last: the token returned with the previous page, or the values of
+                `order_columns` in the last row of the previous page. None for the first page
+            values: the values of the WHERE clause
+            desc: go through the rows in descending order
+        Return (objects, token of the next page). The token is None after the last page."""
+        order_columns = tuple(order_columns)
+        positions = [self.fields.index(c) for c in order_columns]
+        conditions = [] if self.where is None else ['(' + self.where + ')']
+        params = list((self.values if values is None else values) or ())
+        if last is not None:
+            if isinstance(last, str):
+                last = _decode_token(last)
+            if len(last) != len(order_columns):
+                raise ValueError('Expected %d values after which to paginate, got %d'
+                                 % (len(order_columns), len(last)))
+            conditions.append('(' + ','.join(order_columns) + ') ' + ('<' if desc else '>') +
+                              ' (' + ','.join(['%s'] * len(last)) + ')')
+            params.extend(last)
+        stmt = 'SELECT ' + ','.join(self.fields) + ' FROM ' + self.model_cls.Meta.table
+        if conditions:
+            stmt += ' WHERE ' + ' AND '.join(conditions)
+        stmt += ' ORDER BY ' + ','.join(c + (' DESC' if desc else '') for c in order_columns) + \
+            ' LIMIT ' + str(int(page_size))
 
-class Join(Query):
-    def __init__(self, model_cls_0, join_type_0: str, model_cls_1, on_clause_0: str, join_type_1=None, model_cls_2=None, on_clause_1=None) -> None:
-        """ Join query for (upto 3) tables"""
-        self.conn, self.cur = get_conn_cur()
+        self._group = None
+        self._end_event()
+        self._event = execute(self.cur, stmt, params, self.prepared, self.operation,
+                              self.model_cls, keep_open=True)
+        rows = self.cur.fetchall()
+        token = None
+        if len(rows) == page_size:
+            token = _encode_token([rows[-1][i] for i in positions])
+        objs = self._results(lambda: rows)
+        self._end_event()
+        return objs, token
+
+    def _hydrate_partial(self, row):
+        if self._group is None:
+            self._group = DeferredColumns(self.model_cls, self._deferred)
+        return self._group.add(self._hydrate_columns(row))
 
-        self.model_cls_0 = model_cls_0
+    def execute(self, values: Tuple = None):
+        if values is None:
+            values = self.values
+        # A new result set
+        self._group = None
+        self._end_event()
+        cache = self._row_cache
+        id = None
+        # Inside a transaction, rows may not be committed yet: they are not cached
+        if cache is not None and current_transaction() is None:
+            # Rows are cached by int id, the key evicted by the writes: `id='5'` too
+            if isinstance(values[0], (int, str)):  # type: ignore
+                try:
+                    id = int(values[0])  # type: ignore
+                except ValueError:
+                    pass
+        if cache is None or id is None:
+            self._rows = None
+            super().execute(values)
+            return
+        table = self.model_cls.Meta.table
+        row = cache.get_row(table, id)
+        if row is not None:
+            self._rows = [row]
+            return
+        super().execute(values)
+        self._rows = self.cur.fetchall()
+        if self._rows:
+            cache.set_row(table, id, self._rows[0])
 
-        table_name_0 = model_cls_0.Meta.table
-        self.fields_0 = [f for f in dir(model_cls_0) if not f.startswith(
-            '__') and issubclass(type(getattr(model_cls_0, f)), BaseField)]
-        # Add id to the list of fields
-        self.fields_0 += ['id']
+    def fetchone(self, as_: str = None):
+        if self._rows is None:
+            return super().fetchone(as_)
+        if not self._rows:
+            return None
+        return self._results(lambda: [self._rows.pop(0)], self._builder(as_))[0]
 
-        self.model_cls_1 = model_cls_1
-        table_name_1 = model_cls_1.Meta.table
-        self.fields_1 = [f for f in dir(model_cls_1) if not f.startswith(
-            '__') and issubclass(type(getattr(model_cls_1, f)), BaseField)]
-        # Add id to the list of fields
-        self.fields_1 += ['id']
+    def fetchall(self, as_: str = None):
+        if self._rows is None:
+            return super().fetchall(as_)
+        rows, self._rows = self._rows, []
+        if as_ in ('columns', 'numpy'):
+            batches = iter((rows, ))
+            objs = self._columnar(lambda: next(batches, []), as_)
+        else:
+            objs = self._results(lambda: rows, self._builder(as_))
+        self._end_event()
+        return objs
 
-        if model_cls_2 is not None:
-            self.model_cls_2 = model_cls_2
-            table_name_2 = model_cls_2.Meta.table
-            self.fields_2 = [f for f in dir(model_cls_2) if not f.startswith('__')
-                             and issubclass(type(getattr(model_cls_2, f)), BaseField)]
-            self.fields_2 += ['id']
+    def fetchmany(self, size, as_: str = None):
+        if self._rows is None:
+            return super().fetchmany(size, as_)
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return self._results(lambda: rows, self._builder(as_))
+
+
+class Aggregate(Query):
+    operation = 'aggregate'
+
+    def __init__(self, model_cls, columns, where: Union[str, Expression]=None,
+                 group_by: Sequence=None, having: Union[str, Expression]=None,
+                 as_dict: bool=False, primary: bool=False) -> None:
+        """ SELECT query of aggregates, computed by the server, e.g.
+            Aggregate(Student, {'age': Student.c.age, 'students': 'count(*)'},
+                      group_by=['age'], having='count(*) > %s')
+        Results are plain tuples (or dicts), not model objects.
+        Args:
+            columns: the selected expressions (SQL strings or columns), or {name: expression}
+            where: the WHERE clause, like in Select
+            group_by: the GROUP BY expressions (SQL strings or columns)
+            having: the HAVING clause, a SQL string or an expression.
+                Values given to `execute` are the ones of `where`, then of `having`
+            as_dict: fetch dicts, keyed by the names of `columns`, instead of tuples
+            primary: read from the primary even if there are read replicas"""
+        super().__init__(model_cls)
+        self.primary = primary
+        if not isinstance(columns, dict):
+            columns = OrderedDict((_sql(c), c) for c in columns)
+        self.fields = tuple(columns)
+        self.stmt = 'SELECT ' + ','.join(
+            _sql(c) + ('' if name == _sql(c) else ' AS ' + name)
+            for name, c in columns.items()) + ' FROM ' + model_cls.Meta.table
+        where_sql, values = _condition(where)
+        if where_sql is not None:
+            self.stmt += ' WHERE ' + where_sql
+        if group_by:
+            self.stmt += ' GROUP BY ' + ','.join(_sql(c) for c in group_by)
+        having_sql, having_values = _condition(having)
+        if having_sql is not None:
+            self.stmt += ' HAVING ' + having_sql
+        values = values + having_values
+        if values:
+            self.values = values
+        if as_dict:
+            names = self.fields
+            self._hydrate = lambda row: dict(zip(names, row))
         else:
-            self.model_cls_2 = None
-            self.fields_2 = []
-
-        self.stmt = 'SELECT ' + \
-            ','.join([table_name_0 + '.' + f for f in self.fields_0] +
-                     [table_name_1 + '.' + f for f in self.fields_1] +
-                     [table_name_2 + '.' + f for f in self.fields_2]) + \
-            ' FROM ' + table_name_0 + \
-            ' ' + join_type_0 + ' ' + table_name_1
-        if on_clause_0 is not None:
-            self.stmt = self.stmt + ' ON ' + on_clause_0
+            self._hydrate = tuple
+
+
+class Join(Query):
+    operation = 'join'
+
+    def __init__(self, model_cls_0, join_type_0=None, model_cls_1=None, on_clause_0=None,
+                 join_type_1=None, model_cls_2=None, on_clause_1=None,
+                 primary: bool=False, identity: bool=False) -> None:
+        """ Join query of any number of tables, chain `join()` to add them:
+            Join(Student).join('INNER JOIN', Car, Student.c.id == Car.c.owner_id) \\
+                         .join('LEFT JOIN', Product, 'students.id = products.owner_id')
+        The first tables can also be given as arguments:
+            Join(Student, 'INNER JOIN', Car, 'students.id = cars.owner_id')
+        Every result is a tuple holding one object per table.
+        Args:
+            primary: read from the primary even if there are read replicas
+            identity: in a result set, a row of a table is built once: results which share
+                it (e.g. a student joined to its cars) hold the same object.
+                Tables missing from a row (outer joins) are None."""
+        super().__init__(model_cls_0)
+        self.primary = primary
+        self.identity = identity
+        # [(model class, JOIN clause, index of the parent table, attribute in the parent)]
+        self._tables = [(model_cls_0, '', None, None)]  # type: list
+        self._where = None  # type: Any
+        self._join_values = []  # type: list
+        if model_cls_1 is not None:
+            self.join(join_type_0, model_cls_1, on_clause_0)
         if model_cls_2 is not None:
-            self.stmt += ' ' + join_type_1 + ' ' + table_name_2
-            self.stmt += ' ON ' + on_clause_1
+            self.join(join_type_1, model_cls_2, on_clause_1)
+        self._build()
 
-    def fetchone(self):
-        row = self.cur.fetchone()
-        if row is None:
-            return None
-        ret_0 = self.model_cls_0()
-        ret_1 = self.model_cls_1()
+    def join(self, join_type: str, model_cls, on_clause=None, parent=None, attr: str=None):
+        """ Join the table of `model_cls`. Call it before `order_by()`.
+        Args:
+            join_type: 'INNER JOIN', 'LEFT JOIN', etc.
+            on_clause: the ON clause, a SQL string or an expression
+            parent, attr: for `fetch_graph()`, the objects of `model_cls` are listed in the
+                `attr` attribute (default: the table name) of the `parent` objects (default:
+                the first model)"""
+        on_sql, on_values = _condition(on_clause)
+        clause = ' ' + join_type + ' ' + model_cls.Meta.table
+        if on_sql is not None:
+            clause += ' ON ' + on_sql
+        self._join_values.extend(on_values)
+        parent_index = 0 if parent is None else [t[0] for t in self._tables].index(parent)
+        self._tables.append((model_cls, clause, parent_index, attr or model_cls.Meta.table))
+        self._build()
+        return self
 
-        for i, f in enumerate(self.fields_0):
-            setattr(ret_0, f, row[i])
+    def where(self, condition):
+        """ Add the WHERE clause, a SQL string with %s placeholders for the values given
+        to `execute` (after the ones of the ON expressions), or an expression.
+        Call it before `order_by()`."""
+        self._where = condition
+        self._build()
+        return self
 
-        len_0 = len(self.fields_0)
-        for i, f in enumerate(self.fields_1):
-            setattr(ret_1, f, row[i + len_0])
+    def _build(self):
+        # Qualified, e.g. 'cars.id'
+        self.fields = tuple(model_cls.Meta.table + '.' + f
+                            for model_cls, _, _, _ in self._tables
+                            for f in model_cls._schema.select_columns)
+        self.stmt = 'SELECT ' + ','.join(self.fields) + \
+            ' FROM ' + ''.join(model_cls.Meta.table if i == 0 else clause
+                               for i, (model_cls, clause, _, _) in enumerate(self._tables))
+        values = list(self._join_values)
+        where_sql, where_values = _condition(self._where)
+        if where_sql is not None:
+            self.stmt += ' WHERE ' + where_sql
+            values.extend(where_values)
+        self.values = values or None
 
-        if self.model_cls_2 is None:
-            return ret_0, ret_1
+        # (hydrate, position of the id) per table
+        self._parts = []
+        offset = 0
+        for model_cls, _, _, _ in self._tables:
+            columns = model_cls._schema.select_columns
+            self._parts.append((model_cls._schema.hydrator(offset=offset),
+                                offset + len(columns) - 1))
+            offset += len(columns)
+        hydrators = [hydrate for hydrate, _ in self._parts]
+        if self.identity:
+            self._identities = {}
+            self._hydrate = self._hydrate_identity
         else:
-            ret_2 = self.model_cls_2()
-            len_1 = len(self.fields_1)
-            for i, f in enumerate(self.fields_2):
-                setattr(ret_2, f, row[i + len_0 + len_1])
-            return ret_0, ret_1, ret_2
+            self._hydrate = lambda row: tuple(hydrate(row) for hydrate in hydrators)
 
-    def fetchmany(self, size):
-        # Set cursor's array size for better performance
-        # See more here: http://initd.org/psycopg/docs/cursor.html#cursor.fetchmany
-        self.cur.arraysize = size
-        rows = self.cur.fetchmany()
-        ret = []
-        for row in rows:
-            r_0 = self.model_cls_0()
-            r_1 = self.model_cls_1()
+    def execute(self, values: Tuple = None):
+        # A new result set
+        self._identities = {}
+        super().execute(values)
 
-            for i, f in enumerate(self.fields_0):
-                setattr(r_0, f, row[i])
+    async def aexecute(self, values: Tuple = None):
+        self._identities = {}
+        await super().aexecute(values)
 
-            len_0 = len(self.fields_0)
-            for i, f in enumerate(self.fields_1):
-                setattr(r_1, f, row[i + len_0])
+    def _hydrate_identity(self, row, identities=None, created=None):
+        """ Build the objects of `row` which are not in `identities` yet, append them to
+        `created`. Return the tuple of the objects of the row"""
+        if identities is None:
+            identities = self._identities
+        objs = []
+        for i, (hydrate, id_index) in enumerate(self._parts):
+            id = row[id_index]
+            if id is None:
+                objs.append(None)
+                continue
+            obj = identities.get((i, id))
+            if obj is None:
+                obj = identities[(i, id)] = hydrate(row)
+                if created is not None:
+                    created.append((i, obj))
+            objs.append(obj)
+        return tuple(objs)
 
-            if self.model_cls_2 is None:
-                ret.append((r_0, r_1))
-            else:
-                r_2 = self.model_cls_2()
-                len_1 = len(self.fields_1)
-                for i, f in enumerate(self.fields_2):
-                    setattr(r_2, f, row[i + len_0 + len_1])
-                ret.append((r_0, r_1, r_2))
-        return ret
-
-    def fetchall(self):
-        rows = self.cur.fetchall()
-        ret = []
-        for row in rows:
-            r_0 = self.model_cls_0()
-            r_1 = self.model_cls_1()
+    def fetch_graph(self):
+        """ Return the objects of the first table, each built once, with the objects of
+        the other tables listed in their parent, see `join()`:
+            students = Join(Student).join('LEFT JOIN', Car, ...).fetch_graph()
+            students[0].cars  # [Car, ...]"""
+        graph = _Graph(self)
+        self._results(self.cur.fetchall, graph.add)
+        self._end_event()
+        return graph.roots
 
-            for i, f in enumerate(self.fields_0):
-                setattr(r_0, f, row[i])
+    def iter_graph(self, values: Tuple = None, batch_size: int = 2000):
+        """ Streaming version of `fetch_graph()`, on a server-side cursor: yield every object
+        of the first table, with its related objects, once all of them are read.
+        The rows must be ordered by the first table, e.g. `.order_by('students.id')`"""
+        graph = _Graph(self)
+        batches = self._iter_batches(values, batch_size)
+        try:
+            for rows in batches:
+                for row in rows:
+                    if graph.roots and row[self._parts[0][1]] != graph.roots[-1].id:
+                        yield graph.roots[-1]
+                        # Only keep the objects of the current root
+                        graph = _Graph(self)
+                    graph.add(row)
+            if graph.roots:
+                yield graph.roots[-1]
+        finally:
+            batches.close()
 
-            len_0 = len(self.fields_0)
-            for i, f in enumerate(self.fields_1):
-                setattr(r_1, f, row[i + len_0])
 
-            if self.model_cls_2 is None:
-                ret.append((r_0, r_1))
-            else:
-                r_2 = self.model_cls_2()
-                len_1 = len(self.fields_1)
-                for i, f in enumerate(self.fields_2):
-                    setattr(r_2, f, row[i + len_0 + len_1])
-                ret.append((r_0, r_1, r_2))
-        return ret
+class _Graph:
+    """ Objects of a Join, linked to their parents"""
+
+    def __init__(self, join):
+        self.join = join
+        self.roots = []
+        self.identities = {}
+        # (index of the parent table, parent id, index of the table, id) already linked
+        self.links = set()
+
+    def add(self, row):
+        join = self.join
+        created = []
+        objs = join._hydrate_identity(row, self.identities, created)
+        for i, obj in created:
+            # The lists of the children of the new objects
+            for model_cls, _, parent_index, attr in join._tables[1:]:
+                if parent_index == i:
+                    obj.__dict__[attr] = []
+            if i == 0:
+                self.roots.append(obj)
+        for i, (model_cls, _, parent_index, attr) in enumerate(join._tables):
+            obj = objs[i]
+            if i == 0 or obj is None or objs[parent_index] is None:
+                continue
+            link = (parent_index, objs[parent_index].id, i, obj.id)
+            if link not in self.links:
+                self.links.add(link)
+                objs[parent_index].__dict__[attr].append(obj)
@@ -12,8 +12,11 @@ setup(
     download_url='https://github.com/nguyendv/postgrespy/archive/' + os.environ['POSTGRESPY_VERSION'] +'.tar.gz',
     install_requires=[
         'psycopg2>=2.7',
-        'Jinja2>=2.9'
     ],
+    extras_require={
+        # Query.fetchall(as_='numpy')
+        'numpy': ['numpy'],
+    },
     python_requires='~=3.6',
     keywords=[],
     classifiers=[]
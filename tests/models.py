@@ -1,5 +1,6 @@
 from postgrespy.models import Model
-from postgrespy.fields import TextField, IntegerField, BooleanField, JsonBField, ArrayField, DateTimeField
+from postgrespy.fields import TextField, IntegerField, BooleanField, JsonBField, ArrayField, DateTimeField, \
+    EnumField
 
 class Student(Model):
     name = TextField()
@@ -39,6 +40,7 @@ class Movie(Model):
 class Entry(Model):
     body = TextField()
     updated = DateTimeField()
+    mood = EnumField()
 
     class Meta:
         table = 'entries'
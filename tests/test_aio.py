@@ -0,0 +1,79 @@
+""" Contain tests for the asyncio API, see postgrespy/aio.py"""
+
+import asyncio
+from unittest import TestCase
+
+from postgrespy import UniqueViolatedError
+from postgrespy.aio import get_async_pool
+from postgrespy.queries import Select, Join
+
+from .models import Student, Car
+
+
+class AsyncTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        for student in Student.fetchall():
+            student.delete()
+        get_async_pool().closeall()
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_crud(self):
+        async def crud():
+            tom = await Student.ainsert(name='Tom', age=20)
+            await tom.aupdate(age=21)
+            still_tom = await Student.afetchone(id=tom.id)
+            assert still_tom.name == 'Tom' and still_tom.age == 21
+            await Car.ainsert(name='Toyota', owner_id=tom.id)
+
+            cars = await Join(Student, 'INNER JOIN', Car,
+                              'students.id = cars.owner_id').afetchall()
+            assert [(s.name, c.name) for s, c in cars] == [('Tom', 'Toyota')]
+
+            assert await Student.acount(name='Tom') == 1
+            assert await Student.aexists(Student.c.age > 20)
+
+            await tom.adelete()
+            assert await Student.afetchone(id=tom.id) is None
+
+        self.run_async(crud())
+
+    def test_unique_violated(self):
+        async def insert_twice():
+            tom = await Student.ainsert(name='Tom')
+            await Student.ainsert(id=tom.id, name='Tom')
+
+        with self.assertRaises(UniqueViolatedError):
+            self.run_async(insert_twice())
+
+    def test_concurrency(self):
+        pool = get_async_pool()
+
+        async def concurrent():
+            await asyncio.gather(*[Student.ainsert(name='Student %d' % i, age=i)
+                                   for i in range(pool.maxconn * 3)])
+            select = Select(Student, 'age < %s')
+            select.order_by('age')
+            students = await select.afetchall((5, ))
+            assert [s.age for s in students] == [0, 1, 2, 3, 4]
+
+            ages = []
+            async for student in Student.aiter(batch_size=4):
+                ages.append(student.age)
+            assert sorted(ages) == list(range(pool.maxconn * 3))
+            rows = [row async for row in Select(Student, 'age < %s').aiter((2, ), 4, 'dict')]
+            assert sorted(row['age'] for row in rows) == [0, 1]
+
+            # Close the stream early, the connection must go back to the pool
+            stream = Student.aiter(batch_size=2)
+            await stream.__anext__()
+            await stream.aclose()
+            assert not pool._waiters
+            assert len(pool._idle) == pool._size
+
+        self.run_async(concurrent())
@@ -0,0 +1,247 @@
+""" Contain tests for bulk operations of postgrespy.models.Model"""
+
+import io
+from datetime import datetime
+from decimal import Decimal
+from unittest import TestCase
+
+from psycopg2 import DatabaseError, errorcodes
+
+from postgrespy.cache import statement_cache
+
+from .models import Student, Movie, Entry
+
+
+class InsertManyTestCase(TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        for student in Student.fetchall():
+            student.delete()
+        for movie in Movie.fetchall():
+            movie.delete()
+
+    def test_insert_many_returning(self):
+        students = Student.insert_many([{'name': 'Student %d' % i, 'age': i}
+                                        for i in range(25)], batch_size=10)
+        assert len(students) == 25
+        for i, student in enumerate(students):
+            still_student = Student.fetchone(id=student.id)
+            assert still_student.name == 'Student %d' % i
+            assert still_student.age == i
+
+    def test_insert_many_copy(self):
+        students = Student.insert_many([{'name': 'Tab\there', 'age': 1},
+                                        {'name': 'Back\\slash', 'age': None},
+                                        {'name': 'New\nline', 'is_male': True}],
+                                       returning=False)
+        assert [s.id for s in students] == [None, None, None]
+        assert len(Student.fetchall()) == 3
+        assert Student.fetchone(name='Back\\slash') is not None
+        assert Student.fetchone(name='New\nline').is_male == True
+
+    def test_insert_many_array_of_json(self):
+        rows = [{'name': 'Wonder Woman', 'casts': ['Gal "Diana" Gadot', 'Chris, Pine'],
+                 'earning': [{'country': 'USA', 'amount': 1000}]},
+                {'name': 'Aquaman', 'casts': [],
+                 'earning': [{'country': 'UK', 'amount': 10}]}]
+        Movie.insert_many(rows)
+        Movie.insert_many(rows, returning=False)
+
+        movies = Movie.fetchall(name='Wonder Woman')
+        assert len(movies) == 2
+        for movie in movies:
+            assert movie.casts[0] == 'Gal "Diana" Gadot'
+            assert movie.casts[1] == 'Chris, Pine'
+            assert movie.earning[0]['amount'] == 1000
+
+
+class UpdateDeleteManyTestCase(TestCase):
+    def setUp(self):
+        self.students = Student.insert_many([{'name': 'Student %d' % i, 'age': i}
+                                             for i in range(10)])
+
+    def tearDown(self):
+        Student.delete_where('TRUE')
+        for movie in Movie.fetchall():
+            movie.delete()
+
+    def test_update_where(self):
+        assert Student.update_where('age < %s', (5, ), is_male=True) == 5
+        assert len(Student.fetchall(is_male=True)) == 5
+
+        updated = Student.update_where('name = %s', ('Student 7', ), returning=True,
+                                       age=70, is_male=False)
+        assert [(s.id, s.age) for s in updated] == [(self.students[7].id, 70)]
+
+    def test_delete_where(self):
+        assert Student.delete_where('age >= %s', (8, )) == 2
+        deleted = Student.delete_where('id = %s', (self.students[0].id, ), returning=True)
+        assert [s.name for s in deleted] == ['Student 0']
+        assert len(Student.fetchall()) == 7
+
+    def test_errors(self):
+        # Errors of the caller's SQL are raised as they are
+        calls = [(errorcodes.UNDEFINED_COLUMN,
+                  lambda: Student.update_where('nope = %s', (1, ), age=3)),
+                 (errorcodes.UNDEFINED_COLUMN, lambda: Student.delete_where('nope = %s', (1, ))),
+                 (errorcodes.INVALID_TEXT_REPRESENTATION,
+                  lambda: Student.update_many([(self.students[0].id, {'age': 'ten'})])),
+                 (errorcodes.INVALID_COLUMN_REFERENCE,
+                  lambda: Student.upsert(conflict_columns=['name'], name='Tom'))]
+        for pgcode, call in calls:
+            with self.assertRaises(DatabaseError) as cm:
+                call()
+            assert cm.exception.pgcode == pgcode
+        assert Student.count(name='Tom') == 0
+
+    def test_update_many(self):
+        updates = [(s.id, {'age': s.age * 10}) for s in self.students[:6]]
+        updates.insert(3, (self.students[9].id, {'name': None, 'is_male': True}))
+        assert Student.update_many(updates, batch_size=2) == 7
+        assert [s.age for s in Student.fetch_by_ids(s.id for s in self.students[:6])] == \
+            [0, 10, 20, 30, 40, 50]
+        nine = Student.fetchone(id=self.students[9].id)
+        assert nine.is_male == True and nine.__dict__.get('name') is None
+
+        updated = Student.update_many([(self.students[8].id, {'age': 80})], returning=True)
+        assert updated[0].age == 80 and updated[0].name == 'Student 8'
+
+    def test_update_many_array_of_json(self):
+        movie = Movie.insert(name='Aquaman', casts=[], earning=[{'country': 'UK', 'amount': 10}])
+        Movie.update_many([(movie.id, {'casts': ['Jason Momoa'],
+                                       'earning': [{'country': 'USA', 'amount': 20}]})])
+        movie = Movie.fetchone(id=movie.id)
+        assert movie.casts[0] == 'Jason Momoa'
+        assert movie.earning[0]['amount'] == 20
+
+    def test_catalog_types_kept(self):
+        Student.update_many([(self.students[0].id, {'age': 1})])
+        types = Student._schema.sql_types
+        assert types['age'] == 'integer'
+        # Evicting the statements doesn't read the catalog again
+        statement_cache.clear()
+        Student.update_many([(self.students[0].id, {'age': 2})])
+        assert Student._schema.sql_types is types
+
+
+class UpsertTestCase(TestCase):
+    def tearDown(self):
+        Student.delete_where('TRUE')
+        for movie in Movie.fetchall():
+            movie.delete()
+
+    def test_upsert(self):
+        tom = Student.insert(name='Tom', age=20)
+        still_tom = Student.upsert(('id', ), id=tom.id, name='Tom', age=21)
+        assert still_tom.id == tom.id and still_tom.age == 21
+        assert Student.fetchone(id=tom.id).age == 21
+
+        # Only `age` is updated
+        Student.upsert(('id', ), ('age', ), id=tom.id, name='Thomas', age=22)
+        tom = Student.fetchone(id=tom.id)
+        assert tom.name == 'Tom' and tom.age == 22
+
+        assert Student.upsert(('id', ), (), id=tom.id, name='Thomas') is None
+        assert Student.fetchone(id=tom.id).name == 'Tom'
+
+        jerry = Student.upsert(('id', ), name='Jerry')
+        assert Student.fetchone(id=jerry.id).name == 'Jerry'
+
+    def test_upsert_many(self):
+        tom = Student.insert(name='Tom', age=20)
+        jerry = Student.insert(name='Jerry', age=10)
+        upserted = Student.upsert_many([{'id': tom.id, 'name': 'Tom', 'age': 21},
+                                        {'id': tom.id, 'name': 'Tom', 'age': 22},
+                                        {'id': jerry.id + 100, 'name': 'Spike', 'age': 5},
+                                        {'id': jerry.id, 'name': 'Jerry', 'age': 11}],
+                                       ('id', ), batch_size=3)
+        assert [s.id for s in upserted] == [tom.id, tom.id, jerry.id + 100, jerry.id]
+        assert Student.fetchone(id=tom.id).age == 22
+        assert Student.fetchone(id=jerry.id).age == 11
+        assert len(Student.fetchall()) == 3
+
+        skipped = Student.upsert_many([{'id': tom.id, 'name': 'Thomas'},
+                                       {'id': tom.id + 1000, 'name': 'Tyke'}], ('id', ), ())
+        assert skipped[0].id is None and skipped[1].id == tom.id + 1000
+        assert Student.fetchone(id=tom.id).name == 'Tom'
+
+        # Rows are matched on their conflict values as stored, not as given
+        upserted = Student.upsert_many([{'id': str(tom.id), 'name': 'Tom', 'age': 23},
+                                        {'id': tom.id, 'name': 'Tom', 'age': 24}], ('id', ))
+        assert [s.id for s in upserted] == [tom.id, tom.id]
+        assert Student.fetchone(id=tom.id).age == 24
+
+    def test_upsert_array_of_json(self):
+        movie = Movie.upsert(('id', ), name='Aquaman', earning=[{'country': 'UK', 'amount': 10}])
+        Movie.upsert_many([{'id': movie.id, 'earning': [{'country': 'USA', 'amount': 20}]}],
+                          ('id', ))
+        assert Movie.fetchone(id=movie.id).earning[0]['amount'] == 20
+
+
+class CopyTestCase(TestCase):
+    def tearDown(self):
+        Student.delete_where('TRUE')
+        Movie.delete_where('TRUE')
+        Entry.delete_where('TRUE')
+
+    def test_round_trip(self):
+        Student.insert_many([{'name': 'Student %d' % i, 'age': i, 'is_male': i % 2 == 0}
+                             for i in range(50)])
+        for format in ('binary', 'csv', 'text'):
+            f = io.BytesIO()
+            assert Student.copy_to(f, format=format, size=64) == 50
+            if format == 'csv':
+                assert f.getvalue().startswith(b'name,age,is_male,id\n')
+            before = [(s.id, s.name, s.age, s.is_male) for s in Student.fetchall()]
+            Student.delete_where('TRUE')
+            f.seek(0)
+            assert Student.copy_from(f, format=format, size=64) == 50
+            after = [(s.id, s.name, s.age, s.is_male) for s in Student.fetchall()]
+            assert sorted(after) == sorted(before)
+
+        # The id sequence was moved past the imported ids
+        assert Student.insert(name='New').id > max(id for id, _, _, _ in after)
+
+        f = io.BytesIO()
+        assert Student.copy_to(f, Student.c.age < 5, format='csv', columns=('name', )) == 5
+        assert f.getvalue().splitlines()[1:] == [b'Student %d' % i for i in range(5)]
+
+    def test_iterable(self):
+        rows = ({'name': 'Student %d' % i, 'age': i if i else None} for i in range(1000))
+        assert Student.copy_from(rows, size=128) == 1000
+        assert Student.count() == 1000
+        assert Student.count(Student.c.age.is_null()) == 1
+        assert Student.copy_from([]) == 0
+        assert Student.copy_from([('Tuple', 3)], columns=('name', 'age')) == 1
+        assert Student.fetchone(name='Tuple').age == 3
+
+        now = datetime(2018, 1, 2, 3, 4, 5, 6)
+        Entry.copy_from([{'body': 'ABC', 'updated': now}])
+        assert Entry.fetchone(body='ABC').updated == now
+
+        Movie.copy_from([{'name': 'Wonder Woman', 'casts': ['Gal Gadot', None, 'Chris, Pine'],
+                          'earning': [{'country': 'USA', 'amount': 1000}], 'trivia': []}])
+        movie = Movie.fetchone(name='Wonder Woman')
+        assert movie.casts == ['Gal Gadot', None, 'Chris, Pine']
+        assert movie.earning[0]['amount'] == 1000
+        assert movie.trivia == []
+
+    def test_iterable_text_fallback(self):
+        Entry.copy_from([{'body': 'Happy', 'mood': 'happy'}])
+        assert Entry.fetchone(body='Happy').mood == 'happy'
+        # numeric has no binary encoding: the rows are sent in the text format
+        Entry.copy_from([('Rated', 'ok', Decimal('4.5'))], columns=('body', 'mood', 'rating'))
+        f = io.BytesIO()
+        Entry.copy_to(f, format='csv', columns=('body', 'rating'))
+        assert f.getvalue().splitlines()[1:] == [b'Happy,', b'Rated,4.5']
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            Student.copy_to(io.BytesIO(), format='xml')
+        with self.assertRaises(Exception):
+            Student.copy_from([{'name': 'Tom', 'age': 'twenty'}])
+        with self.assertRaisesRegex(ValueError, 'Unknown columns of students: grade'):
+            Student.copy_from([{'name': 'Tom', 'grade': 3}])
+        assert Student.count() == 0
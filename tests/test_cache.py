@@ -0,0 +1,147 @@
+""" Contain tests for the row cache of postgrespy.cache"""
+
+import time
+from unittest import TestCase
+
+from unittest import mock
+
+from postgrespy import models, transaction
+from postgrespy.cache import RowCache
+from postgrespy.db import get_conn_cur, close, get_pool
+from postgrespy.fields import TextField, IntegerField, BooleanField, JsonBField
+from postgrespy.models import Model
+from postgrespy.queries import Select
+
+
+class CachedStudent(Model):
+    name = TextField()
+    age = IntegerField()
+    is_male = BooleanField()
+
+    class Meta:
+        table = 'students'
+        cache = RowCache(maxsize=2, ttl=60, channel='postgrespy_test_cache')
+
+
+class CachedProduct(Model):
+    name = TextField()
+    owner_id = IntegerField()
+    detail = JsonBField()
+
+    class Meta:
+        table = 'products'
+        cache = RowCache(maxsize=2, ttl=60)
+
+
+class RowCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = CachedStudent.Meta.cache
+        self.cache.clear()
+        self.tom = CachedStudent.insert(name='Tom', age=20)
+
+    def tearDown(self):
+        for student in CachedStudent.fetchall():
+            student.delete()
+
+    def test_read_through(self):
+        assert CachedStudent.fetchone(id=self.tom.id).name == 'Tom'
+        checkouts = get_pool().stats()['checkouts']
+        tom = CachedStudent.fetchone(id=self.tom.id)
+        assert tom.name == 'Tom' and tom.age == 20 and tom.id == self.tom.id
+        with Select(CachedStudent, 'id = %s') as select:
+            select.execute((self.tom.id, ))
+            assert select.fetchall()[0].name == 'Tom'
+        # Served without a connection
+        assert get_pool().stats()['checkouts'] == checkouts
+        assert self.cache.info()['hits'] == 2
+        assert self.cache.info()['misses'] == 1
+        assert CachedStudent.fetchone(id=self.tom.id + 1000) is None
+
+    def test_invalidation(self):
+        tom = CachedStudent.fetchone(id=self.tom.id)
+        tom.update(age=21)
+        assert self.cache.info()['evictions'] == 1
+        assert CachedStudent.fetchone(id=self.tom.id).age == 21
+
+        with transaction():
+            tom.update(age=22)
+            # Rows read inside a transaction are not cached
+            assert CachedStudent.fetchone(id=self.tom.id).age == 22
+            assert len(self.cache) == 0
+        assert CachedStudent.fetchone(id=self.tom.id).age == 22
+
+        tom.delete()
+        assert CachedStudent.fetchone(id=self.tom.id) is None
+
+    def test_private_rows(self):
+        meth = CachedProduct.insert(name='meth', owner_id=self.tom.id, detail={'a': 1})
+        CachedProduct.fetchone(id=meth.id).detail['a'] = 999
+        cached = CachedProduct.fetchone(id=meth.id)
+        assert cached.detail == {'a': 1}
+        cached.detail['a'] = 2
+        assert cached.changes() == {'detail': {'a': 2}}
+        assert CachedProduct.fetch_by_ids([meth.id])[0].detail == {'a': 1}
+        assert CachedProduct.Meta.cache.info()['hits'] == 2
+
+    def test_str_id(self):
+        assert CachedStudent.fetchone(id=str(self.tom.id)).age == 20
+        assert CachedStudent.fetchone(id=str(self.tom.id)).age == 20
+        assert self.cache.info()['hits'] == 1
+        self.tom.update(age=21)
+        assert CachedStudent.fetchone(id=str(self.tom.id)).age == 21
+
+    def test_evict_after_commit(self):
+        commit = models.commit
+
+        def slow_commit(conn):
+            # Another reader caches the row before the write is committed
+            CachedStudent.fetchone(id=self.tom.id)
+            commit(conn)
+
+        with mock.patch.object(models, 'commit', slow_commit):
+            self.tom.update(age=21)
+            CachedStudent.update_where('id = %s', (self.tom.id, ), age=22)
+        assert CachedStudent.fetchone(id=self.tom.id).age == 22
+
+    def test_bulk_invalidation(self):
+        CachedStudent.fetchone(id=self.tom.id)
+        assert CachedStudent.update_where('name = %s', ('Tom', ), age=30) == 1
+        assert CachedStudent.fetchone(id=self.tom.id).age == 30
+        CachedStudent.update_many([(self.tom.id, {'age': 31})])
+        assert CachedStudent.fetchone(id=self.tom.id).age == 31
+        assert CachedStudent.delete_where('age = %s', (31, )) == 1
+        assert CachedStudent.fetchone(id=self.tom.id) is None
+
+    def test_expiration(self):
+        self.cache.ttl = 0
+        try:
+            CachedStudent.fetchone(id=self.tom.id)
+            time.sleep(0.01)
+            CachedStudent.fetchone(id=self.tom.id)
+            assert self.cache.info()['expirations'] == 1
+            assert self.cache.info()['hits'] == 0
+        finally:
+            self.cache.ttl = 60
+
+    def test_listen(self):
+        other = RowCache(channel='postgrespy_test_cache')
+        other.listen()
+        try:
+            other.set_row('students', int(self.tom.id), ('Tom', 20, None, self.tom.id))
+            tom = CachedStudent.fetchone(id=self.tom.id)
+            tom.update(age=21)
+            deadline = time.monotonic() + 5
+            while len(other) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert len(other) == 0 and other.evictions == 1
+
+            # Notifications of writes which are rolled back are not delivered
+            other.set_row('students', int(self.tom.id), ('Tom', 20, None, self.tom.id))
+            conn, cur = get_conn_cur()
+            cur.execute('SELECT pg_notify(%s, %s)', ('postgrespy_test_cache', 'students:1'))
+            conn.rollback()
+            close(conn, cur)
+            time.sleep(0.1)
+            assert len(other) == 1
+        finally:
+            other.stop_listening()
@@ -0,0 +1,61 @@
+""" Contain tests for the expressions of postgrespy.expressions"""
+
+from unittest import TestCase
+
+from postgrespy.cache import statement_cache
+from postgrespy.expressions import or_
+from postgrespy.queries import Select
+
+from .models import Student, Product
+
+
+class ExpressionTestCase(TestCase):
+    def setUp(self):
+        self.tom = Student.insert(name='Tom', age=20, is_male=True)
+        self.jerry = Student.insert(name='Jerry', age=10)
+        self.anna = Student.insert(name='Anna', age=30, is_male=False)
+        self.weed = Product.insert(name='weed', owner_id=self.tom.id,
+                                   detail={'color': 'green', 'size': 1})
+        self.book = Product.insert(name='book', owner_id=self.tom.id, detail={'color': 'red'})
+
+    def tearDown(self):
+        Student.delete_where('TRUE')
+
+    def names(self, students):
+        return sorted(s.name for s in students)
+
+    def test_compile(self):
+        c = Student.c
+        sql, values = ((c.age >= 18) & (c.name.in_(['Tom', 'Anna']) | c.is_male.is_null())).compile()
+        assert sql == '(students.age >= %s AND (students.name = ANY(%s) OR students.is_male IS NULL))'
+        assert values == [18, ['Tom', 'Anna']]
+        assert (c.name == None).compile() == ('students.name IS NULL', [])
+        assert (~(c.age < 3)).compile() == ('NOT students.age < %s', [3])
+        assert (c.id == Product.c.owner_id).compile() == ('students.id = products.owner_id', [])
+
+        # Same shape, other values: the SQL text comes from the cache
+        hits = statement_cache.hits
+        assert ((c.age >= 21) & (c.name.in_([]) | c.is_male.is_null())).compile()[1] == [21, []]
+        assert statement_cache.hits == hits + 1
+
+        with self.assertRaises(AttributeError):
+            c.nope
+
+    def test_select(self):
+        c = Student.c
+        with Select(Student, (c.age > 15) & (c.is_male != True)) as select:
+            select.execute()
+            assert self.names(select.fetchall()) == ['Anna']
+        assert self.names(Student.fetchall(c.name.in_(['Tom', 'Jerry']))) == ['Jerry', 'Tom']
+        assert self.names(Student.fetchall(c.is_male.is_null())) == ['Jerry']
+        assert self.names(Student.fetchall(or_(c.age < 15, c.age > 25))) == ['Anna', 'Jerry']
+        assert self.names(Student.fetchall(c.name.like('%o%'), age=20)) == ['Tom']
+        assert Student.fetchone(c.age > 100) is None
+        assert len(Student.fetchmany(2, c.age >= 10)) == 2
+        assert Student.update_where(c.age < 15, age=11) == 1
+        assert Student.fetchone(id=self.jerry.id).age == 11
+
+    def test_contains(self):
+        greens = Product.fetchall(Product.c.detail.contains({'color': 'green'}))
+        assert [p.name for p in greens] == ['weed']
+        assert Product.fetchall(Product.c.detail.contains({'color': 'blue'})) == []
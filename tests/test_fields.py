@@ -27,6 +27,9 @@ class ArrayFieldTestCase(TestCase):
         still_wonder_woman = Movie.fetchone(name="Wonder Woman")
         assert len(still_wonder_woman.casts) == 2
         assert still_wonder_woman.casts[1] == "Chris Pine"
+        # Values are plain lists: they can be iterated more than once
+        assert list(still_wonder_woman.casts) == list(still_wonder_woman.casts) == \
+            ["Gal Gadot", "Chris Pine"]
 
 
 class ArrayOfJsonTestCase(TestCase):
@@ -106,7 +109,7 @@ class DateTimeFieldTestCase(TestCase):
         abc = Entry.insert(body="ABC", updated=now)
 
         still_abc = Entry.fetchone(id=abc.id)
-        updated = still_abc.updated.value
+        updated = still_abc.updated
 
         assert updated.year == now.year and \
             updated.month == now.month and \
@@ -147,7 +150,7 @@ class JsonBTestCase(TestCase):
         assert(self.meth.detail['color'] == 'red')
         new_detail = self.meth.detail
         new_detail['price'] = 5
-        self.meth.update(detail=new_detail.value)
+        self.meth.update(detail=new_detail)
 
         meth2 = Product.fetchone(id=self.meth.id)
         assert(meth2.detail['price'] == 5)
@@ -0,0 +1,136 @@
+""" Contain tests for postgrespy.instrumentation"""
+
+import asyncio
+import time
+from unittest import TestCase, mock
+
+from postgrespy.aio import get_async_pool
+from postgrespy.db import settings
+from postgrespy.pool import ConnectionPool
+from postgrespy.instrumentation import add_listener, remove_listener, fingerprint, \
+    Listener, SlowQueryLogger, Histogram, ExplainSampler
+from postgrespy.queries import Select
+
+from .models import Student
+
+
+class Recorder(Listener):
+    def __init__(self):
+        self.started = []
+        self.events = []
+
+    def before(self, event):
+        self.started.append(event)
+
+    def after(self, event):
+        self.events.append(event)
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.recorder = add_listener(Recorder())
+
+    def tearDown(self):
+        remove_listener(self.recorder)
+        Student.delete_where('TRUE')
+
+    def test_events(self):
+        tom = Student.insert(name='Tom', age=20)
+        Student.insert_many([{'name': 'Student %d' % i, 'age': i} for i in range(10)])
+        tom.update(age=21)
+        assert len(Student.fetchall(Student.c.age < 5)) == 5
+        with Select(Student, 'age >= %s') as select:
+            select.execute((5, ))
+            select.fetchone()
+            select.fetchmany(2)
+        assert len(list(Student.iter(batch_size=4))) == 11
+        tom.delete()
+
+        events = self.recorder.events
+        assert events == self.recorder.started
+        assert [e.operation for e in events] == \
+            ['insert', 'insert_many', 'update', 'select', 'select', 'select', 'delete']
+        assert [e.rows for e in events] == [1, 10, 1, 5, 3, 11, 1]
+        assert [e.model_cls for e in events] == [Student] * 7
+        assert events[3].params == 1
+        assert events[3].fingerprint == 'SELECT name,age,is_male,id FROM students ' \
+            'WHERE students.age < %s'
+        for event in events:
+            assert event.error is None
+            assert event.total_time >= event.execute_time > 0
+        assert events[5].fetch_time > 0 and events[5].hydrate_time > 0
+        # Connections are taken from the pool before the statements which use them
+        assert events[0].pool_wait > 0
+
+    def test_error(self):
+        with self.assertRaises(Exception):
+            with Select(Student, 'nope = %s') as select:
+                select.execute((1, ))
+        assert self.recorder.events[0].error is not None
+
+    def test_async(self):
+        loop = asyncio.new_event_loop()
+
+        async def run():
+            tom = await Student.ainsert(name='Tom', age=20)
+            await Student.afetchall(id=tom.id)
+            await tom.adelete()
+
+        try:
+            loop.run_until_complete(run())
+        finally:
+            get_async_pool().closeall()
+            loop.close()
+        events = self.recorder.events
+        assert [e.operation for e in events] == ['insert', 'select', 'delete']
+        assert events[1].rows == 1 and events[1].hydrate_time > 0
+
+    def test_fingerprint(self):
+        assert fingerprint("SELECT id FROM t\n  WHERE a = 'x''y' LIMIT 10") == \
+            'SELECT id FROM t WHERE a = ? LIMIT ?'
+
+    def test_listeners(self):
+        slow = add_listener(SlowQueryLogger(threshold=0))
+        histogram = add_listener(Histogram(buckets=(0.001, 10), key=lambda e: e.operation))
+        sampler = add_listener(ExplainSampler(threshold=0, rate=1))
+        try:
+            with self.assertLogs('postgrespy', 'WARNING') as logs:
+                Student.insert(name='Tom', age=20)
+                Student.fetchall(name='Tom')
+            assert len(logs.output) == 2
+            assert 'Slow select of Student' in logs.output[1]
+            assert 'Tom' not in logs.output[1]
+        finally:
+            for listener in (slow, histogram, sampler):
+                remove_listener(listener)
+
+        stats = histogram.stats()
+        assert set(stats) == {'insert', 'select'}
+        assert stats['select']['count'] == 1 and stats['select']['rows'] == 1
+        assert stats['select']['buckets']['inf'] == 1
+        assert stats['select']['buckets'][10] == 1
+        assert histogram.percentile('select', 0.99) in (0.001, 10)
+        assert histogram.percentile('delete', 0.5) is None
+
+        # Only the SELECT is explained
+        assert len(sampler.plans) == 1
+        event, plan = sampler.plans[0]
+        assert event.operation == 'select' and 'actual time' in plan
+
+    def test_sampler_never_waits(self):
+        Student.fetchall()
+        event = self.recorder.events[0]
+        sampler = ExplainSampler(threshold=0, rate=1)
+        pool = ConnectionPool(timeout=2, **settings(minconn=1, maxconn=1))
+        conn = pool.getconn()
+        try:
+            with mock.patch('postgrespy.db.get_pool', return_value=pool):
+                start = time.monotonic()
+                with self.assertLogs('postgrespy', 'INFO') as logs:
+                    sampler.after(event)
+                assert time.monotonic() - start < 1
+            assert 'EXPLAIN skipped' in logs.output[0]
+            assert len(sampler.plans) == 0
+        finally:
+            pool.putconn(conn)
+            pool.closeall()
@@ -0,0 +1,94 @@
+""" Contain tests for the batch loading of postgrespy.loader"""
+
+import asyncio
+from unittest import TestCase
+
+from postgrespy.aio import get_async_pool
+from postgrespy.db import get_pool
+from postgrespy.loader import Loader, prefetch, prefetch_one
+
+from .models import Student, Car
+
+
+class LoaderTestCase(TestCase):
+    def setUp(self):
+        self.students = [Student.insert(name='Student %d' % i, age=i) for i in range(5)]
+        self.ids = [student.id for student in self.students]
+        self.toyota = Car.insert(name='Toyota', owner_id=self.ids[0])
+        self.honda = Car.insert(name='Honda', owner_id=self.ids[0])
+        self.ford = Car.insert(name='Ford', owner_id=self.ids[2])
+        self.bike = Car.insert(name='Bike')
+
+    def tearDown(self):
+        for car in Car.fetchall():
+            car.delete()
+        for student in Student.fetchall():
+            student.delete()
+
+    def checkouts(self):
+        return get_pool().stats()['checkouts']
+
+    def test_fetch_by_ids(self):
+        before = self.checkouts()
+        missing = self.ids[-1] + 1000
+        students = Student.fetch_by_ids([self.ids[3], missing, self.ids[1], self.ids[3]])
+        assert self.checkouts() == before + 1
+        assert [s.name for s in students] == ['Student 3', 'Student 1', 'Student 3']
+        assert students[0] is students[2]
+        assert Student.fetch_by_ids([]) == []
+
+    def test_loader(self):
+        loader = Loader(Student)
+        before = self.checkouts()
+        deferreds = [loader.load(id) for id in self.ids + [self.ids[-1] + 1000]]
+        assert self.checkouts() == before
+        assert [d.get().age for d in deferreds[:-1]] == list(range(5))
+        assert deferreds[-1].get() is None
+        assert self.checkouts() == before + 1
+        # Loaded objects are kept
+        assert loader.load(self.ids[0]).get() is deferreds[0].get()
+        assert loader.load_many(self.ids[1:3]) == [deferreds[1].get(), deferreds[2].get()]
+        assert self.checkouts() == before + 1
+
+    def test_aload(self):
+        loop = asyncio.new_event_loop()
+        loader = Loader(Student)
+        queries = []
+        afetch_by_ids = Student.afetch_by_ids
+
+        async def counting(ids):
+            queries.append(ids)
+            return await afetch_by_ids(ids)
+
+        async def load():
+            return await asyncio.gather(*[loader.aload(id) for id in self.ids])
+
+        Student.afetch_by_ids = counting
+        try:
+            students = loop.run_until_complete(load())
+        finally:
+            del Student.afetch_by_ids
+            get_async_pool().closeall()
+            loop.close()
+        assert [s.id for s in students] == self.ids
+        assert queries == [self.ids]
+
+    def test_prefetch(self):
+        before = self.checkouts()
+        groups = prefetch(self.students, Car, 'owner_id', 'cars')
+        assert self.checkouts() == before + 1
+        assert [c.name for c in self.students[0].cars] == ['Toyota', 'Honda']
+        assert [c.name for c in self.students[2].cars] == ['Ford']
+        assert self.students[1].cars == [] and groups[self.ids[1]] == []
+
+        cars = [self.toyota, self.ford, self.bike]
+        prefetch_one(cars, Student, 'owner_id', 'owner')
+        assert self.checkouts() == before + 2
+        assert cars[0].owner.name == 'Student 0'
+        assert cars[1].owner.name == 'Student 2'
+        assert cars[2].owner is None
+
+        # Deferred foreign keys are loaded first
+        cars = Car.fetchall(Car.c.id.in_([self.toyota.id, self.ford.id]), only=['name'])
+        prefetch_one(cars, Student, 'owner_id', 'owner')
+        assert sorted(c.owner.name for c in cars) == ['Student 0', 'Student 2']
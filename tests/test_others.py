@@ -1,7 +1,20 @@
-from postgrespy.queries import Select, Join
-from postgrespy.fields import IntegerField
+from postgrespy.queries import Select, Join, Aggregate
+from postgrespy.fields import IntegerField, BooleanField
+from postgrespy.cache import statement_cache
+from postgrespy.prepared import use_prepared_statements, prepared_statements
+from postgrespy.db import get_pool
+from postgrespy.instrumentation import add_listener, remove_listener, Listener
 from unittest import TestCase
-from .models import Student, Product, Car
+from .models import Student, Product, Car, Movie
+
+
+class SchemaTestCase(TestCase):
+    def test_schema(self):
+        assert Student._schema.columns == ('name', 'age', 'is_male')
+        assert Student._schema.select_columns == ('name', 'age', 'is_male', 'id')
+        assert Movie._schema.index['casts'] == 2
+        assert Student._schema.field_types['id'] is IntegerField
+        assert Student(name='Tom').fields == {'name', 'age', 'is_male'}
 
 
 class SaveLoadDeleteTestCase(TestCase):
@@ -15,10 +28,10 @@ class SaveLoadDeleteTestCase(TestCase):
 
     def test_save_load_delete(self):
 
-        assert(type(self.peter.age) == IntegerField)
+        assert type(self.peter.age) is int
         assert self.peter.age == 15
 
-        assert(type(self.still_peter.age) == IntegerField)
+        assert type(self.still_peter.age) is int
         self.still_peter.update(age=16)
 
         assert self.still_peter.name == 'Peter'
@@ -52,6 +65,26 @@ class ModelFetchTestCase(TestCase):
         many = Student.fetchmany(2)
         assert len(many) == 2
 
+    def test_hydration(self):
+        thor = Student.fetchone(name='Thor')
+        assert type(thor.age) is int and thor.age == 33
+        assert type(thor.id) is int and thor.id == self.thor.id
+        assert thor.fields == {'name', 'age', 'is_male'}
+        # Values are stored raw, NULL as None
+        assert thor.__dict__['age'] == 33
+        assert thor.is_male is None
+        assert Student(name='Tom').age is None
+        assert isinstance(Student.is_male, BooleanField)
+
+    def test_compact(self):
+        with Select(Student, 'name=%s', compact=True) as select:
+            select.execute(('Thor', ))
+            thor = select.fetchone()
+        assert not hasattr(thor, '__dict__')
+        assert thor.age == 33 and type(thor.age) is int
+        assert thor.is_male is None
+        assert thor.to_model().name == 'Thor'
+
     def tearDown(self):
         for student in Student.fetchall():
             student.delete()
@@ -117,6 +150,437 @@ def JoinTestCase(TestCase):
         self.bob.delete()
 
 
+class ProjectionTestCase(TestCase):
+    def setUp(self):
+        self.movies = [Movie.insert(name='Movie %d' % i, casts=['Cast %d' % i],
+                                    earning=[{'country': 'USA', 'amount': i}])
+                       for i in range(3)]
+
+    def tearDown(self):
+        for movie in Movie.fetchall():
+            movie.delete()
+
+    def test_only(self):
+        with Select(Movie, 'name=%s', only=['name']) as select:
+            assert select.stmt.startswith('SELECT name,id FROM')
+            select.execute(('Movie 1', ))
+            movie = select.fetchone()
+        assert movie.name == 'Movie 1' and movie.id == self.movies[1].id
+        assert 'casts' not in movie.__dict__
+        # Loaded on first access
+        assert movie.casts[0] == 'Cast 1'
+        assert movie.earning[0]['amount'] == 1
+        assert '_deferred' not in movie.__dict__
+
+        with self.assertRaises(ValueError):
+            Select(Movie, only=['nope'])
+
+    def test_defer_batch(self):
+        movies = Movie.fetchall(defer=['casts', 'earning', 'trivia'])
+        assert all('earning' not in m.__dict__ for m in movies)
+        checkouts = get_pool().stats()['checkouts']
+        movies[0].update(casts=['Updated'])
+        assert movies[2].earning[0]['amount'] == 2
+        # One query for the whole result set, values set since are kept
+        assert get_pool().stats()['checkouts'] == checkouts + 2
+        assert [m.earning[0]['amount'] for m in movies] == [0, 1, 2]
+        assert movies[0].casts[0] == 'Updated'
+        assert movies[1].trivia is None
+        assert get_pool().stats()['checkouts'] == checkouts + 2
+
+    def test_compact(self):
+        with Select(Movie, only=['name'], compact=True) as select:
+            select.order_by('id')
+            select.execute()
+            movie = select.fetchone()
+        assert movie.name == 'Movie 0' and movie.casts is None
+
+
+class PaginationTestCase(TestCase):
+    def setUp(self):
+        self.students = Student.insert_many([{'name': 'Student %d' % i, 'age': i % 3}
+                                             for i in range(10)])
+
+    def tearDown(self):
+        Student.delete_where('TRUE')
+
+    def test_limit_offset(self):
+        with Select(Student) as select:
+            select.order_by('id')
+            select.limit(3)
+            select.offset(2)
+            select.execute()
+            assert [s.name for s in select.fetchall()] == ['Student 2', 'Student 3', 'Student 4']
+        assert len(Student.fetchmany(4)) == 4
+
+    def test_paginate_after(self):
+        pages = []
+        token = None
+        while True:
+            with Select(Student, 'age < %s') as select:
+                page, token = select.paginate_after(('age', 'id'), token, 3, values=(2, ))
+            pages.append([s.name for s in page])
+            if token is None:
+                break
+        # age 0: 0, 3, 6, 9 then age 1: 1, 4, 7
+        assert pages == [['Student 0', 'Student 3', 'Student 6'],
+                         ['Student 9', 'Student 1', 'Student 4'],
+                         ['Student 7']]
+
+        with Select(Student) as select:
+            page, token = select.paginate_after(['id'], [self.students[5].id], 2, desc=True)
+        assert [s.name for s in page] == ['Student 4', 'Student 3']
+        with Select(Student) as select:
+            page, token = select.paginate_after(['id'], token, 10, desc=True)
+        assert [s.name for s in page] == ['Student 2', 'Student 1', 'Student 0']
+        assert token is None
+
+        with self.assertRaises(ValueError):
+            Select(Student).paginate_after(['id'], 'garbage')
+
+
+class ResultTypeTestCase(TestCase):
+    def setUp(self):
+        self.tom = Student.insert(name='Tom', age=20, is_male=True)
+        self.anna = Student.insert(name='Anna', age=30, is_male=False)
+        self.jerry = Student.insert(name='Jerry')
+        Car.insert(name='Toyota', owner_id=self.tom.id)
+
+    def tearDown(self):
+        Student.delete_where('TRUE')
+
+    def select(self, as_, **kwargs):
+        with Select(Student, **kwargs) as select:
+            select.order_by('id')
+            select.execute()
+            return select.fetchall(as_)
+
+    def test_rows(self):
+        assert self.select('tuple', only=['name']) == [('Tom', self.tom.id),
+                                                       ('Anna', self.anna.id),
+                                                       ('Jerry', self.jerry.id)]
+        assert self.select('dict')[0] == {'name': 'Tom', 'age': 20, 'is_male': True,
+                                          'id': self.tom.id}
+        tom = self.select('namedtuple')[0]
+        assert (tom.name, tom.age, tom.id) == ('Tom', 20, self.tom.id)
+        with Select(Student, 'name = %s') as select:
+            select.execute(('Anna', ))
+            assert select.fetchone('dict')['age'] == 30
+            assert select.fetchone('dict') is None
+        with Select(Student) as select:
+            assert sorted(select.iter(batch_size=2, as_='tuple'))[0][0] == 'Anna'
+        with Join(Student, 'INNER JOIN', Car, 'students.id = cars.owner_id') as join:
+            join.execute()
+            assert join.fetchall('dict')[0]['cars.name'] == 'Toyota'
+        with self.assertRaises(ValueError):
+            self.select('list')
+
+    def test_columns(self):
+        columns = self.select('columns')
+        assert list(columns) == ['name', 'age', 'is_male', 'id']
+        assert columns['name'] == ['Tom', 'Anna', 'Jerry']
+        assert columns['age'] == [20, 30, None]
+
+    def test_numpy(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('NumPy is not installed')
+        columns = self.select('numpy')
+        assert columns['id'].dtype == np.int64
+        assert columns['age'].dtype == np.float64 and np.isnan(columns['age'][2])
+        assert columns['name'] == ['Tom', 'Anna', 'Jerry']
+        # NULL booleans can't be an array
+        assert columns['is_male'] == [True, False, None]
+        assert self.select('numpy', only=['is_male'], where='is_male IS NOT NULL')[
+            'is_male'].dtype == bool
+        empty = self.select('numpy', where='FALSE')
+        assert empty['age'].dtype == np.int64 and empty['name'] == []
+
+    def test_values(self):
+        assert Student.values('name', 'age', age=20) == [{'name': 'Tom', 'age': 20}]
+        assert Student.values(id=self.anna.id)[0]['name'] == 'Anna'
+        assert sorted(Student.values_list('name', flat=True)) == ['Anna', 'Jerry', 'Tom']
+        assert Student.values_list('id', 'name', where=Student.c.age > 25) == \
+            [(self.anna.id, 'Anna')]
+        assert Student.values_list('age', 'name', name='Tom') == [(20, 'Tom')]
+        with self.assertRaises(ValueError):
+            Student.values_list('name', 'age', flat=True)
+
+
+class AggregateTestCase(TestCase):
+    def setUp(self):
+        Student.insert_many([{'name': 'Student %d' % i, 'age': 10 + i % 3} for i in range(8)])
+
+    def tearDown(self):
+        Student.delete_where('TRUE')
+
+    def test_count_exists(self):
+        assert Student.count() == 8
+        assert Student.count(age=10) == 3
+        assert Student.count(Student.c.age > 10, name='Student 1') == 1
+        assert Student.exists(name='Student 7')
+        assert not Student.exists(Student.c.age > 12)
+
+    def test_group_by(self):
+        with Aggregate(Student, [Student.c.age, 'count(*)'], group_by=[Student.c.age]) as query:
+            query.order_by('age')
+            query.execute()
+            assert query.fetchall() == [(10, 3), (11, 3), (12, 2)]
+
+        with Aggregate(Student, {'age': 'age', 'students': 'count(*)', 'oldest': 'max(name)'},
+                       where=Student.c.name != 'Student 0', group_by=['age'],
+                       having='count(*) > %s', as_dict=True) as query:
+            query.order_by('age')
+            query.execute(('Student 0', 2))
+            assert query.fetchall() == [{'age': 11, 'students': 3, 'oldest': 'Student 7'}]
+
+        with Aggregate(Student, ['age', 'count(*)'], where=Student.c.age >= 11,
+                       group_by=['age'], having=Student.c.age < 12) as query:
+            query.execute()
+            assert query.fetchall() == [(11, 3)]
+
+
+class JoinGraphTestCase(TestCase):
+    def setUp(self):
+        self.tom = Student.insert(name='Tom', age=20)
+        self.jerry = Student.insert(name='Jerry', age=20)
+        self.bob = Student.insert(name='Bob', age=20)
+        Product.insert(name='weed', owner_id=self.tom.id, detail={})
+        Product.insert(name='smoke', owner_id=self.tom.id, detail={})
+        Product.insert(name='book', owner_id=self.jerry.id, detail={})
+        Car.insert(name='Toyota', owner_id=self.tom.id)
+        Car.insert(name='Nissan', owner_id=self.tom.id)
+
+    def tearDown(self):
+        Student.delete_where('TRUE')
+
+    def join(self, **kwargs):
+        return Join(Student, **kwargs) \
+            .join('LEFT JOIN', Product, Student.c.id == Product.c.owner_id) \
+            .join('LEFT JOIN', Car, 'students.id = cars.owner_id')
+
+    def test_chained(self):
+        with self.join() as join:
+            join.where(Student.c.name != 'Bob')
+            join.execute()
+            ret = join.fetchall()
+        assert len(ret) == 5
+        assert all(len(objs) == 3 for objs in ret)
+        # One object per row
+        toms = [student for student, _, _ in ret if student.name == 'Tom']
+        assert len(toms) == 4 and toms[0] is not toms[1]
+
+        with Join(Student, 'INNER JOIN', Product, 'students.id = products.owner_id',
+                  'INNER JOIN', Car, 'students.id = cars.owner_id') as join:
+            join.execute()
+            assert len(join.fetchall()) == 4
+
+    def test_identity(self):
+        with self.join(identity=True) as join:
+            join.order_by('students.id', 'products.id', 'cars.id')
+            join.execute()
+            ret = join.fetchall()
+        toms = [student for student, _, _ in ret if student.name == 'Tom']
+        assert len(toms) == 4 and toms[0] is toms[3]
+        assert ret[0][2] is ret[2][2]
+        # Bob has neither products nor cars
+        assert ret[-1][0].name == 'Bob' and ret[-1][1:] == (None, None)
+
+    def check_graph(self, students):
+        assert [s.name for s in students] == ['Tom', 'Jerry', 'Bob']
+        tom, jerry, bob = students
+        assert sorted(p.name for p in tom.products) == ['smoke', 'weed']
+        assert sorted(c.name for c in tom.cars) == ['Nissan', 'Toyota']
+        assert [p.name for p in jerry.products] == ['book'] and jerry.cars == []
+        assert bob.products == [] and bob.cars == []
+
+    def test_graph(self):
+        with self.join() as join:
+            join.order_by('students.id')
+            join.execute()
+            self.check_graph(join.fetch_graph())
+
+        with self.join() as join:
+            join.order_by('students.id')
+            self.check_graph(list(join.iter_graph(batch_size=2)))
+        assert get_pool().stats()['in_use'] == 0
+
+
+class StreamTestCase(TestCase):
+    def setUp(self):
+        Student.insert_many([{'name': 'Student %d' % i, 'age': i} for i in range(50)],
+                            returning=False)
+
+    def test_stream(self):
+        ages = [s.age for s in Student.iter(batch_size=7)]
+        assert sorted(ages) == list(range(50))
+
+        with Select(Student, 'age < %s') as select:
+            select.order_by('age')
+            young = list(select.stream((10, ), batch_size=3))
+        assert [s.age for s in young] == list(range(10))
+
+    def test_stream_closed_early(self):
+        used = get_pool().stats()['in_use']
+        students = Student.iter(batch_size=5, name='Student 1')
+        assert next(students).age == 1
+        assert get_pool().stats()['in_use'] == used + 1
+        students.close()
+        assert get_pool().stats()['in_use'] == used
+
+        # Closed after the exit of its query: no connection is taken to close the cursor
+        with Select(Student, 'age < %s') as select:
+            students = select.iter((10, ), batch_size=3)
+            next(students)
+        students.close()
+        assert get_pool().stats()['in_use'] == used
+
+    def tearDown(self):
+        for student in Student.fetchall():
+            student.delete()
+
+
+class StatementCacheTestCase(TestCase):
+    def setUp(self):
+        pass
+
+    def test_statement_cache(self):
+        Student.insert(name='Pete', age=22)
+        hits, misses = statement_cache.hits, statement_cache.misses
+        john = Student.insert(name='John', age=23)
+        john.update(age=24)
+        john.update(age=25)
+        assert statement_cache.hits >= hits + 2
+        assert Student.fetchone(id=john.id).age == 25
+
+    def tearDown(self):
+        for student in Student.fetchall():
+            student.delete()
+
+
+class PreparedStatementTestCase(TestCase):
+    def setUp(self):
+        use_prepared_statements()
+
+    def test_prepared_statements(self):
+        peter = Student.insert(name='Peter', age=15)
+        for age in range(16, 20):
+            peter.update(age=age)
+            assert Student.fetchone(id=peter.id).age == age
+
+        with Select(Student, 'name=%s and age > %s') as select:
+            select.execute(('Peter', 10))
+            assert len(select.fetchall()) == 1
+            stmts = prepared_statements(select.conn)
+            assert stmts[select.stmt].startswith('EXECUTE postgrespy_')
+
+        with Select(Student, "name LIKE 'Pet%'", prepared=True) as select:
+            select.execute()
+            assert len(select.fetchall()) == 1
+
+        peter.delete()
+        assert Student.fetchone(id=peter.id) is None
+
+    def tearDown(self):
+        use_prepared_statements(False)
+        for student in Student.fetchall():
+            student.delete()
+
+
+class Events(Listener):
+    def __init__(self):
+        self.events = []
+
+    def after(self, event):
+        self.events.append(event)
+
+
+class DirtyTrackingTestCase(TestCase):
+    def setUp(self):
+        self.tom = Student.insert(name='Tom', age=20)
+        self.meth = Product.insert(name='meth', owner_id=self.tom.id,
+                                   detail={'color': 'red', 'tags': ['a']})
+        self.movie = Movie.insert(name='Wonder Woman', casts=['Gal Gadot'],
+                                  earning=[{'country': 'USA', 'amount': 100}])
+        self.listener = add_listener(Events())
+        self.events = self.listener.events
+
+    def tearDown(self):
+        remove_listener(self.listener)
+        Student.delete_where('TRUE')
+        Movie.delete_where('TRUE')
+
+    def test_changes(self):
+        tom = Student.fetchone(id=self.tom.id)
+        assert tom.changes() == {} and tom.save() == ()
+        tom.age = 20
+        assert tom.changes() == {}
+        tom.age = 21
+        tom.is_male = True
+        assert tom.changes() == {'age': 21, 'is_male': True}
+        assert tom.save() == ('age', 'is_male')
+        assert tom.changes() == {} and tom.save() == ()
+        # A single UPDATE of the changed columns
+        updates = [e for e in self.events if e.operation == 'update']
+        assert len(updates) == 1
+        assert updates[0].stmt == 'UPDATE students SET age = %s,is_male = %s WHERE id = %s'
+        assert Student.fetchone(id=tom.id).age == 21
+        assert self.tom.changes() == {}
+
+    def test_mutable(self):
+        meth = Product.fetchone(id=self.meth.id)
+        meth.detail['tags'].append('b')
+        assert meth.changes() == {'detail': {'color': 'red', 'tags': ['a', 'b']}}
+        meth.save()
+        assert meth.changes() == {}
+        assert Product.fetchone(id=meth.id).detail['tags'] == ['a', 'b']
+
+        movie = Movie.fetchone(id=self.movie.id)
+        movie.earning[0]['amount'] = 200
+        assert tuple(movie.changes()) == ('earning', )
+        movie.save()
+        assert Movie.fetchone(id=movie.id).earning[0]['amount'] == 200
+
+        # Columns loaded on first access are tracked too
+        movie = Movie.fetchone(id=self.movie.id, only=['name'])
+        movie.casts.append('Chris Pine')
+        assert tuple(movie.changes()) == ('casts', )
+
+        # Snapshots are taken on the first read, not by the hydration
+        meth = Product.fetchone(id=self.meth.id)
+        assert '_snapshots' not in meth.__dict__ and meth.changes() == {}
+        meth.detail = {'color': 'blue'}
+        meth.detail['size'] = 1
+        assert meth.changes() == {'detail': {'color': 'blue', 'size': 1}}
+
+    def test_save_new(self):
+        jerry = Student(name='Jerry', age=10)
+        assert jerry.save() == ('name', 'age')
+        assert jerry.id is not None and jerry.changes() == {}
+        assert Student.fetchone(id=jerry.id).name == 'Jerry'
+
+    def test_save_all(self):
+        students = [Student.insert(name='Student %d' % i, age=i) for i in range(6)]
+        del self.events[:]
+        for s in students[:4]:
+            s.age += 10
+        students[1].is_male = True
+        students[3].is_male = False
+        new = Student(name='New', age=1)
+        assert Student.save_all(students + [new]) == 5
+        assert new.id is not None
+        # One INSERT, one UPDATE per set of changed columns
+        assert [e.operation for e in self.events] == \
+            ['insert_many', 'update_many', 'update_many']
+        assert [e.rows for e in self.events] == [1, 2, 2]
+        assert all(s.changes() == {} for s in students)
+        assert Student.save_all(students) == 0
+        ages = {s.name: s.age for s in Student.fetchall()}
+        assert [ages['Student %d' % i] for i in range(6)] == [10, 11, 12, 13, 4, 5]
+        assert Student.count(is_male=True) == 1 and ages['New'] == 1
+
+
 class NothingTestCase(TestCase):
     """This test case ensures that all objects have been deleted"""
 
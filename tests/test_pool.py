@@ -0,0 +1,83 @@
+""" Contain tests for postgrespy.pool.ConnectionPool"""
+
+import os
+import threading
+import time
+from unittest import TestCase
+
+from postgrespy import PoolTimeoutError
+from postgrespy.db import settings
+from postgrespy.pool import ConnectionPool
+
+
+class ConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        kwargs = settings(minconn=1, maxconn=2)
+        self.pool = ConnectionPool(timeout=5, **kwargs)
+
+    def tearDown(self):
+        self.pool.closeall()
+
+    def test_wait_and_timeout(self):
+        conn_0 = self.pool.getconn()
+        conn_1 = self.pool.getconn()
+        with self.assertRaises(PoolTimeoutError):
+            self.pool.getconn(timeout=0.05)
+
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.pool.getconn()))
+        waiter.start()
+        time.sleep(0.05)
+        self.pool.putconn(conn_1)
+        waiter.join()
+        assert got == [conn_1]
+
+        stats = self.pool.stats()
+        assert stats['waits'] == 2 and stats['timeouts'] == 1
+        assert stats['in_use'] == 2 and stats['size'] == 2
+        self.pool.putconn(conn_0)
+        self.pool.putconn(got[0])
+        assert self.pool.stats()['idle'] == 2
+
+    def test_recycle(self):
+        conn = self.pool.getconn()
+        self.pool.putconn(conn)
+        self.pool.max_lifetime = 0
+        new_conn = self.pool.getconn()
+        assert new_conn is not conn and conn.closed
+        assert self.pool.stats()['recycled'] == 1
+        self.pool.putconn(new_conn)
+
+    def test_broken(self):
+        conn = self.pool.getconn()
+        conn.close()
+        self.pool.putconn(conn)
+        assert self.pool.stats()['broken'] == 1
+
+        # Simulate a connection killed by the server while idle in the pool
+        conn, other = self.pool.getconn(), self.pool.getconn()
+        self.pool.putconn(conn)
+        with other.cursor() as cur:
+            cur.execute('SELECT pg_terminate_backend(%s)', (conn.get_backend_pid(), ))
+        other.commit()
+        self.pool.ping_after = 0
+        new_conn = self.pool.getconn()
+        assert new_conn is not conn
+        with new_conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        assert self.pool.stats()['broken'] == 2
+        self.pool.putconn(new_conn)
+        self.pool.putconn(other)
+
+    def test_fork(self):
+        conn = self.pool.getconn()
+        self.pool.putconn(conn)
+        # Pretend to be a child process, forked while another thread held the lock
+        self.pool._pid = self.pool._lock_pid = os.getpid() + 1
+        held = self.pool._lock
+        held.acquire()
+        new_conn = self.pool.getconn()
+        held.release()
+        assert new_conn is not conn and not conn.closed
+        assert self.pool.stats()['size'] == 1
+        self.pool.putconn(new_conn)
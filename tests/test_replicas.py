@@ -0,0 +1,86 @@
+""" Contain tests for the read replica routing of postgrespy.db"""
+
+from unittest import TestCase
+
+from postgrespy import transaction
+from postgrespy.cache import RowCache
+from postgrespy.db import add_replica, remove_replica, set_routing, on_primary, get_pool
+from postgrespy.fields import TextField, IntegerField, BooleanField
+from postgrespy.models import Model
+from postgrespy.queries import Select
+
+from .models import Student
+
+
+class CachedStudent(Model):
+    name = TextField()
+    age = IntegerField()
+    is_male = BooleanField()
+
+    class Meta:
+        table = 'students'
+        cache = RowCache(maxsize=10, ttl=60)
+
+
+class ReplicaTestCase(TestCase):
+    def setUp(self):
+        # Both "replicas" are the test server itself, under another application_name
+        self.replicas = [add_replica('replica_%d' % i, minconn=0, application_name='replica_%d' % i)
+                         for i in range(2)]
+        self.tom = Student.insert(name='Tom', age=20)
+
+    def tearDown(self):
+        for i in range(2):
+            remove_replica('replica_%d' % i)
+        set_routing('round_robin')
+        for student in Student.fetchall():
+            student.delete()
+
+    def checkouts(self):
+        return [pool.stats()['checkouts'] for pool in self.replicas]
+
+    def test_round_robin(self):
+        before = self.checkouts()
+        Student.insert(name='Jerry')
+        assert self.checkouts() == before
+
+        for _ in range(4):
+            assert Student.fetchone(id=self.tom.id).name == 'Tom'
+        assert self.checkouts() == [before[0] + 2, before[1] + 2]
+
+        with Select(Student, 'name=%s') as select:
+            select.execute(('Tom', ))
+            with select.conn.cursor() as cur:
+                cur.execute("SELECT current_setting('application_name')")
+                assert cur.fetchone()[0].startswith('replica_')
+
+    def test_primary(self):
+        before = self.checkouts()
+        primary_checkouts = get_pool().stats()['checkouts']
+        with Select(Student, primary=True) as select:
+            select.execute()
+            assert len(select.fetchall()) == 1
+        with on_primary():
+            Student.fetchone(id=self.tom.id)
+        with transaction():
+            Student.fetchall()
+        assert self.checkouts() == before
+        assert get_pool().stats()['checkouts'] == primary_checkouts + 3
+
+    def test_least_busy(self):
+        set_routing('least_busy')
+        busy = self.replicas[0].getconn()
+        before = self.checkouts()
+        Student.fetchone(id=self.tom.id)
+        Student.fetchone(id=self.tom.id)
+        assert self.checkouts() == [before[0], before[1] + 2]
+        self.replicas[0].putconn(busy)
+
+    def test_row_cache(self):
+        # The rows of the cache are read from the primary
+        before = self.checkouts()
+        assert CachedStudent.fetchone(id=self.tom.id).name == 'Tom'
+        assert CachedStudent.fetch_by_ids([self.tom.id, self.tom.id + 1000])[0].name == 'Tom'
+        assert self.checkouts() == before
+        assert CachedStudent.Meta.cache.info()['hits'] == 1
+        CachedStudent.Meta.cache.clear()
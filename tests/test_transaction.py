@@ -0,0 +1,91 @@
+""" Contain tests for postgrespy.transaction()"""
+
+from unittest import TestCase
+
+from postgrespy import transaction, UniqueViolatedError
+from postgrespy.db import get_pool
+from postgrespy.queries import Select
+
+from .models import Student, Car
+
+
+def count_committed(model_cls):
+    """Count the rows of `model_cls` from a connection outside of any transaction"""
+    conn = get_pool().getconn()
+    with conn.cursor() as cur:
+        cur.execute('SELECT count(*) FROM ' + model_cls.Meta.table)
+        count = cur.fetchone()[0]
+    conn.rollback()
+    get_pool().putconn(conn)
+    return count
+
+
+class TransactionTestCase(TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        for student in Student.fetchall():
+            student.delete()
+
+    def test_commit(self):
+        with transaction():
+            tom = Student.insert(name='Tom', age=20)
+            Car.insert(name='Toyota', owner_id=tom.id)
+            tom.update(age=21)
+            # Visible inside the transaction, not outside yet
+            assert Student.fetchone(id=tom.id).age == 21
+            with Select(Car, 'owner_id=%s') as select:
+                select.execute((tom.id, ))
+                assert len(select.fetchall()) == 1
+            assert count_committed(Student) == 0
+        assert count_committed(Student) == 1
+        assert count_committed(Car) == 1
+
+    def test_rollback(self):
+        with self.assertRaises(ZeroDivisionError):
+            with transaction():
+                Student.insert(name='Tom', age=20)
+                1 / 0
+        assert Student.fetchall() == []
+
+    def test_savepoint(self):
+        with transaction():
+            tom = Student.insert(name='Tom', age=20)
+            with self.assertRaises(UniqueViolatedError):
+                with transaction():
+                    Student.insert(name='Jerry')
+                    Student.insert(id=tom.id, name='Tom again')
+            Student.insert(name='Bob')
+        assert sorted(s.name for s in Student.fetchall()) == ['Bob', 'Tom']
+
+    def test_batch_writes(self):
+        students = Student.insert_many([{'name': 'Student %d' % i, 'age': i}
+                                        for i in range(10)])
+        with transaction(batch_writes=True) as tx:
+            for student in students:
+                student.update(age=student.age + 100)
+            students[0].delete()
+            assert len(tx._pending) == 2
+            # Reads see the queued writes
+            assert Student.fetchone(id=students[1].id).age == 101
+            assert tx._pending == []
+            students[2].update(age=0)
+        assert Student.fetchone(id=students[0].id) is None
+        assert Student.fetchone(id=students[2].id).age == 0
+        assert Student.fetchone(id=students[9].id).age == 109
+
+    def test_batch_writes_savepoint(self):
+        tom = Student.insert(name='Tom', age=20)
+        jerry = Student.insert(name='Jerry', age=10)
+        with transaction(batch_writes=True):
+            # The queued update fails when the nested block is flushed
+            with self.assertRaises(UniqueViolatedError):
+                with transaction():
+                    tom.update(age=21)
+                    Student(id=jerry.id).update(id=tom.id)
+            # The outer transaction is still usable
+            jerry.update(age=11)
+            assert Student.fetchone(id=jerry.id).age == 11
+        assert Student.fetchone(id=tom.id).age == 20
+        assert Student.fetchone(id=jerry.id).age == 11